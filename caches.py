@@ -0,0 +1,156 @@
+from __future__ import absolute_import, division, print_function
+
+# Caches shared by diffimTests and imageDecorrelation, so that repeated decorrelations of
+# diffims with the same matching kernel and variances do not recompute the kernels and PSFs,
+# nor allocate new output exposures.
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+import numpy as np
+
+__all__ = ("KernelCache", "ExposurePool")
+
+
+class KernelCache(object):
+    """!
+    \\brief A least-recently-used cache of decorrelation kernels and corrected PSFs
+
+    Entries are keyed by a name, a hash of the input kernel arrays and the exact values of the
+    variances. Each kernel is hashed after rounding to `kernelDigits` digits relative to its largest
+    absolute value (which is itself kept to `kernelDigits` significant digits), so that kernels
+    differing only by round-off collide whatever their normalization. Approximate reuse across
+    variances is opt-in: with `varianceDigits` set, variances that agree to that many significant
+    digits (a relative tolerance of about 10**-varianceDigits) share an entry, so that a result
+    computed for slightly different variances may be returned. Cached numpy arrays are returned as copies so callers may modify them; other
+    values (e.g. a kernelOps.DecorrelationFilter, which copies its outputs itself) are shared and
+    must not be modified.
+    The cache is thread-safe (values are computed outside the lock).
+    """
+
+    def __init__(self, maxSize=64, varianceDigits=None, kernelDigits=8):
+        self.maxSize = maxSize
+        self.varianceDigits = varianceDigits
+        self.kernelDigits = kernelDigits
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def makeKey(self, name, arrays, variances):
+        h = hashlib.sha1()
+        for arr in arrays:
+            arr = np.asarray(arr, dtype=np.float64)
+            scale = np.max(np.abs(arr)) if arr.size else 0.
+            if scale > 0:
+                arr = np.round(arr / scale, self.kernelDigits) + 0.  # + 0. turns -0. into 0.
+            h.update(str(arr.shape).encode())
+            h.update(('%.*g' % (self.kernelDigits, scale)).encode())
+            h.update(np.ascontiguousarray(arr).tobytes())
+        if self.varianceDigits is None:
+            variances = tuple(float(v) for v in variances)
+        else:
+            variances = tuple(float('%.*g' % (self.varianceDigits, v)) for v in variances)
+        return (name, h.hexdigest(), variances)
+
+    def get(self, name, arrays, variances, compute):
+        """! Return the cached result of `compute()` for these inputs, computing it on a miss.
+        @param name  Name of the quantity being cached
+        @param arrays  List of input numpy arrays (e.g. the matching kernel)
+        @param variances  List of input variances (e.g. svar, tvar)
+        @param compute  Callable taking no arguments that computes the result
+        """
+        if self.maxSize <= 0:
+            with self.lock:
+                self.misses += 1
+            return compute()
+        key = self.makeKey(name, arrays, variances)
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.hits += 1
+                self.entries[key] = value
+                return self._copy(value)
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            while len(self.entries) >= self.maxSize:
+                self.entries.popitem(last=False)
+            self.entries[key] = value
+        return self._copy(value)
+
+    @staticmethod
+    def _copy(value):
+        return value.copy() if isinstance(value, np.ndarray) else value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+
+class ExposurePool(object):
+    """!
+    \\brief A pool of preallocated Exposures (or MaskedImages) to use as convolution outputs
+
+    `acquire()` hands out a buffer with the same type and bounding box as its template, copying only
+    the metadata (PSF, WCS, calib zero-point, filter and a copy of the header) and, optionally, the
+    mask plane; the image and variance pixels are left as they were and must be overwritten by the
+    caller. Buffers that are `release()`d are kept (at most `maxPerKey` per type and bbox) and
+    reused by later calls, instead of calling `clone()` every time. The pool is thread-safe.
+    """
+
+    def __init__(self, maxPerKey=4):
+        self.maxPerKey = maxPerKey
+        self.free = {}
+        self.lock = threading.Lock()
+        self.nAllocated = self.nReused = 0
+
+    @staticmethod
+    def _key(obj):
+        bbox = obj.getBBox()
+        return (type(obj), bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight())
+
+    def acquire(self, template, copyMask=False):
+        """! Return a buffer matching `template`.
+        @param template  The afw.image.Exposure or MaskedImage to match
+        @param copyMask  Copy the mask plane of `template` into the buffer
+        """
+        key = self._key(template)
+        with self.lock:
+            buffers = self.free.get(key)
+            buf = buffers.pop() if buffers else None
+            if buf is None:
+                self.nAllocated += 1
+            else:
+                self.nReused += 1
+        if buf is None:
+            buf = template.Factory(template.getBBox())
+
+        if hasattr(template, 'getMaskedImage'):
+            buf.setPsf(template.getPsf() if template.hasPsf() else None)
+            buf.setWcs(template.getWcs() if template.hasWcs() else None)
+            # The buffer keeps its own Calib and header, as clone() would, so that changing them on
+            # the output does not change the input's
+            buf.getCalib().setFluxMag0(*template.getCalib().getFluxMag0())
+            buf.setFilter(template.getFilter())
+            buf.setMetadata(template.getMetadata().deepCopy())
+            if copyMask:
+                buf.getMaskedImage().getMask().getArray()[:, :] = \
+                    template.getMaskedImage().getMask().getArray()
+        elif copyMask:
+            buf.getMask().getArray()[:, :] = template.getMask().getArray()
+        return buf
+
+    def release(self, buf):
+        """! Return a buffer obtained from `acquire()` to the pool; the caller must not use it afterwards.
+        """
+        key = self._key(buf)
+        with self.lock:
+            buffers = self.free.setdefault(key, [])
+            if len(buffers) < self.maxPerKey:
+                buffers.append(buf)
+
+    def clear(self):
+        with self.lock:
+            self.free.clear()
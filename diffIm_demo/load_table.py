@@ -1,7 +1,9 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import lsst.daf.persistence as dp
+import diffimTests as dit
 butler=dp.Butler('decamDirTest')
 sources=butler.get('deepDiff_diaSrc',visit=289820,ccdnum=11)
 print sources[0].extract('ip_diffim_Naive*')
-import pandas as pd
-df = pd.DataFrame({col: sources.columns[col] for col in sources.schema.getNames()})
-
+df = dit.catalogToDataFrame(sources)  # or e.g. columns=['id', 'ip_diffim_Naive*'] for only those
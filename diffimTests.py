@@ -1,3 +1,8 @@
+import os
+import collections
+import contextlib
+import threading
+import warnings
 import numpy as np
 from numpy.polynomial.chebyshev import chebval2d
 import scipy
@@ -6,7 +11,14 @@ from scipy.fftpack import fft2, ifft2, fftshift, ifftshift
 import scipy.ndimage.filters
 import scipy.signal
 
+import kernelOps
+import caches
+import imageStats
+import sourceMatching
+import fastDetection
+
 log_level = None
+log = None  # the 'diffimTests' lsst.log logger, if the stack is set up
 try:
     import lsst.afw.image as afwImage
     import lsst.afw.math as afwMath
@@ -23,6 +35,7 @@ try:
     lsst.log.Log.getLogger('TRACE2.afw.math.convolve.basicConvolve').setLevel(lsst.log.ERROR)
     lsst.log.Log.getLogger('TRACE4.afw.math.convolve.convolveWithBruteForce').setLevel(lsst.log.ERROR)
     log_level = lsst.log.ERROR  # INFO
+    log = lsst.log.Log.getLogger('diffimTests')
     import lsst.log.utils as logUtils
     logUtils.traceSetAt('afw', 0)
 except Exception as e:
@@ -31,23 +44,9 @@ except Exception as e:
 
 def zscale_image(input_img, contrast=0.25):
     """This emulates ds9's zscale feature. Returns the suggested minimum and
-    maximum values to display."""
-
-    samples = input_img.flatten()
-    samples = samples[~np.isnan(samples)]
-    samples.sort()
-    chop_size = int(0.10*len(samples))
-    subset = samples[chop_size:-chop_size]
-
-    i_midpoint = int(len(subset)/2)
-    I_mid = subset[i_midpoint]
-
-    fit = np.polyfit(np.arange(len(subset)) - i_midpoint, subset, 1)
-    # fit = [ slope, intercept]
-
-    z1 = I_mid + fit[0]/contrast * (1-i_midpoint)/1.0
-    z2 = I_mid + fit[0]/contrast * (len(subset)-i_midpoint)/1.0
-    return z1, z2
+    maximum values to display. See imageStats.zscale; it works on a fixed-size
+    sample of the pixels, and the result is cached per image."""
+    return imageStats.zscale(input_img, contrast=contrast)
 
 def plotImageGrid(images, nrows_ncols=None, extent=None, clim=None, interpolation='none',
                   cmap='gray', imScale=2., cbar=True, titles=None, titlecol=['r','y'], **kwds):
@@ -607,35 +606,22 @@ def getMatchingKernelAL(pars, basis, constKernelIndices, nonConstKernelIndices,
 #     pcf = pcf.real / pcf.real.sum()
 #     return pcf
 
-def computeClippedImageStats(im, low=3, high=3, ignore=None):
-    im = im[~(np.isnan(im) | np.isinf(im))]
-    if ignore is not None:
-        for i in ignore:
-            im = im[im != i]
-    tmp = im
-    if low != 0 and high != 0 and tmp.min() != tmp.max():
-        _, low, upp = scipy.stats.sigmaclip(tmp, low=low, high=high)
-        if not np.isnan(low) and not np.isnan(upp) and low != upp:
-            tmp = im[(im > low) & (im < upp)]
-    mean1 = np.nanmean(tmp)
-    sig1 = np.nanstd(tmp)
-    return mean1, sig1, np.nanmin(im), np.nanmax(im)
+def computeClippedImageStats(im, low=3, high=3, ignore=None, method='exact'):
+    # Sigma-clipping with scipy.stats.sigmaclip, in chunks; see imageStats.clippedStats. `im` may
+    # also be a list of chunks. method='histogram' avoids any copy of `im` (e.g. for memmaps), at
+    # the cost of three passes over it and a slightly approximate result.
+    return imageStats.clippedStats(im, low=low, high=high, ignore=ignore, method=method)
 
 
 # compute rms x- and y- pixel offset between two catalogs. Assume input is 2- or 3-column dataframe.
 # Assume 1st column is x-coord and 2nd is y-coord. 
 # If 3-column then 3rd column is flux and use flux**2 as weighting on shift calculation
 # We need some severe filtering if we have lots of sources
+# Sources are matched one-to-one (closest first) within `threshold` pixels; see sourceMatching.
 def computeOffsets(src1, src2, threshold=2.5, fluxWeighted=True):
-    dist = np.sqrt(np.add.outer(src1.iloc[:, 0], -src2.iloc[:, 0])**2. +
-                   np.add.outer(src1.iloc[:, 1], -src2.iloc[:, 1])**2.)  # in pixels
-    matches = np.where(dist <= threshold)
-    match1 = src1.iloc[matches[0], :]
-    match2 = src2.iloc[matches[1], :]
-    if len(matches[0]) > src1.shape[0]:
-        print 'WARNING: Threshold for ast. matching is probably too small:', match1.shape[0], src1.shape[0]
-    if len(matches[1]) > src2.shape[0]:
-        print 'WARNING: Threshold for ast. matching is probably too small:', match2.shape[0], src2.shape[0]
+    idx1, idx2, _ = sourceMatching.matchSources(src1.iloc[:, :2].values, src2.iloc[:, :2].values, threshold)
+    match1 = src1.iloc[idx1, :]
+    match2 = src2.iloc[idx2, :]
     dx = (match1.iloc[:, 0].values - match2.iloc[:, 0].values)
     _, dxlow, dxupp = scipy.stats.sigmaclip(dx, low=2, high=2)
     dy = (match1.iloc[:, 1].values - match2.iloc[:, 1].values)
@@ -652,6 +638,83 @@ def computeOffsets(src1, src2, threshold=2.5, fluxWeighted=True):
     return dx, dy, rms
 
 
+# Offset of im1 relative to im2 (the position of a source in im1 minus that in im2, x along
+# the 2nd axis as in the catalogs) from the peak of their FFT cross-correlation. The cross-power
+# spectrum F1 F2* is divided by |F1 F2*|**whitening: whitening=1 is pure phase correlation, which
+# gives equal weight to the frequencies beyond the PSF's band that hold only noise, so its
+# offsets scatter by tenths of a pixel on noisy tiles; whitening=0 (plain cross-correlation)
+# weights the frequencies by their signal power and is the most accurate for noise-limited
+# images. The integer peak is refined on a grid of 1/upsample pixels by evaluating the
+# correlation there with a matrix DFT of the cross-power spectrum (Guizar-Sicairos et al. 2008),
+# then by a parabola through that grid's peak, instead of a parabola through the integer peak,
+# which is biased by up to ~0.07 pixels towards the nearest integer. The images are tapered with
+# a Hann window to suppress the edge discontinuity, which biases the offsets towards zero by ~3%
+# of their size (use window=False where the sources are away from the edges).
+# Returns dx, dy, the correlation peak (1 for identical images, by Cauchy-Schwarz) and the rms
+# of the correlation more than 5 pixels away from its peak; peak / rms is the significance of
+# the peak (up to ~10 for unrelated noise on 64x64 tiles).
+def phaseCorrelationOffset(im1, im2, window=True, whitening=0., upsample=20):
+    im1 = np.nan_to_num(im1 - np.nanmean(im1))
+    im2 = np.nan_to_num(im2 - np.nanmean(im2))
+    if window:
+        w = np.outer(np.hanning(im1.shape[0]), np.hanning(im1.shape[1]))
+        im1, im2 = im1 * w, im2 * w
+    F1, F2 = fft2(im1), fft2(im2)
+    cross = F1 * np.conj(F2)
+    if whitening > 0:
+        cross /= np.maximum(np.abs(cross), 1e-12 * np.abs(cross).max())**whitening
+    norm = np.sqrt(np.sum(np.abs(F1)**(2. * (1. - whitening))) *
+                   np.sum(np.abs(F2)**(2. * (1. - whitening)))) / cross.size
+    corr = ifft2(cross).real / norm
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+
+    # Distances from the peak, with wrap-around
+    dist = [(np.arange(n) - p + n // 2) % n - n // 2 for p, n in zip(peak, corr.shape)]
+    rms = np.sqrt(np.mean(corr[(dist[0][:, None]**2 + dist[1][None, :]**2) > 25]**2))
+
+    y0, x0 = [p - n if p > n // 2 else p for p, n in zip(peak, corr.shape)]  # wrap to +/- n/2
+    peakValue = corr[peak]
+    if upsample > 1:
+        lags = np.arange(-upsample, upsample + 1) / float(upsample)
+        ey, ex = [np.exp(2j * np.pi * np.outer(p + lags, np.fft.fftfreq(n)))
+                  for p, n in zip((y0, x0), corr.shape)]
+        up = ey.dot(cross).dot(ex.T).real / cross.size / norm
+        i, j = np.unravel_index(np.argmax(up), up.shape)
+        i, j = np.clip(i, 1, len(lags) - 2), np.clip(j, 1, len(lags) - 2)
+        y0 += lags[i] + _parabolaPeak(up[i - 1, j], up[i, j], up[i + 1, j]) / upsample
+        x0 += lags[j] + _parabolaPeak(up[i, j - 1], up[i, j], up[i, j + 1]) / upsample
+        peakValue = up[i, j]
+    else:
+        y0 += _parabolaPeak(corr[(peak[0] - 1) % corr.shape[0], peak[1]], corr[peak],
+                            corr[(peak[0] + 1) % corr.shape[0], peak[1]])
+        x0 += _parabolaPeak(corr[peak[0], (peak[1] - 1) % corr.shape[1]], corr[peak],
+                            corr[peak[0], (peak[1] + 1) % corr.shape[1]])
+    return x0, y0, peakValue, rms
+
+
+# Offset of the vertex of the parabola through (-1, cm), (0, c0), (1, cp) (0 if it is not a maximum)
+def _parabolaPeak(cm, c0, cp):
+    denom = cm - 2. * c0 + cp
+    return 0.5 * (cm - cp) / denom if denom < 0 else 0.
+
+
+# Phase-correlation offsets (see phaseCorrelationOffset()) of im1 relative to im2 on
+# (tileSize x tileSize) tiles, i.e. an offset field, or of the whole images if tileSize is None.
+# Returns arrays of the tile centers x, y, of the offsets dx, dy, and of the correlation peaks
+# and rms's.
+def computePhaseCorrelationOffsets(im1, im2, tileSize=None, window=True, whitening=0., upsample=20):
+    tileSize = im1.shape if tileSize is None else np.broadcast_to(tileSize, 2)
+    out = []
+    for i in range(0, im1.shape[0] - tileSize[0] + 1, tileSize[0]):
+        for j in range(0, im1.shape[1] - tileSize[1] + 1, tileSize[1]):
+            sl = (slice(i, i + tileSize[0]), slice(j, j + tileSize[1]))
+            dx, dy, peak, rms = phaseCorrelationOffset(im1[sl], im2[sl], window=window,
+                                                       whitening=whitening, upsample=upsample)
+            out.append((j + tileSize[1] / 2., i + tileSize[0] / 2., dx, dy, peak, rms))
+    x, y, dx, dy, peak, rms = (np.array(v) for v in zip(*out))
+    return x, y, dx, dy, peak, rms
+
+
 def getImageGrid(im):
     xim = np.arange(np.int(-np.floor(im.shape[0]/2.)), np.int(np.floor(im.shape[0]/2)))
     yim = np.arange(np.int(-np.floor(im.shape[1]/2.)), np.int(np.floor(im.shape[1]/2)))
@@ -660,9 +723,48 @@ def getImageGrid(im):
 
 
 # Here, im2 is science, im1 is template
+# Apply the (optional) decorrelation kernel to an A&L diffim D = im2 [(x) pc] - im1 (x) kappa, and
+# propagate the variance planes of im1 and im2 to it:
+#   var_D = pck**2 (x) (var2 [(x) pc**2] + var1 (x) kappa**2),
+# all as linear (zero-padded) convolutions in a single Fourier-domain pass that shares the padded
+# shape with the image path. Real arrays are transformed in pairs, as one complex FFT each (see
+# kernelOps.splitFT()): the two variance planes, kappa**2 and pc**2, and the decorrelation kernel
+# (for the image) and its square (for the variance), so the variance costs two forward FFTs and
+# one inverse FFT more than decorrelating the image alone. Returns the (decorrelated) diffim and
+# its variance.
+def applyALKernelsInFourierSpace(diffim, var1, var2, kappa, decorrKernel=None, preConvKernel=None):
+    kernels = [k for k in (kappa, decorrKernel, preConvKernel) if k is not None]
+    pad = np.sum([k.shape for k in kernels], axis=0)
+    shape = [scipy.fftpack.next_fast_len(diffim.shape[i] + pad[i]) for i in range(2)]
+
+    def inverse(arr_hat):
+        return scipy.fftpack.ifft2(arr_hat).real[:diffim.shape[0], :diffim.shape[1]]
+
+    V1_hat, V2_hat = kernelOps.splitFT(scipy.fftpack.fft2(var1 + 1j * var2, shape=shape))
+    if preConvKernel is not None:
+        size = np.maximum(kappa.shape, preConvKernel.shape)
+        K2_hat, PC2_hat = kernelOps.splitFT(kernelOps.kernelFT(
+            kernelOps.padKernels(kappa**2, size) + 1j * kernelOps.padKernels(preConvKernel**2, size), shape))
+        V_hat = V1_hat * K2_hat + V2_hat * PC2_hat
+    else:
+        V_hat = V1_hat * kernelOps.kernelFT(kappa**2, shape) + V2_hat
+    del V1_hat, V2_hat
+
+    if decorrKernel is not None:
+        D_hat, D2_hat = kernelOps.splitFT(kernelOps.kernelFT(decorrKernel + 1j * decorrKernel**2, shape))
+        diffim = kernelOps.filterArray(diffim, D_hat)
+        V_hat *= D2_hat
+    return diffim, inverse(V_hat)
+
+
+# Returns the diffim, its PSF, the matching kernel and the variance of the diffim. The variance is
+# only computed if var1 and var2 (the variance planes of im1 and im2) are given, in which case the
+# decorrelation and the variance propagation are done with applyALKernelsInFourierSpace();
+# otherwise it is None.
 def performAlardLupton(im1, im2, sigGauss=None, degGauss=None, betaGauss=1, kernelSize=25,
                        spatialKernelOrder=2, spatialBackgroundOrder=2, doALZCcorrection=True,
-                       preConvKernel=None, sig1=None, sig2=None, im2Psf=None, verbose=False):
+                       preConvKernel=None, sig1=None, sig2=None, im2Psf=None, verbose=False,
+                       var1=None, var2=None):
     x = np.arange(-kernelSize+1, kernelSize, 1)
     y = x.copy()
     x0, y0 = np.meshgrid(x, y)
@@ -692,19 +794,27 @@ def performAlardLupton(im1, im2, sigGauss=None, degGauss=None, betaGauss=1, kern
     del spatialBasis
     diffim = im2 - fit
     psf = im2Psf
+    pck = None
     if doALZCcorrection:
         if sig1 is None:
             _, sig1, _, _ = computeClippedImageStats(im1)
         if sig2 is None:
             _, sig2, _, _ = computeClippedImageStats(im2)
 
-        pck = computeDecorrelationKernel(kfit, sig1**2, sig2**2, preConvKernel=preConvKernel)
-        pci = scipy.ndimage.filters.convolve(diffim, pck, mode='constant')
+        pck = cachedDecorrelationKernel(kfit, sig1**2, sig2**2, preConvKernel=preConvKernel)
         if im2Psf is not None:
-            psf = computeCorrectedDiffimPsf(kfit, im2Psf, svar=sig1**2, tvar=sig2**2)
-        diffim = pci
+            psf = cachedCorrectedDiffimPsf(kfit, im2Psf, svar=sig1**2, tvar=sig2**2)
+        diagnostics.record('performAlardLupton', kfit=kfit, decorrelationKernel=pck, psf=psf,
+                           uncorrectedDiffim=diffim)
+
+    if var1 is not None and var2 is not None:
+        diffim, var = applyALKernelsInFourierSpace(diffim, var1, var2, kfit, decorrKernel=pck,
+                                                   preConvKernel=preConvKernel)
+        return diffim, psf, kfit, var
 
-    return diffim, psf, kfit
+    if pck is not None:
+        diffim = scipy.ndimage.filters.convolve(diffim, pck, mode='constant')
+    return diffim, psf, kfit, None
 
 # Compute the ZOGY eqn. (13):
 # $$
@@ -730,12 +840,12 @@ def ZOGYUtils(im1, im2, im1_psf, im2_psf, sig1=None, sig2=None, F_r=1., F_n=1.,
     if padSize > 0:
         padSize0 = padSize #im1.shape[0]//2 - im1_psf.shape[0]//2 # Need to pad the PSF to remove windowing artifacts
         padSize1 = padSize #im1.shape[1]//2 - im1_psf.shape[1]//2 # The bigger the padSize the better, but slower.
+        # Zero-padding keeps the PSF sums. Don't rescale to the same mean: the D kernels don't
+        # care, but the S_corr kernels (and P_D) scale with the PSF normalization.
         psf1 = np.pad(im1_psf, ((padSize0, padSize0), (padSize1, padSize1)), mode='constant',
                       constant_values=0)
-        psf1 *= im1_psf.mean() / psf1.mean()
         psf2 = np.pad(im2_psf, ((padSize0, padSize0), (padSize1, padSize1)), mode='constant',
                       constant_values=0)
-        psf2 *= im2_psf.mean() / psf2.mean()
 
     P_r = psf1 #im1_psf
     P_n = psf2 #im2_psf
@@ -765,7 +875,110 @@ def performZOGY(im1, im2, im1_psf, im2_psf, sig1=None, sig2=None, F_r=1., F_n=1.
     return D
 
 
-global_dict = {}
+# Opt-in recorder for the intermediate arrays (PSFs, kernels and their transforms) of the diffim
+# routines, e.g. to look at them in a notebook:
+#     dit.diagnostics.enable()
+#     dit.performZOGYImageSpace(...)
+#     dit.diagnostics.last('performZOGYImageSpace')['K_n']
+# It is off by default so that nothing is kept alive between calls. When enabled it keeps only
+# the arrays of the last `maxCalls` calls; if `spillDir` is set the numpy arrays are written there
+# as .npy files and only their file names are kept (they are memory-mapped back by last()/get()).
+# Anything else (None, scalars) is kept as is.
+class DiagnosticsRecorder(object):
+    def __init__(self, enabled=False, maxCalls=10, spillDir=None):
+        self.enabled = enabled
+        self.spillDir = spillDir
+        self.calls = collections.deque(maxlen=maxCalls)
+        self.nRecorded = 0
+
+    def enable(self, maxCalls=None, spillDir=None):
+        if maxCalls is not None and maxCalls != self.calls.maxlen:
+            self.calls = collections.deque(self.calls, maxlen=maxCalls)
+        if spillDir is not None:
+            if not os.path.exists(spillDir):
+                os.makedirs(spillDir)
+            self.spillDir = spillDir
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        self.calls.clear()
+
+    def record(self, name, **arrays):
+        if not self.enabled:
+            return
+        self.nRecorded += 1
+        spilled = set()
+        if self.spillDir is not None:
+            for key, value in arrays.items():
+                if not isinstance(value, np.ndarray) or value.dtype.hasobject:
+                    continue
+                fname = os.path.join(self.spillDir, '%s_%06d_%s.npy' % (name, self.nRecorded, key))
+                np.save(fname, value)
+                arrays[key] = fname
+                spilled.add(key)
+        self.calls.append((name, arrays, spilled))
+
+    @staticmethod
+    def _load(arrays, spilled):
+        if not spilled:
+            return arrays
+        return {key: np.load(value, mmap_mode='r') if key in spilled else value
+                for key, value in arrays.items()}
+
+    def get(self, name=None):
+        return [self._load(arrays, spilled) for n, arrays, spilled in self.calls
+                if name is None or n == name]
+
+    def last(self, name=None):
+        for n, arrays, spilled in reversed(self.calls):
+            if name is None or n == name:
+                return self._load(arrays, spilled)
+        return None
+
+    def lastValue(self, key):
+        for n, arrays, spilled in reversed(self.calls):
+            if key in arrays:
+                return self._load(arrays, spilled)[key]
+        raise KeyError(key)
+
+
+diagnostics = DiagnosticsRecorder()
+
+
+# Deprecated: read-only view of the most recently recorded value of each intermediate array, for
+# the older notebooks that read e.g. dit.global_dict['K_r']. It is only filled when the recorder
+# is enabled; use dit.diagnostics.last(name) instead.
+class _GlobalDictAlias(collections.Mapping):
+    def __getitem__(self, key):
+        warnings.warn("diffimTests.global_dict is deprecated; call diffimTests.diagnostics.enable() "
+                      "and use diffimTests.diagnostics.last()", DeprecationWarning, stacklevel=2)
+        if not diagnostics.enabled:
+            raise KeyError("%s (diffimTests.diagnostics is not enabled)" % key)
+        return diagnostics.lastValue(key)
+
+    def __iter__(self):
+        keys = set()
+        for n, arrays, spilled in diagnostics.calls:
+            keys.update(arrays)
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+global_dict = _GlobalDictAlias()
+
+
+# Least-recently-used cache of decorrelation kernels and corrected PSFs (see caches.KernelCache).
+kernelCache = caches.KernelCache()
+
+
+# Pool of preallocated Exposures to use as convolution outputs (see caches.ExposurePool).
+exposurePool = caches.ExposurePool()
 
 # In all functions, im1 is R (reference, or template) and im2 is N (new, or science)
 def performZOGYImageSpace(im1, im2, im1_psf, im2_psf, sig1=None, sig2=None, F_r=1., F_n=1., padSize=15):
@@ -775,22 +988,15 @@ def performZOGYImageSpace(im1, im2, im1_psf, im2_psf, sig1=None, sig2=None, F_r=
     delta = 0 #.1
     K_r_hat = (P_r_hat + delta) / (denom + delta)
     K_n_hat = (P_n_hat + delta) / (denom + delta)
-    global_dict['K_r_hat'] = K_r_hat
-    global_dict['K_n_hat'] = K_n_hat
     K_r = np.fft.ifft2(K_r_hat).real
     K_n = np.fft.ifft2(K_n_hat).real
-    global_dict['psf1'] = im1_psf
-    global_dict['psf2'] = im2_psf
-    global_dict['padded_psf1'] = padded_psf1
-    global_dict['padded_psf2'] = padded_psf2
-    global_dict['P_r_hat'] = P_r_hat
-    global_dict['P_n_hat'] = P_n_hat
 
     if padSize > 0:
         K_n = K_n[padSize:-padSize, padSize:-padSize]
         K_r = K_r[padSize:-padSize, padSize:-padSize]
-    global_dict['K_r'] = K_r
-    global_dict['K_n'] = K_n
+    diagnostics.record('performZOGYImageSpace', K_r_hat=K_r_hat, K_n_hat=K_n_hat,
+                       psf1=im1_psf, psf2=im2_psf, padded_psf1=padded_psf1, padded_psf2=padded_psf2,
+                       P_r_hat=P_r_hat, P_n_hat=P_n_hat, K_r=K_r, K_n=K_n)
 
     # Note these are reverse-labelled, this is CORRECT!
     im1c = scipy.signal.convolve2d(im1, K_n, mode='same', boundary='fill', fillvalue=0.)
@@ -818,22 +1024,9 @@ def computeZOGYDiffimPsf(im1, im2, im1_psf, im2_psf, sig1=None, sig2=None, F_r=1
     return P_D, F_D
 
 
-# Compute the corrected ZOGY "S_corr" (eq. 25)
-# Currently only implemented is V(S_N) and V(S_R)
-# Want to implement astrometric variance Vast(S_N) and Vast(S_R)
-def performZOGY_Scorr(im1, im2, var_im1, var_im2, im1_psf, im2_psf,
-                      sig1=None, sig2=None, F_r=1., F_n=1., xVarAst=0., yVarAst=0., D=None, padSize=15):
-    if D is None:
-        D = performZOGYImageSpace(im1, im2, im1_psf, im2_psf, sig1, sig2, F_r, F_n, padSize=padSize)
-    P_D, F_D = computeZOGYDiffimPsf(im1, im2, im1_psf, im2_psf, sig1, sig2, F_r, F_n)
-    # P_r_hat = np.fft.fftshift(P_r_hat)  # Not sure why I need to do this but it seems that I do.
-    # P_n_hat = np.fft.fftshift(P_n_hat)
-
-    sigR, sigN, P_r_hat, P_n_hat, denom, _, _ = ZOGYUtils(im1, im2, im1_psf, im2_psf,
-                                                          sig1, sig2, F_r, F_n, padSize=padSize)
-
-    # Adjust the variance planes of the two images to contribute to the final detection
-    # (eq's 26-29).
+# The kernels k_r, k_n of eq's 26-29 which, squared, propagate the template and science
+# variance planes into the variance of S. P_r_hat, P_n_hat and denom are from ZOGYUtils().
+def computeZOGYScorrKernels(P_r_hat, P_n_hat, denom, F_r=1., F_n=1., padSize=0):
     k_r_hat = F_r * F_n**2 * np.conj(P_r_hat) * np.abs(P_n_hat)**2 / denom**2.
     k_n_hat = F_n * F_r**2 * np.conj(P_n_hat) * np.abs(P_r_hat)**2 / denom**2.
 
@@ -846,8 +1039,82 @@ def performZOGY_Scorr(im1, im2, var_im1, var_im2, im1_psf, im2_psf,
     if padSize > 0:
         k_n = k_n[padSize:-padSize, padSize:-padSize]
         k_r = k_r[padSize:-padSize, padSize:-padSize]
-    var1c = scipy.ndimage.filters.convolve(var_im1, k_r**2., mode='constant')
-    var2c = scipy.ndimage.filters.convolve(var_im2, k_n**2., mode='constant')
+    return k_r, k_n
+
+
+# Propagate the two variance planes through pairs of (same-sized) kernels: for each pair
+# (k1, k2) return var_im1 (x) k1**2 + var_im2 (x) k2**2 (either kernel may be None).
+# This is done in Fourier space: the transforms of the variance planes are computed once and
+# shared by all of the pairs, and each pair costs one inverse FFT. The planes are zero-padded so
+# that this is the same (linear) convolution as scipy.ndimage.filters.convolve(mode='constant').
+def convolveVariancePlanes(var_im1, var_im2, kernelPairs):
+    kShape = [k for pair in kernelPairs for k in pair if k is not None][0].shape
+    shape = [scipy.fftpack.next_fast_len(var_im1.shape[i] + kShape[i] - 1) for i in range(2)]
+    V1_hat = fft2(var_im1, shape=shape)
+    V2_hat = fft2(var_im2, shape=shape)
+    y0, x0 = kShape[0]//2, kShape[1]//2
+
+    out = []
+    for k1, k2 in kernelPairs:
+        v_hat = 0.
+        if k1 is not None:
+            v_hat = v_hat + V1_hat * fft2(k1**2., shape=shape)
+        if k2 is not None:
+            v_hat = v_hat + V2_hat * fft2(k2**2., shape=shape)
+        out.append(ifft2(v_hat).real[y0:(y0 + var_im1.shape[0]), x0:(x0 + var_im1.shape[1])])
+    return out
+
+
+# Variance planes of the ZOGY D (eq. 13) and of S (the var1c and var2c terms of eq's 26-29).
+# D = K_r (x) N - K_n (x) R, so var(D) = var_im2 (x) K_r**2 + var_im1 (x) K_n**2, with the same
+# (PSF-sized) kernels as performZOGYImageSpace(). All three planes share the transforms of the
+# variance planes (see convolveVariancePlanes()). If not computeScorr, only var(D) is computed
+# (var1c, var2c are returned as None).
+def computeZOGYVariance(var_im1, var_im2, im1_psf, im2_psf, sig1=None, sig2=None, F_r=1., F_n=1.,
+                        padSize=0, computeScorr=True):
+    if sig1 is None:
+        sig1 = np.sqrt(computeClippedImageStats(var_im1)[0])
+    if sig2 is None:
+        sig2 = np.sqrt(computeClippedImageStats(var_im2)[0])
+    sigR, sigN, P_r_hat, P_n_hat, denom, _, _ = ZOGYUtils(None, None, im1_psf, im2_psf,
+                                                          sig1, sig2, F_r, F_n, padSize=padSize)
+    K_r = np.fft.ifft2(F_r * P_r_hat / denom).real
+    K_n = np.fft.ifft2(F_n * P_n_hat / denom).real
+    if padSize > 0:
+        K_n = K_n[padSize:-padSize, padSize:-padSize]
+        K_r = K_r[padSize:-padSize, padSize:-padSize]
+    if not computeScorr:
+        var_D, = convolveVariancePlanes(var_im1, var_im2, [(K_n, K_r)])
+        return var_D, None, None
+    k_r, k_n = computeZOGYScorrKernels(P_r_hat, P_n_hat, denom, F_r, F_n, padSize=padSize)
+
+    var_D, var1c, var2c = convolveVariancePlanes(var_im1, var_im2, [(K_n, K_r), (k_r, None), (None, k_n)])
+    return var_D, var1c, var2c
+
+
+# Compute the corrected ZOGY "S_corr" (eq. 25)
+# Currently only implemented is V(S_N) and V(S_R)
+# Want to implement astrometric variance Vast(S_N) and Vast(S_R)
+# var1c, var2c may be passed in if they were already computed by computeZOGYVariance().
+def performZOGY_Scorr(im1, im2, var_im1, var_im2, im1_psf, im2_psf,
+                      sig1=None, sig2=None, F_r=1., F_n=1., xVarAst=0., yVarAst=0., D=None, padSize=15,
+                      var1c=None, var2c=None):
+    if D is None:
+        D = performZOGYImageSpace(im1, im2, im1_psf, im2_psf, sig1, sig2, F_r, F_n, padSize=padSize)
+    P_D, F_D = computeZOGYDiffimPsf(im1, im2, im1_psf, im2_psf, sig1, sig2, F_r, F_n)
+    # P_r_hat = np.fft.fftshift(P_r_hat)  # Not sure why I need to do this but it seems that I do.
+    # P_n_hat = np.fft.fftshift(P_n_hat)
+
+    # Adjust the variance planes of the two images to contribute to the final detection
+    # (eq's 26-29). The kernels are only needed if the planes were not passed in, or for the
+    # astrometric correction.
+    needKernels = var1c is None or var2c is None or xVarAst + yVarAst > 0
+    if needKernels:
+        sigR, sigN, P_r_hat, P_n_hat, denom, _, _ = ZOGYUtils(im1, im2, im1_psf, im2_psf,
+                                                              sig1, sig2, F_r, F_n, padSize=padSize)
+        k_r, k_n = computeZOGYScorrKernels(P_r_hat, P_n_hat, denom, F_r, F_n, padSize=padSize)
+    if var1c is None or var2c is None:
+        var1c, var2c = convolveVariancePlanes(var_im1, var_im2, [(k_r, None), (None, k_n)])
 
     fGradR = fGradN = 0.
     if xVarAst + yVarAst > 0:  # Do the astrometric variance correction
@@ -864,34 +1131,316 @@ def performZOGY_Scorr(im1, im2, var_im1, var_im2, im1_psf, im2_psf,
     return S_corr, S, D, P_D, F_D, var1c, var2c
 
 
-def computePixelCovariance(diffim, diffim2=None):
-    diffim = diffim/diffim.std()
-    shifted_imgs2 = None
-    shifted_imgs = [
-        diffim,
-        np.roll(diffim, 1, 0), np.roll(diffim, -1, 0), np.roll(diffim, 1, 1), np.roll(diffim, -1, 1),
-        np.roll(np.roll(diffim, 1, 0), 1, 1), np.roll(np.roll(diffim, 1, 0), -1, 1),
-        np.roll(np.roll(diffim, -1, 0), 1, 1), np.roll(np.roll(diffim, -1, 0), -1, 1),
-        np.roll(diffim, 2, 0), np.roll(diffim, -2, 0), np.roll(diffim, 2, 1), np.roll(diffim, -2, 1),
-        np.roll(diffim, 3, 0), np.roll(diffim, -3, 0), np.roll(diffim, 3, 1), np.roll(diffim, -3, 1),
-        np.roll(diffim, 4, 0), np.roll(diffim, -4, 0), np.roll(diffim, 4, 1), np.roll(diffim, -4, 1),
-        np.roll(diffim, 5, 0), np.roll(diffim, -5, 0), np.roll(diffim, 5, 1), np.roll(diffim, -5, 1),
-    ]
-    shifted_imgs = np.vstack([i.flatten() for i in shifted_imgs])
-    #out = np.corrcoef(shifted_imgs)
-    if diffim2 is not None:
-        shifted_imgs2 = [
-            diffim2,
-            np.roll(diffim2, 1, 0), np.roll(diffim2, -1, 0), np.roll(diffim2, 1, 1), np.roll(diffim2, -1, 1),
-            np.roll(np.roll(diffim2, 1, 0), 1, 1), np.roll(np.roll(diffim2, 1, 0), -1, 1),
-            np.roll(np.roll(diffim2, -1, 0), 1, 1), np.roll(np.roll(diffim2, -1, 0), -1, 1),
-            np.roll(diffim2, 2, 0), np.roll(diffim2, -2, 0), np.roll(diffim2, 2, 1), np.roll(diffim2, -2, 1),
-            np.roll(diffim2, 3, 0), np.roll(diffim2, -3, 0), np.roll(diffim2, 3, 1), np.roll(diffim2, -3, 1),
-            np.roll(diffim2, 4, 0), np.roll(diffim2, -4, 0), np.roll(diffim2, 4, 1), np.roll(diffim2, -4, 1),
-            np.roll(diffim2, 5, 0), np.roll(diffim2, -5, 0), np.roll(diffim2, 5, 1), np.roll(diffim2, -5, 1),
-        ]
-        shifted_imgs2 = np.vstack([i.flatten() for i in shifted_imgs2])
-    out = np.cov(shifted_imgs, shifted_imgs2, bias=1)
+# Pad (or trim) a PSF symmetrically so that it has the same shape as the image and its
+# center pixel (shape//2) lands on the image center. Needed for the Fourier-space ZOGY.
+# Works on the last two axes, so `psf` may also be a (N, ny, nx) stack of PSFs.
+def padPsfToImage(psf, imShape):
+    return kernelOps.padKernels(psf, imShape)
+
+
+# 2-d FFTs over the last two axes of a (possibly stacked) array. Use the multithreaded
+# scipy.fft (scipy >= 1.4) when `workers` is given and it is available.
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+
+def fft2Stack(x, workers=None):
+    if workers is not None and scipy_fft is not None:
+        return scipy_fft.fft2(x, axes=(-2, -1), workers=workers)
+    return fft2(x, axes=(-2, -1))
+
+
+def ifft2Stack(x, workers=None):
+    if workers is not None and scipy_fft is not None:
+        return scipy_fft.ifft2(x, axes=(-2, -1), workers=workers)
+    return ifft2(x, axes=(-2, -1))
+
+
+# sqrt of the average variance of an image, or of each image of a (N, ny, nx) stack (as a
+# (N, 1, 1) array so it broadcasts against the stack).
+def _zogySigma(im, sig=None):
+    if im.ndim == 2:
+        return computeClippedImageStats(im)[1] if sig is None else sig
+    if sig is None:
+        sig = [computeClippedImageStats(i)[1] for i in im]
+    return np.asarray(sig, dtype=float).reshape(-1, 1, 1)
+
+
+# Multi-epoch ZOGY: difference one template against many science epochs.
+# Everything that depends only on the template (R_hat, P_r_hat and the transform of the
+# template variance plane) is computed once and reused for each epoch, so each epoch only
+# pays for the transforms of its own image, PSF and variance plane. This is the same
+# computation as performZOGY() + computeZOGYDiffimPsf() + performZOGY_Scorr(), but done
+# entirely in Fourier space with image-sized PSFs (no padSize needed).
+# All arrays may also be (N, ny, nx) stacks (see performZOGYBatch()); the FFTs are then done
+# over the last two axes of the whole stack at once.
+class ZOGYTemplate(object):
+    def __init__(self, im1, im1_psf, var_im1=None, sig1=None, F_r=1., workers=None):
+        self.shape = im1.shape[-2:]
+        self.sigR = _zogySigma(im1, sig1)
+        self.F_r = F_r
+        self.workers = workers
+        self.R_hat = fft2Stack(im1, workers)
+        self.P_r_hat = fft2Stack(padPsfToImage(im1_psf, self.shape), workers)
+        self.P_r_hat_abs2 = np.abs(self.P_r_hat)**2.
+        self.V_r_hat = fft2Stack(var_im1, workers) if var_im1 is not None else None
+
+    def subtract(self, im2, im2_psf, var_im2=None, sig2=None, F_n=1., xVarAst=0., yVarAst=0.):
+        """! Compute the ZOGY diffim (and S_corr) of a science image against the cached template.
+        @param im2  Science image, same shape as the template
+        @param im2_psf  PSF of the science image (padded or trimmed to the image shape)
+        @param var_im2  Variance plane of the science image. S_corr is only computed if both this
+        and the template variance plane are available
+        @param sig2  sqrt of the (average) variance of the science image
+        @return S_corr, S, D, P_D, F_D, var1c, var2c as returned by performZOGY_Scorr(); the S terms
+        are None if no variance planes were given.
+        """
+        fft2_ = lambda x: fft2Stack(x, self.workers)
+        ifft2_ = lambda x: ifft2Stack(x, self.workers)
+        ifftshift_ = lambda x: ifftshift(x, axes=(-2, -1))
+        # Products with the conjugate of an (image-centered) PSF transform carry the opposite
+        # phase ramp, so are re-centered the other way; for odd-sized images the two differ by a pixel.
+        fftshift_ = lambda x: fftshift(x, axes=(-2, -1))
+
+        F_r, sigR, sigN = self.F_r, self.sigR, _zogySigma(im2, sig2)
+        P_r_hat = self.P_r_hat
+        P_n_hat = fft2_(padPsfToImage(im2_psf, self.shape))
+        P_n_hat_abs2 = np.abs(P_n_hat)**2.
+        denom2 = sigN**2 * F_r**2 * self.P_r_hat_abs2 + sigR**2 * F_n**2 * P_n_hat_abs2
+        denom = np.sqrt(denom2)
+
+        N_hat = fft2_(im2)
+        D_hat = (F_r * P_r_hat * N_hat - F_n * P_n_hat * self.R_hat) / denom
+        D = ifftshift_(ifft2_(D_hat).real)
+
+        F_D = F_r * F_n / np.sqrt(sigN**2 * F_r**2 + sigR**2 * F_n**2)
+        P_D_hat = F_r * F_n * P_r_hat * P_n_hat / (F_D * denom)
+        P_D = ifftshift_(ifft2_(P_D_hat).real)
+
+        S_corr = S = var1c = var2c = None
+        if var_im2 is not None and self.V_r_hat is not None:
+            # S = D convolved with the flipped P_D, i.e. multiplied by the conjugate of P_D_hat.
+            S = fftshift_(ifft2_(F_D * D_hat * np.conj(P_D_hat)).real)
+
+            # Variance of S (eq's 26-29): convolve each variance plane with its kernel squared.
+            k_r_hat = F_r * F_n**2 * np.conj(P_r_hat) * P_n_hat_abs2 / denom2
+            k_n_hat = F_n * F_r**2 * np.conj(P_n_hat) * self.P_r_hat_abs2 / denom2
+            k_r = ifft2_(k_r_hat).real
+            k_n = ifft2_(k_n_hat).real
+            var1c = fftshift_(ifft2_(self.V_r_hat * fft2_(k_r**2.)).real)
+            var2c = fftshift_(ifft2_(fft2_(var_im2) * fft2_(k_n**2.)).real)
+
+            fGradR = fGradN = 0.
+            if xVarAst + yVarAst > 0:  # Do the astrometric variance correction
+                S_R = fftshift_(ifft2_(self.R_hat * k_r_hat).real)
+                gradRx, gradRy = np.gradient(S_R, axis=(-2, -1))
+                fGradR = xVarAst * gradRx**2. + yVarAst * gradRy**2.
+                S_N = fftshift_(ifft2_(N_hat * k_n_hat).real)
+                gradNx, gradNy = np.gradient(S_N, axis=(-2, -1))
+                fGradN = xVarAst * gradNx**2. + yVarAst * gradNy**2.
+
+            S_corr = S / np.sqrt(var1c + var2c + fGradR + fGradN)
+
+        return S_corr, S, D, P_D, F_D, var1c, var2c
+
+
+# Stream ZOGY diffims of `template` (an Exposure) against each Exposure yielded by `sciences`.
+# This is a generator, so only one epoch's images are held at a time.
+def performZOGYTimeSeries(template, sciences, F_r=1., F_n=1., xVarAst=0., yVarAst=0.):
+    zt = ZOGYTemplate(template.im, template.psf, template.var, sig1=template.sig, F_r=F_r)
+    for science in sciences:
+        yield zt.subtract(science.im, science.psf, science.var, sig2=science.sig, F_n=F_n,
+                          xVarAst=xVarAst, yVarAst=yVarAst)
+
+
+# ZOGY on a stack of N same-sized image pairs at once (e.g. for parameter sweeps over many
+# small simulated images). im1s, im2s (and var_im1s, var_im2s) are (N, ny, nx) arrays; the PSFs
+# are (N, py, px) stacks or a single (py, px) PSF shared by all pairs; sig1s, sig2s are
+# length-N sequences (computed per image if None). The FFTs of each batch of `chunkSize` pairs
+# are done in one call over the last two axes (with `workers` threads if scipy.fft is
+# available). Returns the (N, ny, nx) stacks D, P_D and S_corr (None without variance planes).
+def performZOGYBatch(im1s, im2s, im1_psfs, im2_psfs, var_im1s=None, var_im2s=None, sig1s=None, sig2s=None,
+                     F_r=1., F_n=1., chunkSize=64, workers=None):
+    im1s, im2s = np.asarray(im1s), np.asarray(im2s)
+    D = np.empty(im1s.shape)
+    P_D = np.empty(im1s.shape)
+    S_corr = np.empty(im1s.shape) if var_im1s is not None and var_im2s is not None else None
+
+    def chunk(x, sl):
+        return x[sl] if x is not None and np.ndim(x) >= 1 and len(x) == len(im1s) else x
+
+    for i0 in range(0, len(im1s), chunkSize):
+        sl = slice(i0, i0 + chunkSize)
+        im1_psf = im1_psfs[sl] if np.ndim(im1_psfs) == 3 else im1_psfs
+        im2_psf = im2_psfs[sl] if np.ndim(im2_psfs) == 3 else im2_psfs
+        zt = ZOGYTemplate(im1s[sl], im1_psf, chunk(var_im1s, sl), sig1=chunk(sig1s, sl), F_r=F_r,
+                          workers=workers)
+        S_corr_c, _, D[sl], P_D[sl], _, _, _ = zt.subtract(im2s[sl], im2_psf, chunk(var_im2s, sl),
+                                                           sig2=chunk(sig2s, sl), F_n=F_n)
+        if S_corr is not None:
+            S_corr[sl] = S_corr_c
+    return D, P_D, S_corr
+
+
+# Fourier-space ZOGY done on overlapping tiles, so that only tile-sized transforms are held in
+# memory at once. The (global) noise sig1, sig2 is used for every tile. Each tile is extended by
+# `overlap` pixels on each side and only its central part is kept. The default overlap is the
+# smallest one whose truncated kernel error is within `maxKernelError` (see chooseZOGYTileOverlap()).
+def performZOGYTiled(im1, im2, im1_psf, im2_psf, sig1=None, sig2=None, F_r=1., F_n=1., tileSize=256,
+                     overlap=None, maxKernelError=1e-3):
+    if sig1 is None:
+        _, sig1, _, _ = computeClippedImageStats(im1)
+    if sig2 is None:
+        _, sig2, _, _ = computeClippedImageStats(im2)
+    if overlap is None:
+        overlap, _ = chooseZOGYTileOverlap(im1_psf, im2_psf, sig1, sig2, maxKernelError, F_r=F_r, F_n=F_n)
+
+    D = np.zeros(im1.shape)
+    for y0 in range(0, im1.shape[0], tileSize):
+        y1 = min(y0 + tileSize, im1.shape[0])
+        ya, yb = max(y0 - overlap, 0), min(y1 + overlap, im1.shape[0])
+        for x0 in range(0, im1.shape[1], tileSize):
+            x1 = min(x0 + tileSize, im1.shape[1])
+            xa, xb = max(x0 - overlap, 0), min(x1 + overlap, im1.shape[1])
+            tileShape = (yb - ya, xb - xa)
+            D_tile = performZOGY(im1[ya:yb, xa:xb], im2[ya:yb, xa:xb],
+                                 padPsfToImage(im1_psf, tileShape), padPsfToImage(im2_psf, tileShape),
+                                 sig1=sig1, sig2=sig2, F_r=F_r, F_n=F_n)
+            D[y0:y1, x0:x1] = D_tile[(y0 - ya):(y1 - ya), (x0 - xa):(x1 - xa)]
+    return D
+
+
+# Relative (L2) error of the image-space ZOGY kernel K_n (the one applied to the template; K_r
+# behaves the same way) computed with a given padSize and trimmed back to the PSF size, versus
+# the kernel computed with a large padding and no trimming.
+def estimateZOGYKernelError(im1_psf, im2_psf, sig1, sig2, padSize=0, F_r=1., F_n=1.):
+    def kernel(pad):
+        _, _, _, P_n_hat, denom, _, _ = ZOGYUtils(None, None, im1_psf, im2_psf, sig1, sig2,
+                                                  F_r, F_n, padSize=pad)
+        return np.fft.ifft2(P_n_hat / denom).real
+
+    refPad = max(im1_psf.shape)
+    K_ref = kernel(refPad)
+    K_ref_inner = K_ref[refPad:-refPad, refPad:-refPad]
+    K = kernel(padSize)
+    if padSize > 0:
+        K = K[padSize:-padSize, padSize:-padSize]
+    refNorm2 = np.sum(K_ref**2.)
+    err2 = np.sum((K - K_ref_inner)**2.) + (refNorm2 - np.sum(K_ref_inner**2.))
+    return np.sqrt(max(err2, 0.) / refNorm2)
+
+
+# Relative (L2) error of the tiled ZOGY (performZOGYTiled()) in the kept part of each tile: the
+# fraction of each ZOGY kernel (K_r and K_n, computed with a padding of twice the overlap) that
+# lies more than `overlap` pixels from its center, which the tile cuts off; the larger of the two.
+def estimateZOGYTileError(im1_psf, im2_psf, sig1, sig2, overlap, F_r=1., F_n=1.):
+    _, _, P_r_hat, P_n_hat, denom, _, _ = ZOGYUtils(None, None, im1_psf, im2_psf, sig1, sig2,
+                                                    F_r, F_n, padSize=2*overlap)
+    y, x = np.indices(denom.shape)
+    outside = np.maximum(np.abs(y - denom.shape[0]//2), np.abs(x - denom.shape[1]//2)) > overlap
+    err = 0.
+    for P_hat in (P_r_hat, P_n_hat):
+        K = np.fft.ifft2(P_hat / denom).real
+        err = max(err, np.sqrt(np.sum(K[outside]**2.) / np.sum(K**2.)))
+    return err
+
+
+# The smallest overlap for performZOGYTiled(), out of multiples of the PSF size, whose
+# estimateZOGYTileError() is within `maxKernelError`, or the largest of them if none is.
+# Returns the overlap and its error.
+def chooseZOGYTileOverlap(im1_psf, im2_psf, sig1, sig2, maxKernelError=1e-3, factors=(1, 2, 3, 4),
+                          F_r=1., F_n=1.):
+    psfSize = max(im1_psf.shape + im2_psf.shape)
+    for factor in factors:
+        overlap = factor * psfSize
+        err = estimateZOGYTileError(im1_psf, im2_psf, sig1, sig2, overlap, F_r, F_n)
+        if err <= maxKernelError:
+            break
+    return overlap, err
+
+
+# Estimate the cost (floating-point operations and peak memory, in bytes) of each way of doing
+# ZOGY and pick the cheapest one that is within `maxKernelError` (see estimateZOGYKernelError()
+# and estimateZOGYTileError(); the image-space and tiled paths truncate their kernels) and within
+# `memoryBudget`. Returns a dict with the chosen 'method' ('fourier', 'imageSpace' or 'tiled'), its
+# 'padSize', 'tileSize' and 'overlap', and the estimates for all candidates. The choice is logged
+# (at INFO level) to the 'diffimTests' lsst.log logger.
+#   fourier: 5 image-sized complex FFTs and ~8 complex image-sized arrays
+#   imageSpace: 4 FFTs of the padded PSF and two direct convolutions of the image with the
+#     kernels, which are trimmed back to the PSF size (scipy.signal.convolve2d)
+#   tiled: the fourier path on each (tileSize + 2*overlap)**2 tile plus the output image, with
+#     the overlap of chooseZOGYTileOverlap()
+def chooseZOGYMethod(imShape, im1_psf, im2_psf, sig1, sig2, padSizes=(0, 5, 10, 15, 25), tileSize=256,
+                     maxKernelError=1e-3, memoryBudget=2.*1024**3):
+    def fftFlops(n):
+        return 5. * n * np.log2(n)
+
+    nPix = float(np.prod(imShape))
+    kernelPix = float(np.prod(im1_psf.shape))  # performZOGYImageSpace() trims K_r, K_n to this size
+    candidates = [{'method': 'fourier', 'padSize': 0, 'tileSize': None, 'overlap': None, 'error': 0.,
+                   'flops': 5. * fftFlops(nPix) + 20. * nPix, 'memory': 8. * 16. * nPix}]
+
+    for padSize in padSizes:
+        paddedPix = float((im1_psf.shape[0] + 2*padSize) * (im1_psf.shape[1] + 2*padSize))
+        candidates.append({'method': 'imageSpace', 'padSize': padSize, 'tileSize': None, 'overlap': None,
+                           'error': estimateZOGYKernelError(im1_psf, im2_psf, sig1, sig2, padSize),
+                           'flops': 4. * fftFlops(paddedPix) + 2. * 2. * nPix * kernelPix,
+                           'memory': 5. * 8. * nPix + 8. * 16. * paddedPix})
+
+    overlap, tileError = chooseZOGYTileOverlap(im1_psf, im2_psf, sig1, sig2, maxKernelError)
+    nTiles = np.ceil(imShape[0] / float(tileSize)) * np.ceil(imShape[1] / float(tileSize))
+    tilePix = float(min(tileSize + 2*overlap, imShape[0]) * min(tileSize + 2*overlap, imShape[1]))
+    candidates.append({'method': 'tiled', 'padSize': 0, 'tileSize': tileSize, 'overlap': overlap,
+                       'error': tileError,
+                       'flops': nTiles * (5. * fftFlops(tilePix) + 20. * tilePix),
+                       'memory': 3. * 8. * nPix + 8. * 16. * tilePix})
+
+    ok = [c for c in candidates if c['error'] <= maxKernelError and c['memory'] <= memoryBudget]
+    if len(ok) == 0:  # nothing fits; fall back to the smallest memory footprint
+        ok = [min(candidates, key=lambda c: c['memory'])]
+    choice = dict(min(ok, key=lambda c: c['flops']))
+    choice['candidates'] = candidates
+    if log is not None:
+        log.info('ZOGY: using %s (padSize=%d, tileSize=%s, overlap=%s): %.2f GFLOP, %.1f MB, '
+                 'kernel error %.2g' % (choice['method'], choice['padSize'], choice['tileSize'],
+                                        choice['overlap'], choice['flops'] / 1e9, choice['memory'] / 1024.**2,
+                                        choice['error']))
+    return choice
+
+
+# Offsets of the shifted images whose covariance matrix computePixelCovariance() returns.
+pixelCovarianceShifts = [(0, 0), (1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)] + \
+    [s for lag in range(2, 6) for s in [(lag, 0), (-lag, 0), (0, lag), (0, -lag)]]
+
+
+# Covariance matrix of `diffim` shifted (with np.roll) by each of `pixelCovarianceShifts`, (and those
+# of diffim2 if given) as np.cov(shifted images, bias=1) would compute it, and the sum of its
+# off-diagonal elements over the sum of its diagonal. The matrix is filled from the pixel
+# auto-covariance at all lags, computed via FFT (imageStats.pixelCovariance), rather than from the
+# 25 (or 50) full-image copies. If `mask` (True for pixels to exclude) or `tileSize` is given, the
+# lags do not wrap around and the covariance is accumulated over the unmasked pixel pairs in each tile.
+# Use imageStats.pixelCovariance directly for the covariance at arbitrary lags.
+def computePixelCovariance(diffim, diffim2=None, mask=None, tileSize=None):
+    diffim = diffim/(diffim.std() if mask is None else diffim[~mask].std())
+    shifts = np.array(pixelCovarianceShifts)
+    maxLag = 2 * np.abs(shifts).max()
+    circular = mask is None and tileSize is None
+    images = [diffim] if diffim2 is None else [diffim, diffim2]
+    blocks = [[None] * len(images) for i in images]
+    for i, im1 in enumerate(images):
+        for j, im2 in enumerate(images):
+            if j < i:
+                continue
+            cov = imageStats.pixelCovariance(im1, im2 if j != i else None, maxLag=maxLag, mask=mask,
+                                             tileSize=tileSize, circular=circular)
+            # cov(roll(x, s_k), roll(y, s_l)) is the covariance of x and y at lag s_k - s_l
+            lags = shifts[:, None, :] - shifts[None, :, :] + maxLag
+            blocks[i][j] = cov[lags[..., 0], lags[..., 1]]
+            if j != i:
+                blocks[j][i] = blocks[i][j].T
+    out = np.vstack([np.hstack(row) for row in blocks])
     tmp2 = out.copy()
     np.fill_diagonal(tmp2, np.NaN)
     stat = np.nansum(tmp2)/np.sum(np.diag(out))  # print sum of off-diag / sum of diag
@@ -916,17 +1465,17 @@ def performALZCExposureCorrection(templateExposure, exposure, subtractedExposure
     sig2 = exposure.getMaskedImage().getVariance().getArray()
     sig1squared, _, _, _ = computeClippedImageStats(sig1)
     sig2squared, _, _, _ = computeClippedImageStats(sig2)
-    corrKernel = computeDecorrelationKernel(kimg, sig1squared, sig2squared)
-    # Eventually, use afwMath.convolve(), but for now just use scipy.
+    corrKernel = cachedDecorrelationKernel(kimg, sig1squared, sig2squared)
     log.info("ALZC: Convolving.")
-    pci, _ = doConvolve(subtractedExposure.getMaskedImage().getImage().getArray(),
-                        corrKernel)
-    subtractedExposure.getMaskedImage().getImage().getArray()[:, :] = pci
+    pci, _ = doConvolve(subtractedExposure, corrKernel, pool=exposurePool)
+    subtractedExposure.getMaskedImage().getImage().getArray()[:, :] = \
+        pci.getMaskedImage().getImage().getArray()
+    exposurePool.release(pci)
     log.info("ALZC: Finished with convolution.")
 
     # Compute the subtracted exposure's updated psf
     psf = afwPsfToArray(subtractedExposure.getPsf(), subtractedExposure)  # .computeImage().getArray()
-    psfc = computeCorrectedDiffimPsf(corrKernel, psf, svar=sig1squared, tvar=sig2squared)
+    psfc = cachedCorrectedDiffimPsf(corrKernel, psf, svar=sig1squared, tvar=sig2squared)
     psfcI = afwImage.ImageD(subtractedExposure.getPsf().computeImage().getBBox())
     psfcI.getArray()[:, :] = psfc
     psfcK = afwMath.FixedKernel(psfcI)
@@ -959,11 +1508,13 @@ def computeClippedAfwStats(im, numSigmaClip=3., numIter=3, maskIm=None):
     return mean, std, var
 
 
-def doConvolve(exposure, kernel, use_scipy=False):
+def doConvolve(exposure, kernel, use_scipy=False, pool=None):
     """! Convolve an Exposure with a decorrelation convolution kernel.
     @param exposure Input afw.image.Exposure to be convolved.
     @param kernel Input 2-d numpy.array to convolve the image with
     @param use_scipy Use scipy to do convolution instead of afwMath
+    @param pool An optional ExposurePool from which to take the output Exposure
+    (ignored if use_scipy is True)
     @return a new Exposure with the convolved pixels and the (possibly
     re-centered) kernel.
 
@@ -981,12 +1532,140 @@ def doConvolve(exposure, kernel, use_scipy=False):
 
     else:
         kern = arrayToAfwKernel(fkernel)
-        outExp = exposure.clone()  # Do this to keep WCS, PSF, masks, etc.
+        if pool is not None:
+            outExp = pool.acquire(exposure)  # All pixel planes are written by convolve()
+        else:
+            outExp = exposure.clone()  # Do this to keep WCS, PSF, masks, etc.
         convCntrl = afwMath.ConvolutionControl(False, True, 0)
         afwMath.convolve(outExp.getMaskedImage(), exposure.getMaskedImage(), kern, convCntrl)
 
     return outExp, kern
 
+
+# The mask plane of an image convolved with a kernel of `kernelShape`, as afwMath.convolve() makes
+# it: each mask bit set on a pixel is spread over the kernel footprint about it, and the border
+# that the kernel footprint overhangs is marked EDGE.
+def growMaskBits(mask, kernelShape, edgeBit=0):
+    out = np.zeros_like(mask)
+    structure = np.ones(kernelShape, dtype=bool)
+    bits = int(np.bitwise_or.reduce(mask, axis=None)) if mask.size else 0
+    bit = 1
+    while bit <= bits:
+        if bits & bit:
+            out[scipy.ndimage.binary_dilation((mask & bit) != 0, structure=structure)] |= bit
+        bit <<= 1
+    if edgeBit:
+        hy, hx = kernelShape[0]//2, kernelShape[1]//2
+        out[:hy, :] |= edgeBit
+        out[out.shape[0] - hy:, :] |= edgeBit
+        out[:, :hx] |= edgeBit
+        out[:, out.shape[1] - hx:] |= edgeBit
+    return out
+
+
+def subtractAndDecorrelateInFourierSpace(templateExposure, scienceExposure, kappa, svar=0.04, tvar=0.04,
+                                        preConvKernel=None, delta=0., psf=None, backgroundModel=None,
+                                        keepUndecorrelated=False, pool=None):
+    """! Convolve the template by the matching kernel, subtract it from the science image and
+    decorrelate the difference, all in one Fourier-domain pass.
+    D = F^-1[(S_hat - kappa_hat * T_hat) * filter], with the filter and kappa_hat at the padded image
+    size from the cached (kernel-sized) filter of cachedDecorrelationFilter().
+    The variance plane is var_D = var_S + var_T (x) kappa**2, convolved with the square of the
+    decorrelation kernel.
+    @param templateExposure Input afw.image.Exposure of the template (im1)
+    @param scienceExposure Input afw.image.Exposure of the science image (im2)
+    @param kappa  A (constant) matching kernel 2-d numpy.array derived from Alard & Lupton PSF matching
+    @param svar   Average variance of science image used for PSF matching
+    @param tvar   Average variance of template image used for PSF matching
+    @param preConvKernel   A pre-convolution kernel applied to im2 prior to A&L PSF matching
+    @param psf    The PSF 2-d numpy.array of im2, only used as part of the key of the cached filter
+    (so that the corrected PSF can later be had from it)
+    @param backgroundModel An optional afw.math.Function2D differential background, fitted with
+    the kernel, that is subtracted from the science image (as in ImagePsfMatchTask.subtractExposures())
+    @param keepUndecorrelated Also return the un-decorrelated diffim (one extra inverse FFT)
+    @param pool   An optional ExposurePool from which to take the output Exposures
+    @return the decorrelated diffim Exposure, the decorrelation kernel (centered, trimmed to the
+    kappa size) as a 2-d numpy.array, and the un-decorrelated diffim Exposure (or None)
+
+    @note Unlike ImagePsfMatchTask.subtractExposures() a single, constant kappa is used across
+    the image, as is done for the decorrelation.
+    @note The mask plane is that of the science image OR-ed with the template's grown by the kernel
+    footprint (see growMaskBits()); non-finite pixels in the science image, and pixels within the
+    kernel footprint of non-finite template pixels, are NaN in the output.
+    """
+    tmi, smi = templateExposure.getMaskedImage(), scienceExposure.getMaskedImage()
+    imShape = smi.getImage().getArray().shape
+    kernelFilt = cachedDecorrelationFilter(kappa, svar, tvar, preConvKernel=preConvKernel, psf=psf,
+                                           delta=delta)
+    filt = kernelFilt.atImageShape(imShape)
+    shape = filt.shape
+
+    def transform(arr):
+        good = np.isfinite(arr)
+        return scipy.fftpack.fft2(np.where(good, arr, 0.), shape=shape), good
+
+    def inverse(arr_hat):
+        return scipy.fftpack.ifft2(arr_hat).real[:imShape[0], :imShape[1]]
+
+    sci = smi.getImage().getArray()
+    if backgroundModel is not None:
+        background = afwImage.ImageD(smi.getBBox())
+        background += backgroundModel
+        sci = sci - background.getArray()
+    S_hat, goodS = transform(sci)
+    T_hat, goodT = transform(tmi.getImage().getArray())
+    D_hat = S_hat - filt.kappaFT * T_hat
+    del S_hat, T_hat
+    bad = ~goodS | scipy.ndimage.binary_dilation(~goodT, structure=np.ones(kappa.shape, dtype=bool))
+
+    VS_hat, _ = transform(smi.getVariance().getArray())
+    VT_hat, _ = transform(tmi.getVariance().getArray())
+    V_hat = VS_hat + kernelOps.kernelFT(kappa**2, shape) * VT_hat
+    del VS_hat, VT_hat
+
+    tmsk = tmi.getMask()
+    mask = smi.getMask().getArray() | growMaskBits(tmsk.getArray(), kappa.shape, tmsk.getPlaneBitMask('EDGE'))
+
+    outputs = []
+    for doDecorr in ([True, False] if keepUndecorrelated else [True]):
+        if pool is not None:
+            outExp = pool.acquire(scienceExposure)
+        else:
+            outExp = scienceExposure.clone()  # Do this to keep WCS, PSF, etc.
+        omi = outExp.getMaskedImage()
+        img = inverse(D_hat * filt.filter if doDecorr else D_hat)
+        var = inverse(V_hat * filt.varianceFilter if doDecorr else V_hat)
+        img[bad] = var[bad] = np.nan
+        omi.getImage().getArray()[:, :] = img
+        omi.getVariance().getArray()[:, :] = var
+        omi.getMask().getArray()[:, :] = mask
+        outputs.append(outExp)
+
+    return outputs[0], kernelFilt.kernel(), (outputs[1] if keepUndecorrelated else None)
+
+
+def fitALKernelInStack(task, templateExposure, scienceExposure):
+    """! Fit the A&L PSF-matching kernel with an ImagePsfMatchTask, without convolving the template.
+    This does what ImagePsfMatchTask.matchExposures() (without warping) does up to the kernel
+    solution: it builds the task's kernel cell set from the selected sources and solves it, but
+    skips the real-space convolution of the whole template by the kernel.
+    @param task An ip_diffim ImagePsfMatchTask
+    @return the (spatially-varying) psfMatchingKernel and the backgroundModel
+    """
+    import lsst.ip.diffim.diffimTools as diffimTools
+
+    templateFwhmPix = task.getFwhmPix(templateExposure.getPsf())
+    scienceFwhmPix = task.getFwhmPix(scienceExposure.getPsf())
+    selectSources = task.getSelectSources(scienceExposure)
+    candidateList = diffimTools.sourceToFootprintList(selectSources, templateExposure, scienceExposure,
+                                                      task.kConfig.detectionConfig, task.log)
+    kernelCellSet = task._buildCellSet(templateExposure.getMaskedImage(), scienceExposure.getMaskedImage(),
+                                       candidateList)
+    basisList = ipDiffim.makeKernelBasisList(task.kConfig, templateFwhmPix, scienceFwhmPix)
+    spatialSolution, psfMatchingKernel, backgroundModel = task._solve(kernelCellSet, basisList)
+    return psfMatchingKernel, backgroundModel
+
+
 def arrayToAfwKernel(array):
     kernelImg = afwImage.ImageD(array.shape[0], array.shape[1])
     kernelImg.getArray()[:, :] = array
@@ -1140,6 +1819,8 @@ def computeDecorrelationKernel(kappa, svar=0.04, tvar=0.04, preConvKernel=None,
     #if np.argmax(pck.real) == 0:  # I can't figure out why we need to ifftshift sometimes but not others.
     #    pck = scipy.fftpack.ifftshift(pck.real)
     fkernel = fixEvenKernel(pck.real)
+    diagnostics.record('computeDecorrelationKernel', kappa=kappa, preConvKernel=pc, filter_hat=kft,
+                       kernel=fkernel)
 
     # I think we may need to "reverse" the PSF, as in the ZOGY (and Kaiser) papers...
     # This is the same as taking the complex conjugate in Fourier space before FFT-ing back to real space.
@@ -1150,7 +1831,7 @@ def computeDecorrelationKernel(kappa, svar=0.04, tvar=0.04, preConvKernel=None,
 
 def computeCorrectedDiffimPsf(kappa, psf, svar=0.04, tvar=0.04):
     """! Compute the (decorrelated) difference image's new PSF.
-    new_psf = psf(k) * sqrt((svar + tvar) / (svar + tvar * kappa_ft(k)**2))
+    new_psf = psf(k) * sqrt((svar + tvar) / (svar + tvar * |kappa_ft(k)|**2))
 
     @param kappa  A matching kernel array derived from Alard & Lupton PSF matching
     @param psf    The uncorrected psf array of the science image (and also of the diffim)
@@ -1158,31 +1839,30 @@ def computeCorrectedDiffimPsf(kappa, psf, svar=0.04, tvar=0.04):
     @param tvar   Average variance of template image used for PSF matching
     @return a 2-d numpy.array containing the new PSF
     """
-    def post_conv_psf_ft2(psf, kernel, svar, tvar):
-        # Pad psf or kernel symmetrically to make them the same size!
-        # Note this assumes they are both square (width == height)
-        if psf.shape[0] < kernel.shape[0]:
-            diff = (kernel.shape[0] - psf.shape[0]) // 2
-            psf = np.pad(psf, (diff, diff), mode='constant')
-        elif psf.shape[0] > kernel.shape[0]:
-            diff = (psf.shape[0] - kernel.shape[0]) // 2
-            kernel = np.pad(kernel, (diff, diff), mode='constant')
-
-        psf = fixOddKernel(psf)
-        psf_ft = scipy.fftpack.fft2(psf)
-        kernel = fixOddKernel(kernel)
-        kft = scipy.fftpack.fft2(kernel)
-        out = psf_ft * np.sqrt((svar + tvar) / (svar + tvar * kft**2))
-        return out
+    return kernelOps.computeCorrectedDiffimPsfs(kappa, psf, svar=svar, tvar=tvar, fixOdd=True)
+
+# Memoized versions of the above, using the module-level `kernelCache`.
+def cachedDecorrelationKernel(kappa, svar=0.04, tvar=0.04, preConvKernel=None, delta=0.):
+    arrays = [kappa] if preConvKernel is None else [kappa, preConvKernel]
+    return kernelCache.get('computeDecorrelationKernel', arrays, [svar, tvar, delta],
+                           lambda: computeDecorrelationKernel(kappa, svar, tvar, preConvKernel, delta))
 
-    def post_conv_psf(psf, kernel, svar, tvar):
-        kft = post_conv_psf_ft2(psf, kernel, svar, tvar)
-        out = scipy.fftpack.ifft2(kft)
-        return out
 
-    pcf = post_conv_psf(psf=psf, kernel=kappa, svar=svar, tvar=tvar)
-    pcf = pcf.real / pcf.real.sum()
-    return pcf
+def cachedCorrectedDiffimPsf(kappa, psf, svar=0.04, tvar=0.04):
+    return kernelCache.get('computeCorrectedDiffimPsf', [kappa, psf], [svar, tvar],
+                           lambda: computeCorrectedDiffimPsf(kappa, psf, svar, tvar))
+
+
+# A kernelOps.DecorrelationFilter (kappa, pre-convolution kernel and PSF FFTs at a common size, from
+# which the decorrelation kernel, corrected PSF and variance filter are derived), from `kernelCache`.
+# Only the kernel-sized filter is cached: the filter at the padded size of an image (to filter the
+# image planes with kernelOps.filterArray()) is built per call with its atImageShape(), as its FFTs
+# are as large as the image.
+def cachedDecorrelationFilter(kappa, svar=0.04, tvar=0.04, preConvKernel=None, psf=None, delta=0.):
+    arrays = [kappa] + [k if k is not None else np.zeros(0) for k in (preConvKernel, psf)]
+    return kernelCache.get('DecorrelationFilter', arrays, [svar, tvar, delta],
+                           lambda: kernelOps.DecorrelationFilter(kappa, svar, tvar, preConvKernel=preConvKernel,
+                                                                 psf=psf, delta=delta))
 
 def fixOddKernel(kernel):
     """! Take a kernel with odd dimensions and make them even for FFT
@@ -1192,80 +1872,185 @@ def fixOddKernel(kernel):
     otherwise just return the input kernel.
     """
     # Note this works best for the FFT if we left-pad
-    out = kernel
-    changed = False
-    if (out.shape[0] % 2) == 1:
-        out = np.pad(out, ((1, 0), (0, 0)), mode='constant')
-        changed = True
-    if (out.shape[1] % 2) == 1:
-        out = np.pad(out, ((0, 0), (1, 0)), mode='constant')
-        changed = True
-    if changed:
-        out *= (np.mean(kernel) / np.mean(out))  # need to re-scale to same mean for FFT
-    return out
+    return kernelOps.fixOddKernels(kernel)
 
 def fixEvenKernel(kernel):
     """! Take a kernel with even dimensions and make them odd, centered correctly.
     @param kernel a numpy.array
     @return a fixed kernel numpy.array
     """
-    # Make sure the peak (close to a delta-function) is in the center!
-    maxloc = np.unravel_index(np.argmax(kernel), kernel.shape)
-    out = np.roll(kernel, kernel.shape[0]//2 - maxloc[0], axis=0)
-    out = np.roll(out, out.shape[1]//2 - maxloc[1], axis=1)
-    # Make sure it is odd-dimensioned by trimming it.
-    if (out.shape[0] % 2) == 0:
-        maxloc = np.unravel_index(np.argmax(out), out.shape)
-        if out.shape[0] - maxloc[0] > maxloc[0]:
-            out = out[:-1, :]
-        else:
-            out = out[1:, :]
-        if out.shape[1] - maxloc[1] > maxloc[1]:
-            out = out[:, :-1]
-        else:
-            out = out[:, 1:]
-    return out
+    # Make sure the peak (close to a delta-function) is in the center, and it is odd-dimensioned.
+    return kernelOps.fixEvenKernels(kernel)
 
 
+# A numpy image with its psf and variance plane. The image and variance planes are kept as given
+# (views, not copies). Statistics (`sig`, and `getStats()`) and the afw exposure from
+# `asAfwExposure()` are computed on first use and cached. A version stamp is bumped (and the caches
+# invalidated) when `im`, `var` or `psf` is replaced, or after pixels are modified in place within
+# `with exposure.mutate():` (or by calling `markModified()`).
 class Exposure(object):
+    __slots__ = ('_im', '_var', '_psf', 'metaData', '_stats', '_version', '_afwExposure')
+
     def __init__(self, im, psf=None, var=None, metaData=None):
+        self._stats = {}
+        self._version = 0
+        self._afwExposure = None
         self.im = im
         self.psf = psf
         self.var = var
         self.metaData = {} if metaData is None else metaData
-        if var is not None:
-            self.sig, _, _, _ = np.sqrt(computeClippedImageStats(var))
-        else:
-            _, self.sig, _, _ = computeClippedImageStats(im)
+
+    @property
+    def im(self):
+        return self._im
+
+    @im.setter
+    def im(self, im):
+        self._im = None if im is None else np.asarray(im)
+        self.markModified()
+
+    @property
+    def var(self):
+        return self._var
+
+    @var.setter
+    def var(self, var):
+        self._var = None if var is None else np.asarray(var)
+        self.markModified()
+
+    @property
+    def psf(self):
+        return self._psf
+
+    @psf.setter
+    def psf(self, psf):
+        self._psf = psf
+        self._version += 1
+        self._afwExposure = None
+
+    @property
+    def version(self):
+        return self._version
+
+    def invalidateStats(self):
+        self._stats.clear()
+
+    def markModified(self):
+        self._version += 1
+        self._afwExposure = None
+        self.invalidateStats()
+
+    @contextlib.contextmanager
+    def mutate(self):
+        try:
+            yield self
+        finally:
+            self.markModified()
+
+    # Clipped (mean, std, min, max) of the 'im' or 'var' plane; see computeClippedImageStats()
+    def getStats(self, plane='im'):
+        if plane not in self._stats:
+            self._stats[plane] = computeClippedImageStats(getattr(self, plane))
+        return self._stats[plane]
+
+    # The noise sigma: sqrt of the clipped mean variance, or if there is no variance plane, the
+    # clipped std. dev. of the image. May be set explicitly (until the pixels change).
+    @property
+    def sig(self):
+        if 'sig' not in self._stats:
+            self._stats['sig'] = np.sqrt(self.getStats('var')[0]) if self.var is not None \
+                else self.getStats('im')[1]
+        return self._stats['sig']
+
+    @sig.setter
+    def sig(self, sig):
+        self._stats['sig'] = sig
+
+    def __getstate__(self):
+        return dict(im=self.im, psf=self.psf, var=self.var, metaData=self.metaData, _stats=self._stats)
+
+    def __setstate__(self, state):
+        # Also accepts the __dict__ of Exposures pickled before __slots__ was used.
+        self._stats = dict(state.get('_stats', {}))
+        self._version, self._afwExposure = 0, None
+        self._im, self._var = state.get('im'), state.get('var')
+        self._psf, self.metaData = state.get('psf'), state.get('metaData', {})
+        if 'sig' in state:
+            self._stats['sig'] = state['sig']
 
     def setMetaData(self, key, value):
         self.metaData[key] = value
 
-    def asAfwExposure(self):
-        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(self.im.shape[0]-1, self.im.shape[1]-1))
-        im1ex = afwImage.ExposureF(bbox)
-        im1ex.getMaskedImage().getImage().getArray()[:, :] = self.im
-        im1ex.getMaskedImage().getVariance().getArray()[:, :] = self.var
-        psfShape = self.psf.shape[0]//2
-        psfBox = afwGeom.Box2I(afwGeom.Point2I(-psfShape, -psfShape), afwGeom.Point2I(psfShape, psfShape))
-        psf = afwImage.ImageD(psfBox)
-        psf.getArray()[:, :] = self.psf
-        psfK = afwMath.FixedKernel(psf)
-        psfNew = measAlg.KernelPsf(psfK)
-        im1ex.setPsf(psfNew)
-        wcs = makeWcs()
-        im1ex.setWcs(wcs)
-        return im1ex
-
-    def doDetection(self, threshold=5.0, doSmooth=True):
-        return doDetection(self.asAfwExposure(), threshold=threshold, doSmooth=doSmooth)
+    # The afw.image.ExposureF of this exposure, with a KernelPsf of `psf` and the shared default WCS.
+    # It is built on first use and cached until the exposure is modified (see `markModified()`).
+    # Each caller gets its own clone of the cached ExposureF, as detection and PSF matching set mask
+    # bits (and callers may set the PSF) in their inputs. With shared=True the cached ExposureF
+    # itself is returned (no copy); it is shared with every later caller, so it must not be modified.
+    # With zeroCopy=True (only with shared=True), its image and variance planes share the numpy
+    # buffers where possible (C-contiguous float32 planes), and are copied otherwise. They then
+    # alias `im` and `var`: in-place changes on either side are seen by the other, but only those
+    # made within `with exposure.mutate():` update the version stamp and the cached statistics.
+    def asAfwExposure(self, shared=False, zeroCopy=False):
+        if zeroCopy and not shared:
+            raise ValueError('zeroCopy requires shared=True (a clone would copy the planes)')
+        cached = self._afwExposure
+        if cached is None or cached[:2] != (self._version, zeroCopy):
+            im1ex = _wrapArraysAsAfwExposure(self.im, self.var) if zeroCopy else None
+            if im1ex is None:
+                bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0),
+                                     afwGeom.Point2I(self.im.shape[0]-1, self.im.shape[1]-1))
+                im1ex = afwImage.ExposureF(bbox)
+                im1ex.getMaskedImage().getImage().getArray()[:, :] = self.im
+                im1ex.getMaskedImage().getVariance().getArray()[:, :] = self.var
+            psfShape = self.psf.shape[0]//2
+            psfBox = afwGeom.Box2I(afwGeom.Point2I(-psfShape, -psfShape),
+                                   afwGeom.Point2I(psfShape, psfShape))
+            psf = afwImage.ImageD(psfBox)
+            psf.getArray()[:, :] = self.psf
+            psfK = afwMath.FixedKernel(psf)
+            im1ex.setPsf(measAlg.KernelPsf(psfK))
+            im1ex.setWcs(getDefaultWcs())
+            cached = self._afwExposure = (self._version, zeroCopy, im1ex)
+        return cached[2] if shared else cached[2].clone()
+
+    def doDetection(self, threshold=5.0, doSmooth=True, columns=None):
+        return doDetection(self.asAfwExposure(), threshold=threshold, doSmooth=doSmooth,
+                           columns=columns)
 
     def doMeasurePsf(self):
-        res = measurePsf(self.asAfwExposure())
-        self.psf = afwPsfToArray(res.psf, self.asAfwExposure())  # .computeImage()
+        exp = self.asAfwExposure(shared=True)  # measurePsf() works on a clone
+        res = measurePsf(exp)
+        self.psf = afwPsfToArray(res.psf, exp)  # .computeImage()
         return res
 
 
+# Wrap the (C-contiguous, float32) numpy image and variance planes in an afw ExposureF that shares
+# their memory. Returns None if the arrays or the afw version do not allow it.
+def _wrapArraysAsAfwExposure(im, var):
+    if any(a is None or a.dtype != np.float32 or not a.flags.c_contiguous for a in (im, var)):
+        return None
+    try:
+        image = afwImage.ImageF(im, False)  # deep=False
+        variance = afwImage.ImageF(var, False)
+    except Exception:
+        return None
+    if not np.may_share_memory(image.getArray(), im):
+        return None
+    mask = afwImage.MaskU(image.getBBox())
+    return afwImage.makeExposure(afwImage.MaskedImageF(image, mask, variance))
+
+
+_defaultWcs = None
+
+
+# The makeWcs() WCS, built (via a PropertySet) only once and shared by all Exposure.asAfwExposure()'s.
+def getDefaultWcs():
+    global _defaultWcs
+    if _defaultWcs is None:
+        _defaultWcs = makeWcs()
+    return _defaultWcs
+
+
 def makeWcs(offset=0):  # Taken from IP_DIFFIM/tests/testImagePsfMatch.py
     import lsst.daf.base as dafBase
     metadata = dafBase.PropertySet()
@@ -1289,13 +2074,31 @@ def makeWcs(offset=0):  # Taken from IP_DIFFIM/tests/testImagePsfMatch.py
     return afwImage.makeWcs(metadata)
 
 
-def doDetection(exp, threshold=5.0, thresholdType='stdev', thresholdPolarity='both', doSmooth=True,
-                asDF=True):
+# The measurement plugins run by doDetection() (the minimum set required).
+defaultMeasurementPlugins = ("base_CircularApertureFlux",
+                             "base_PixelFlags",
+                             "base_SkyCoord",
+                             "base_PsfFlux",
+                             "base_GaussianCentroid",
+                             "base_GaussianFlux",
+                             "base_PeakLikelihoodFlux",
+                             "base_PeakCentroid",
+                             "base_SdssCentroid",
+                             "base_SdssShape",
+                             "base_NaiveCentroid",
+                             #"ip_diffim_NaiveDipoleCentroid",
+                             #"ip_diffim_NaiveDipoleFlux",
+                             "ip_diffim_PsfDipoleFlux",
+                             "ip_diffim_ClassificationDipole",
+                             )
+
+
+def makeDetectionTasks(threshold=5.0, thresholdType='stdev', thresholdPolarity='both',
+                       plugins=defaultMeasurementPlugins):
     # Modeled from meas_algorithms/tests/testMeasure.py
     import lsst.meas.algorithms as measAlg
     import lsst.meas.base as measBase
     import lsst.afw.table as afwTable
-    import lsst.log
 
     schema = afwTable.SourceTable.makeMinimalSchema()
     config = measAlg.SourceDetectionTask.ConfigClass()
@@ -1309,23 +2112,7 @@ def doDetection(exp, threshold=5.0, thresholdType='stdev', thresholdPolarity='bo
     # Do measurement too, so we can get x- and y-coord centroids
 
     config = measBase.SingleFrameMeasurementTask.ConfigClass()
-    # Use the minimum set of plugins required.
-    config.plugins = ["base_CircularApertureFlux",
-                      "base_PixelFlags",
-                      "base_SkyCoord",
-                      "base_PsfFlux",
-                      "base_GaussianCentroid",
-                      "base_GaussianFlux",
-                      "base_PeakLikelihoodFlux",
-                      "base_PeakCentroid",
-                      "base_SdssCentroid",
-                      "base_SdssShape",
-                      "base_NaiveCentroid",
-                      #"ip_diffim_NaiveDipoleCentroid",
-                      #"ip_diffim_NaiveDipoleFlux",
-                      "ip_diffim_PsfDipoleFlux",
-                      "ip_diffim_ClassificationDipole",
-                      ]
+    config.plugins = list(plugins)
     config.slots.centroid = "base_GaussianCentroid" #"ip_diffim_NaiveDipoleCentroid"
     #config.plugins["base_CircularApertureFlux"].radii = [3.0, 7.0, 15.0, 25.0]
     #config.slots.psfFlux = "base_CircularApertureFlux_7_0" # Use of the PSF flux is hardcoded in secondMomentStarSelector
@@ -1336,22 +2123,96 @@ def doDetection(exp, threshold=5.0, thresholdType='stdev', thresholdPolarity='bo
     config.doReplaceWithNoise = False
     measureTask = measBase.SingleFrameMeasurementTask(schema, config=config)
     measureTask.log.setLevel(log_level)
+    return schema, detectionTask, measureTask
+
+
+# Configured (schema, detection task, measurement task) triplets from makeDetectionTasks(), keyed
+# by (threshold, thresholdType, thresholdPolarity, plugins), keeping the `maxSize` most recently
+# used. Tasks are not thread-safe, so each thread gets its own, and the cache is emptied in
+# a new (e.g. forked pool worker) process.
+class DetectionTaskCache(object):
+    def __init__(self, maxSize=8):
+        self.maxSize = maxSize
+        self.local = threading.local()
+
+    def _tasks(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.tasks = collections.OrderedDict()
+        return self.local.tasks
+
+    def get(self, threshold=5.0, thresholdType='stdev', thresholdPolarity='both',
+            plugins=defaultMeasurementPlugins):
+        tasks = self._tasks()
+        key = (threshold, thresholdType, thresholdPolarity, tuple(plugins))
+        if key in tasks:
+            tasks[key] = tasks.pop(key)  # most recently used
+        else:
+            tasks[key] = makeDetectionTasks(threshold, thresholdType, thresholdPolarity, plugins)
+            while len(tasks) > self.maxSize:
+                tasks.popitem(last=False)
+        return tasks[key]
+
+    def clear(self):
+        self._tasks().clear()
+
+
+detectionTaskCache = DetectionTaskCache()
+
 
+# If asDF, the sources are returned as a pandas DataFrame of the `columns` (names or glob
+# patterns, all if None); see catalogToDataFrame().
+def doDetection(exp, threshold=5.0, thresholdType='stdev', thresholdPolarity='both', doSmooth=True,
+                asDF=True, plugins=defaultMeasurementPlugins, columns=None):
+    import lsst.afw.table as afwTable
+
+    schema, detectionTask, measureTask = detectionTaskCache.get(threshold, thresholdType,
+                                                                thresholdPolarity, plugins)
+    # A new table for each run, so source IDs (and other table state) start afresh.
     table = afwTable.SourceTable.make(schema)
     sources = detectionTask.run(table, exp, doSmooth=doSmooth).sources
 
     measureTask.measure(exp, sources)
 
     if asDF:
-        import pandas as pd
-        sources = pd.DataFrame({col: sources.columns[col] for col in sources.schema.getNames()})
+        sources = catalogToDataFrame(sources, columns)
 
     return sources
 
+
+# Convert an afw SourceCatalog to a pandas DataFrame (or if not asDF, a numpy structured array)
+# of the `columns`: a list of column names or glob patterns (e.g. 'base_PsfFlux_*'), or all
+# scalar columns if None. Each column is taken whole as a numpy array from the catalog's
+# column view (the catalog is first deep-copied if it is not contiguous in memory).
+def catalogToDataFrame(sources, columns=None, asDF=True):
+    import fnmatch
+    schema = sources.getSchema()
+    names = schema.getOrderedNames() if hasattr(schema, 'getOrderedNames') else sorted(schema.getNames())
+    if columns is not None:
+        patterns = [columns] if isinstance(columns, basestring) else columns
+        names = [n for n in names if any(fnmatch.fnmatchcase(n, p) for p in patterns)]
+    if not sources.isContiguous():
+        sources = sources.copy(deep=True)
+    view = sources.columns
+    arrays = collections.OrderedDict()
+    for name in names:
+        arr = np.asarray(view[name])
+        if arr.ndim == 1:  # skip array-valued fields
+            arrays[name] = arr
+    if asDF:
+        import pandas as pd
+        return pd.DataFrame(arrays, columns=list(arrays.keys()))
+    out = np.empty(len(sources), dtype=[(str(n), a.dtype) for n, a in arrays.items()])
+    for name, arr in arrays.items():
+        out[name] = arr
+    return out
+
+# Measure the PSF of `exp`, on a clone of it (the input's PSF, pixels and mask are not modified).
 def measurePsf(exp, measurePsfAlg='psfex', detectThresh=5.0):
     import lsst.pipe.tasks.measurePsf as measurePsf
     import lsst.log
 
+    exp = exp.clone()
     # The old (meas_algorithms) SdssCentroid assumed this by default if it
     # wasn't specified; meas_base requires us to be explicit.
     shape = exp.getPsf().computeImage().getDimensions()
@@ -1419,7 +2280,7 @@ def computeVarianceMean(exposure, actuallyDoImage=False, statToDo=afwMath.MEANCL
 
 
 class DiffimTest(object):
-    def __init__(self, doInit=True, **kwargs):
+    def __init__(self, doInit=True, offsetMethod='detection', **kwargs):
         self.args = kwargs
 
         if doInit:
@@ -1437,7 +2298,8 @@ class DiffimTest(object):
 
             self.astrometricOffsets = kwargs.get('offset', [0, 0])
             try:
-                dx, dy = self.computeAstrometricOffsets(threshold=2.5)  # dont make this threshold smaller!
+                dx, dy = self.computeAstrometricOffsets(threshold=2.5,  # dont make this threshold smaller!
+                                                        method=offsetMethod)
                 self.astrometricOffsets = [dx, dy]
             except Exception as e:
                 pass
@@ -1493,57 +2355,104 @@ class DiffimTest(object):
             preConvKernel = self.im2.psf
             if betaGauss == 1.:  # update default, resize the kernel appropriately
                 betaGauss = 1./np.sqrt(2.)
-        D_AL, D_psf, self.kappa_AL = performAlardLupton(self.im1.im, self.im2.im,
-                                                        spatialKernelOrder=spatialKernelOrder,
-                                                        spatialBackgroundOrder=spatialBackgroundOrder,
-                                                        sig1=self.im1.sig, sig2=self.im2.sig,
-                                                        kernelSize=kernelSize,
-                                                        betaGauss=betaGauss,
-                                                        doALZCcorrection=doDecorr,
-                                                        im2Psf=self.im2.psf,
-                                                        preConvKernel=preConvKernel)
-        # This is not entirely correct, we also need to convolve var with the decorrelation kernel (squared):
-        var = self.im1.var + scipy.ndimage.filters.convolve(self.im2.var, self.kappa_AL**2., mode='constant')
-        self.D_AL = Exposure(D_AL, D_psf, var)
-        self.D_AL.im /= np.sqrt(self.im1.metaData['sky'] + self.im2.metaData['sky'])  #np.sqrt(var)
-        self.D_AL.var /= np.sqrt(self.im1.metaData['sky'] + self.im2.metaData['sky'])  #np.sqrt(var)
+        # The variance is var2 + var1 (x) kappa**2 (with var2 pre-convolved by preConvKernel**2 if
+        # needed), convolved with the decorrelation kernel squared.
+        D_AL, D_psf, self.kappa_AL, var = performAlardLupton(self.im1.im, self.im2.im,
+                                                             spatialKernelOrder=spatialKernelOrder,
+                                                             spatialBackgroundOrder=spatialBackgroundOrder,
+                                                             sig1=self.im1.sig, sig2=self.im2.sig,
+                                                             kernelSize=kernelSize,
+                                                             betaGauss=betaGauss,
+                                                             doALZCcorrection=doDecorr,
+                                                             im2Psf=self.im2.psf,
+                                                             preConvKernel=preConvKernel,
+                                                             var1=self.im1.var, var2=self.im2.var)
+        # Normalize the diffim by its expected noise: the image by the sqrt, the variance by the sum.
+        norm = self.im1.metaData['sky'] + self.im2.metaData['sky']
+        self.D_AL = Exposure(D_AL / np.sqrt(norm), D_psf, var / norm)
         # TBD: make the returned D an Exposure.
         return self.D_AL, self.kappa_AL
 
+    # Mean squared x- and y- offsets between the images (as returned by computeOffsets()). With
+    # method='detection', from matched detections in the two images; with 'phaseCorrelation', from
+    # the FFT phase-correlation offsets (see computePhaseCorrelationOffsets()) of the images, or
+    # of (tileSize x tileSize) tiles of them, which is much faster and needs no detection. Tiles
+    # whose correlation peak is below minSignificance times the correlation rms (e.g. empty or
+    # noise-dominated tiles) are rejected, and the offsets of the others are sigma-clipped at
+    # 2 sigma in x and y, as the matched sources in computeOffsets().
     def computeAstrometricOffsets(self, column='base_GaussianCentroid', fluxCol='base_PsfFlux',
-                                  threshold=2.5):
-        src1 = self.im1.doDetection()
+                                  threshold=2.5, method='detection', tileSize=None, minSignificance=10.):
+        if method == 'phaseCorrelation':
+            _, _, dx, dy, peak, rms = computePhaseCorrelationOffsets(self.im1.im, self.im2.im,
+                                                                     tileSize=tileSize)
+            good = peak >= minSignificance * rms
+            if not np.any(good):
+                raise RuntimeError('No tile has a significant phase-correlation peak')
+            dx, dy = dx[good], dy[good]
+            _, dxlow, dxupp = scipy.stats.sigmaclip(dx, low=2, high=2)
+            _, dylow, dyupp = scipy.stats.sigmaclip(dy, low=2, high=2)
+            inds = (dx >= dxlow) & (dx <= dxupp) & (dy >= dylow) & (dy <= dyupp)
+            return np.mean(dx[inds]**2.), np.mean(dy[inds]**2.)
+        columns = [column + '_*', fluxCol + '_*']
+        src1 = self.im1.doDetection(columns=columns)
         src1 = src1[~src1[column + '_flag'] & ~src1[fluxCol + '_flag']]
         src1 = src1[[column + '_x', column + '_y', fluxCol + '_flux']]
         src1.reindex()
-        src2 = self.im2.doDetection()
+        src2 = self.im2.doDetection(columns=columns)
         src2 = src2[~src2[column + '_flag'] & ~src2[fluxCol + '_flag']]
         src2 = src2[[column + '_x', column + '_y', fluxCol + '_flux']]
         src2.reindex()
         dx, dy, _ = computeOffsets(src1, src2, threshold=threshold)
         return dx, dy
 
-    def doZOGY(self, computeScorr=True, inImageSpace=True, padSize=0):
+    # inImageSpace may be True (image-space ZOGY with the given padSize), False (all in Fourier
+    # space), 'tiled' (Fourier space on tiles of tileSize) or 'auto' to let chooseZOGYMethod()
+    # pick the cheapest of these (and the padSize) given the image and PSF sizes; `autoKwargs` are
+    # passed on to chooseZOGYMethod() and are only allowed with 'auto'. The path that was run is
+    # kept in `zogyChoice`: the dict from chooseZOGYMethod() with 'auto', otherwise just its
+    # 'method', 'padSize', 'tileSize' and 'overlap'.
+    def doZOGY(self, computeScorr=True, inImageSpace=True, padSize=0, tileSize=256, **autoKwargs):
+        method = {True: 'imageSpace', False: 'fourier'}.get(inImageSpace, inImageSpace)
+        if method not in ('imageSpace', 'fourier', 'tiled', 'auto'):
+            raise ValueError("doZOGY: inImageSpace must be True, False, 'tiled' or 'auto', not %r" %
+                             (inImageSpace,))
+        if autoKwargs and method != 'auto':
+            raise TypeError("doZOGY: unexpected keyword arguments %s with inImageSpace=%r" %
+                            (sorted(autoKwargs), inImageSpace))
+        if method == 'auto':
+            choice = chooseZOGYMethod(self.im1.im.shape, self.im1.psf, self.im2.psf,
+                                      self.im1.sig, self.im2.sig, tileSize=tileSize, **autoKwargs)
+        else:
+            overlap = None
+            if method == 'tiled':
+                overlap, _ = chooseZOGYTileOverlap(self.im1.psf, self.im2.psf, self.im1.sig, self.im2.sig)
+            choice = {'method': method, 'padSize': padSize if method == 'imageSpace' else 0,
+                      'tileSize': tileSize if method == 'tiled' else None, 'overlap': overlap}
+        self.zogyChoice = choice
+        method, padSize, overlap = choice['method'], choice['padSize'], choice['overlap']
+
         D_ZOGY = None
-        if inImageSpace:
+        if method == 'imageSpace':
             D_ZOGY = performZOGYImageSpace(self.im1.im, self.im2.im, self.im1.psf, self.im2.psf,
                                            sig1=self.im1.sig, sig2=self.im2.sig, padSize=padSize)
+        elif method == 'tiled':
+            D_ZOGY = performZOGYTiled(self.im1.im, self.im2.im, self.im1.psf, self.im2.psf,
+                                      sig1=self.im1.sig, sig2=self.im2.sig, tileSize=tileSize,
+                                      overlap=overlap)
         else:  # Do all in fourier space (needs image-sized PSFs)
-            padSize = 0
-            padSize0 = self.im1.im.shape[0]//2 - self.im1.psf.shape[0]//2
-            padSize1 = self.im1.im.shape[1]//2 - self.im1.psf.shape[1]//2
-            # Hastily assume the image is even-sized and the psf is odd...
-            psf1 = np.pad(self.im1.psf, ((padSize0, padSize0-1), (padSize1, padSize1-1)), mode='constant',
-                          constant_values=0)
-            psf2 = np.pad(self.im2.psf, ((padSize0, padSize0-1), (padSize1, padSize1-1)), mode='constant',
-                          constant_values=0)
+            psf1 = padPsfToImage(self.im1.psf, self.im1.im.shape)
+            psf2 = padPsfToImage(self.im2.psf, self.im2.im.shape)
             D_ZOGY = performZOGY(self.im1.im, self.im2.im, psf1, psf2,
                                  sig1=self.im1.sig, sig2=self.im2.sig)
 
         P_D_ZOGY, F_D = computeZOGYDiffimPsf(self.im1.im, self.im2.im,
                                              self.im1.psf, self.im2.psf,
                                              sig1=self.im1.sig, sig2=self.im2.sig, F_r=1., F_n=1.)
-        self.D_ZOGY = Exposure(D_ZOGY, P_D_ZOGY, self.im1.var + self.im2.var)
+        # Propagate the variance planes through the ZOGY kernels (for both D and S at once)
+        var_D, var1c, var2c = computeZOGYVariance(self.im1.var, self.im2.var, self.im1.psf, self.im2.psf,
+                                                  sig1=self.im1.sig, sig2=self.im2.sig, padSize=padSize,
+                                                  computeScorr=computeScorr)
+        self.D_ZOGY = Exposure(D_ZOGY, P_D_ZOGY, var_D)
 
         if computeScorr:
             S_corr_ZOGY, S_ZOGY, _, P_D_ZOGY, F_D, var1c, \
@@ -1553,17 +2462,24 @@ class DiffimTest(object):
                                           D=D_ZOGY, #xVarAst=dx, yVarAst=dy)
                                           xVarAst=self.astrometricOffsets[0], # these are already variances.
                                           yVarAst=self.astrometricOffsets[1],
-                                          padSize=padSize)
-            self.S_ZOGY = Exposure(S_ZOGY, P_D_ZOGY, np.sqrt(var1c + var2c))
-            self.S_corr_ZOGY = Exposure(S_corr_ZOGY, P_D_ZOGY, np.sqrt(var1c + var2c)/np.sqrt(var1c + var2c))
+                                          padSize=padSize, var1c=var1c, var2c=var2c)
+            self.S_ZOGY = Exposure(S_ZOGY, P_D_ZOGY, var1c + var2c)
+            self.S_corr_ZOGY = Exposure(S_corr_ZOGY, P_D_ZOGY, np.ones_like(S_corr_ZOGY))
 
         return self.D_ZOGY
 
-    def doALInStack(self, doWarping=False, doDecorr=True, doPreConv=False):
+    # If `fused` is set, only the kernel is fitted by the task (see fitALKernelInStack()), and the
+    # convolution, background subtraction and decorrelation are done in a single Fourier-domain pass
+    # with its (constant) kernel (see subtractAndDecorrelateInFourierSpace()); the result has the
+    # same fields as otherwise, but its subtractedExposure (the un-decorrelated diffim) is None
+    # unless keepUndecorrelated is set.
+    def doALInStack(self, doWarping=False, doDecorr=True, doPreConv=False, decorrInFourierSpace=False,
+                    fused=False, keepUndecorrelated=False):
         import lsst.ip.diffim as ipDiffim
         import lsst.meas.algorithms as measAlg
         import lsst.log
 
+        # ImagePsfMatchTask sets mask bits in its inputs
         im1 = self.im1.asAfwExposure()
         im2 = self.im2.asAfwExposure()
 
@@ -1572,7 +2488,7 @@ class DiffimTest(object):
         if doPreConv:
             #doDecorr = False  # Right now decorr with pre-conv doesn't work
             preConvKernel = self.im2.psf
-            im2c, kern = doConvolve(im2, preConvKernel, use_scipy=False)
+            im2c, kern = doConvolve(im2, preConvKernel, use_scipy=False, pool=exposurePool)
 
         config = ipDiffim.ImagePsfMatchTask.ConfigClass()
         config.kernel.name = "AL"
@@ -1588,38 +2504,37 @@ class DiffimTest(object):
 
         task = ipDiffim.ImagePsfMatchTask(config=config)
         task.log.setLevel(log_level)
+        if fused and doDecorr and not doWarping:
+            return self._doALInStackFused(task, im1, im2, im2c, preConvKernel, keepUndecorrelated)
         result = task.subtractExposures(im1, im2c, doWarping=doWarping)
+        if im2c is not im2:
+            exposurePool.release(im2c)
 
         if doDecorr:
             kimg = alPsfMatchingKernelToArray(result.psfMatchingKernel, im1)
-            #return kimg
-            if preConvKernel is not None and kimg.shape[0] < preConvKernel.shape[0]:
-                # This is likely brittle and may only work if both kernels are odd-shaped.
-                #kimg[np.abs(kimg) < 1e-4] = np.sign(kimg)[np.abs(kimg) < 1e-4] * 1e-8
-                #kimg -= kimg[0, 0]
-                padSize0 = preConvKernel.shape[0]//2 - kimg.shape[0]//2
-                padSize1 = preConvKernel.shape[1]//2 - kimg.shape[1]//2
-                kimg = np.pad(kimg, ((padSize0, padSize0), (padSize1, padSize1)), mode='constant',
-                              constant_values=0)
-                #kimg /= kimg.sum()
-
-                #preConvKernel = preConvKernel[padSize0:-padSize0, padSize1:-padSize1]
-                #print kimg.shape, preConvKernel.shape
-
             sig1squared = computeVarianceMean(im1)
             sig2squared = computeVarianceMean(im2)
-            pck = computeDecorrelationKernel(kimg, sig1squared, sig2squared,
-                                             preConvKernel=preConvKernel, delta=1.)
-            #return kimg, preConvKernel, pck
-            diffim, _ = doConvolve(result.subtractedExposure, pck, use_scipy=False)
+            psf = afwPsfToArray(result.subtractedExposure.getPsf(), result.subtractedExposure)  # .computeImage().getArray()
+            # The filter holds kappa, preConvKernel and psf at a common size, so they need not be padded
+            # to match, and the corrected PSF includes the pre-convolution. In Fourier space, the image
+            # and variance planes are filtered with the same filter at the padded size of the diffim.
+            filt = cachedDecorrelationFilter(kimg, sig1squared, sig2squared, preConvKernel=preConvKernel,
+                                             psf=psf, delta=1.)
+            pck = filt.kernel()
+            if decorrInFourierSpace:
+                diffim = result.subtractedExposure.clone()
+                img, _, var = diffim.getMaskedImage().getArrays()
+                imFilt = filt.atImageShape(img.shape)
+                img[:, :] = kernelOps.filterArray(img, imFilt.filter)
+                var[:, :] = kernelOps.filterArray(var, imFilt.varianceFilter)
+            else:
+                diffim, _ = doConvolve(result.subtractedExposure, pck, use_scipy=False)
             #diffim.getMaskedImage().getImage().getArray()[:, ] \
             #    /= np.sqrt(self.im1.metaData['sky'] + self.im1.metaData['sky'])
             #diffim.getMaskedImage().getVariance().getArray()[:, ] \
             #    /= np.sqrt(self.im1.metaData['sky'] + self.im1.metaData['sky'])
 
-            psf = afwPsfToArray(result.subtractedExposure.getPsf(), result.subtractedExposure)  # .computeImage().getArray()
-            # NOTE! Need to compute the updated PSF including preConvKernel !!! This doesn't do it:
-            psfc = computeCorrectedDiffimPsf(kimg, psf, svar=sig1squared, tvar=sig2squared)
+            psfc = filt.correctedPsf()
             psfcI = afwImage.ImageD(psfc.shape[0], psfc.shape[1])
             psfcI.getArray()[:, :] = psfc
             psfcK = afwMath.FixedKernel(psfcI)
@@ -1633,11 +2548,75 @@ class DiffimTest(object):
 
         return result
 
+    def _doALInStackFused(self, task, im1, im2, im2c, preConvKernel, keepUndecorrelated=False):
+        import lsst.meas.algorithms as measAlg
+        import lsst.pipe.base as pipeBase
+
+        psfMatchingKernel, backgroundModel = fitALKernelInStack(task, im1, im2c)
+        kimg = alPsfMatchingKernelToArray(psfMatchingKernel, im1)
+        sig1squared = computeVarianceMean(im1)
+        sig2squared = computeVarianceMean(im2)
+        psf = afwPsfToArray(im2.getPsf(), im2)
+        diffim, pck, subtracted = subtractAndDecorrelateInFourierSpace(
+            im1, im2c, kimg, sig1squared, sig2squared, preConvKernel=preConvKernel, delta=1., psf=psf,
+            backgroundModel=backgroundModel, keepUndecorrelated=keepUndecorrelated, pool=exposurePool)
+        if im2c is not im2:
+            exposurePool.release(im2c)
+
+        # The same cached filter as used for the subtraction
+        psfc = cachedDecorrelationFilter(kimg, sig1squared, sig2squared, preConvKernel=preConvKernel,
+                                         psf=psf, delta=1.).correctedPsf()
+        psfcI = afwImage.ImageD(psfc.shape[0], psfc.shape[1])
+        psfcI.getArray()[:, :] = psfc
+        psfcK = afwMath.FixedKernel(psfcI)
+        diffim.setPsf(measAlg.KernelPsf(psfcK))
+        if subtracted is not None:
+            subtracted.setPsf(im2.getPsf())
+
+        return pipeBase.Struct(subtractedExposure=subtracted, psfMatchingKernel=psfMatchingKernel,
+                               backgroundModel=backgroundModel, decorrelatedDiffim=diffim,
+                               preConvKernel=preConvKernel, decorrelationKernel=pck, kappaImg=kimg)
+
     def reset(self):
-        self.res = self.S_corr_ZOGY = self.D_ZOGY = self.D_AL = None
+        self.res = self.S_corr_ZOGY = self.D_ZOGY = self.D_AL = self.zogyChoice = None
+
+    # Detect and measure sources on `exp` (a numpy Exposure or an afw Exposure) with the stack
+    # (doDetection()) or, if detector='numpy', with fastDetection.detectSources().
+    @staticmethod
+    def detectSources(exp, doSmooth=True, detector='stack'):
+        if detector == 'numpy':
+            if isinstance(exp, Exposure):
+                return fastDetection.detectSources(exp.im, exp.psf, exp.var, doSmooth=doSmooth)
+            im, _, var = exp.getMaskedImage().getArrays()
+            return fastDetection.detectSources(im, afwPsfToArray(exp.getPsf(), exp), var, doSmooth=doSmooth)
+        if isinstance(exp, Exposure):
+            exp = exp.asAfwExposure()
+        return doDetection(exp, doSmooth=doSmooth)
+
+    # Validate the numpy detector against the stack: detect on the same diffims with both, match
+    # the sources and return, per diffim, the numbers of sources found by each and by both, and the
+    # median centroid offset and PSF flux ratio (numpy/stack) of the matched sources.
+    def compareDetectors(self, subtractMethods=['ALstack', 'ZOGY'], zogyImageSpace=True, radius=1.5):
+        out = {}
+        stack = self.runTest(subtractMethods, zogyImageSpace=zogyImageSpace, returnSources=True)
+        fast = self.runTest(subtractMethods, zogyImageSpace=zogyImageSpace, returnSources=True,
+                            detector='numpy')
+        for key in stack:
+            if key not in fast:
+                continue
+            s, f = stack[key], fast[key]
+            idx1, idx2, dist = sourceMatching.matchSources(
+                np.column_stack([s.base_NaiveCentroid_x, s.base_NaiveCentroid_y]),
+                np.column_stack([f.base_NaiveCentroid_x, f.base_NaiveCentroid_y]), radius)
+            fluxRatio = f.base_PsfFlux_flux.values[idx2] / s.base_PsfFlux_flux.values[idx1]
+            out[key] = {'nStack': len(s), 'nNumpy': len(f), 'nMatched': len(idx1),
+                        'medianOffset': np.median(dist) if len(dist) else np.nan,
+                        'medianFluxRatio': np.median(fluxRatio) if len(dist) else np.nan}
+        return out
 
+    # detector='numpy' uses the fast numpy detector (see fastDetection) rather than the stack.
     def runTest(self, subtractMethods=['ALstack', 'ZOGY', 'ZOGY_S', 'ALstack_noDecorr'],
-                zogyImageSpace=True, returnSources=False):
+                zogyImageSpace=True, returnSources=False, detector='stack'):
         import pandas as pd  # We're going to store the results as pandas dataframes.
 
         D_ZOGY = S_ZOGY = res = D_AL = None
@@ -1664,23 +2643,23 @@ class DiffimTest(object):
             # Run detection next
             try:
                 if subMethod is 'ALstack':
-                    src_AL = doDetection(res.decorrelatedDiffim)
+                    src_AL = self.detectSources(res.decorrelatedDiffim, detector=detector)
                     src_AL = src_AL[~src_AL['base_PsfFlux_flag']]
                     src['ALstack'] = src_AL
                 elif subMethod is 'ALstack_noDecorr':
-                    src_AL2 = doDetection(res.subtractedExposure)
+                    src_AL2 = self.detectSources(res.subtractedExposure, detector=detector)
                     src_AL2 = src_AL2[~src_AL2['base_PsfFlux_flag']]
                     src['ALstack_noDecorr'] = src_AL2
                 elif subMethod is 'ZOGY':
-                    src_ZOGY = doDetection(D_ZOGY.asAfwExposure())
+                    src_ZOGY = self.detectSources(D_ZOGY, detector=detector)
                     src_ZOGY = src_ZOGY[~src_ZOGY['base_PsfFlux_flag']]
                     src['ZOGY'] = src_ZOGY
                 elif subMethod is 'ZOGY_S':
-                    src_SZOGY = doDetection(S_ZOGY.asAfwExposure(), doSmooth=False)
+                    src_SZOGY = self.detectSources(S_ZOGY, doSmooth=False, detector=detector)
                     src_SZOGY = src_SZOGY[~src_SZOGY['base_PsfFlux_flag']]
                     src['SZOGY'] = src_SZOGY
                 elif subMethod is 'AL' and D_AL is not None:
-                    src_AL = doDetection(D_AL.asAfwExposure())
+                    src_AL = self.detectSources(D_AL, detector=detector)
                     src_AL = src_AL[~src_AL['base_PsfFlux_flag']]
                     src['AL'] = src_AL
             except Exception as e:
@@ -1695,13 +2674,9 @@ class DiffimTest(object):
 
         detections = {}
         for key in src:
-            dist = np.sqrt(np.add.outer(src[key].base_NaiveCentroid_x, -changedCentroid[:, 0])**2. + \
-               np.add.outer(src[key].base_NaiveCentroid_y, -changedCentroid[:, 1])**2.) # in pixels
-            matches = np.where(dist <= 1.5)
-            true_pos = len(np.unique(matches[0]))
-            false_neg = changedCentroid.shape[0] - len(np.unique(matches[1]))
-            false_pos = src[key].shape[0] - len(np.unique(matches[0]))
-            detections[key] = {'TP': true_pos, 'FN': false_neg, 'FP': false_pos}
+            detectedCentroid = np.column_stack([src[key].base_NaiveCentroid_x, src[key].base_NaiveCentroid_y])
+            detections[key] = sourceMatching.scoreDetections(detectedCentroid, changedCentroid[:, :2],
+                                                             radius=1.5)  # in pixels
 
         return detections
 
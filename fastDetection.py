@@ -0,0 +1,115 @@
+from __future__ import absolute_import, division, print_function
+
+# A lightweight source detector on numpy arrays, for parameter sweeps where only the peak
+# positions and PSF fluxes are needed (e.g. the scoring in DiffimTest.runTest). It mimics the
+# stack's SourceDetectionTask (thresholdType='stdev') followed by base_NaiveCentroid and
+# base_PsfFlux measurement, and returns columns named as in the stack's catalogs.
+
+import numpy as np
+import scipy.ndimage
+import scipy.signal
+
+try:
+    from . import imageStats
+except (ImportError, ValueError):
+    import imageStats
+
+__all__ = ("detectSources",)
+
+
+def _gather(im, rows, cols, halfSize):
+    """! (nSources, 2*halfSize+1, 2*halfSize+1) stamps of `im` about the given pixels, with the
+    indices clipped at the image edges.
+    """
+    offsets = np.arange(-halfSize, halfSize + 1)
+    r = np.clip(rows[:, None] + offsets[None, :], 0, im.shape[0] - 1)
+    c = np.clip(cols[:, None] + offsets[None, :], 0, im.shape[1] - 1)
+    return im[r[:, :, None], c[:, None, :]]
+
+
+def detectSources(im, psf, var=None, threshold=5.0, thresholdPolarity='both', doSmooth=True,
+                  splitPeaks=False, asDF=True):
+    """! Detect and measure sources in an image.
+
+    The image is correlated with the PSF (via FFT) if `doSmooth`, and pixels beyond `threshold`
+    times the clipped std. dev. of the (smoothed) image are grouped into footprints with
+    `scipy.ndimage.label`. Each footprint gives one source at its most significant pixel (or, if
+    `splitPeaks`, one per local maximum found with `scipy.ndimage.maximum_filter`). All sources
+    are then measured at once:
+        * base_NaiveCentroid: the first moment of the 3x3 pixels about the peak;
+        * base_PsfFlux: the PSF-weighted flux sum(psf * im) / sum(psf**2) at the peak, with its
+          error from the variance plane `var` (or from the clipped std. dev. of `im`), flagged
+          for sources whose PSF footprint falls off the image.
+
+    @param im        2-d numpy.array of the image (x is along the 2nd axis, as in afw)
+    @param psf       2-d numpy.array of the PSF, centered at (h//2, w//2)
+    @param var       2-d numpy.array of the variance, or None
+    @param thresholdPolarity 'positive', 'negative' or 'both'
+    @return pandas.DataFrame (or a dict of numpy.arrays if not `asDF`) of the sources
+    """
+    im = np.nan_to_num(np.asarray(im, dtype=np.float64))
+    psf = np.asarray(psf, dtype=np.float64)
+    psf = psf / psf.sum()
+    psfNorm = np.sum(psf**2)
+
+    filtered = scipy.signal.fftconvolve(im, psf[::-1, ::-1], mode='same')
+    detIm = filtered if doSmooth else im
+    _, sig, _, _ = imageStats.clippedStats(detIm)
+
+    polarities = {'both': (1., -1.), 'positive': (1.,), 'negative': (-1.,)}[thresholdPolarity]
+    rows, cols, signs = [], [], []
+    for sign in polarities:
+        signed = sign * detIm
+        above = signed >= threshold * sig
+        labels, nLabels = scipy.ndimage.label(above)
+        if nLabels == 0:
+            continue
+        if splitPeaks:
+            peaks = above & (signed == scipy.ndimage.maximum_filter(signed, size=3))
+            r, c = np.nonzero(peaks)
+        else:
+            positions = scipy.ndimage.maximum_position(signed, labels, np.arange(1, nLabels + 1))
+            r, c = np.array(positions, dtype=int).reshape(-1, 2).T
+        rows.append(r)
+        cols.append(c)
+        signs.append(np.full(len(r), sign))
+    if rows:
+        rows, cols, signs = np.concatenate(rows), np.concatenate(cols), np.concatenate(signs)
+    else:
+        rows, cols, signs = np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    # Naive centroids, from the (sign-corrected) 3x3 stamps
+    stamps = _gather(im, rows, cols, 1) * signs[:, None, None]
+    offsets = np.arange(-1, 2)
+    total = stamps.sum(axis=(1, 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = cols + np.sum(stamps.sum(axis=1) * offsets, axis=1) / total
+        y = rows + np.sum(stamps.sum(axis=2) * offsets, axis=1) / total
+
+    # PSF fluxes and their errors
+    flux = filtered[rows, cols] / psfNorm
+    if var is not None:
+        varFiltered = scipy.signal.fftconvolve(np.nan_to_num(np.asarray(var, dtype=np.float64)),
+                                               (psf**2)[::-1, ::-1], mode='same')
+        fluxSigma = np.sqrt(np.maximum(varFiltered[rows, cols], 0.)) / psfNorm
+    else:
+        fluxSigma = np.full(len(rows), imageStats.clippedStats(im)[1] * np.sqrt(psfNorm) / psfNorm)
+    halfH, halfW = psf.shape[0] // 2, psf.shape[1] // 2
+    edge = (rows < halfH) | (rows >= im.shape[0] - halfH) | (cols < halfW) | (cols >= im.shape[1] - halfW)
+
+    sources = {
+        'id': np.arange(1, len(rows) + 1),
+        'base_PeakCentroid_x': cols.astype(np.float64),
+        'base_PeakCentroid_y': rows.astype(np.float64),
+        'base_NaiveCentroid_x': x,
+        'base_NaiveCentroid_y': y,
+        'base_NaiveCentroid_flag': ~np.isfinite(x) | ~np.isfinite(y),
+        'base_PsfFlux_flux': flux,
+        'base_PsfFlux_fluxSigma': fluxSigma,
+        'base_PsfFlux_flag': edge,
+        'significance': detIm[rows, cols] / sig,
+    }
+    if asDF:
+        import pandas as pd
+        sources = pd.DataFrame(sources)
+    return sources
@@ -23,15 +23,29 @@ standard_library.install_aliases()
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+import weakref
+
 import numpy as np
 import scipy.fftpack
 
+import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.meas.algorithms as measAlg
 import lsst.afw.math as afwMath
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 
+try:
+    from . import kernelOps
+    from .caches import KernelCache, ExposurePool
+except (ImportError, ValueError):  # not within a package
+    import kernelOps
+    from caches import KernelCache, ExposurePool
+
 __all__ = ("DecorrelateALKernelTask", "DecorrelateALKernelConfig")
 
 
@@ -47,6 +61,84 @@ class DecorrelateALKernelConfig(pexConfig.Config):
         doc="""Mask planes to ignore for sigma-clipped statistics""",
         default=("INTRP", "EDGE", "DETECTED", "SAT", "CR", "BAD", "NO_DATA", "DETECTED_NEGATIVE")
     )
+    spatiallyVarying = pexConfig.Field(
+        dtype=bool,
+        doc="""Compute decorrelation kernels from the (spatially-varying) matching kernel on a grid
+        across the image and blend them bilinearly, rather than use one kernel from the image center""",
+        default=False
+    )
+    spatialGridSize = pexConfig.ListField(
+        dtype=int,
+        doc="""Number of grid nodes in x and y (including the image edges) at which to compute
+        the decorrelation kernel if spatiallyVarying is True""",
+        default=(3, 3)
+    )
+    spatialPsfOrder = pexConfig.Field(
+        dtype=int,
+        doc="""Order of the polynomial describing the spatial variation of the corrected diffim PSF
+        if spatiallyVarying is True""",
+        default=1
+    )
+    nThreads = pexConfig.Field(
+        dtype=int,
+        doc="""Number of threads to use for the tiled convolution if spatiallyVarying is True""",
+        default=1
+    )
+    varianceMeanMethod = pexConfig.ChoiceField(
+        dtype=str,
+        doc="""How to compute the sigma-clipped mean of the variance planes""",
+        default="exact",
+        allowed={
+            "exact": "afwMath.makeStatistics MEANCLIP over all pixels",
+            "subsample": "numpy clipped mean over a deterministic subsample of at most "
+                         "varianceSubsampleSize pixels, with its standard error",
+            "histogram": "clipped mean of a histogram of all pixels, built in one pass; approximate, "
+                         "to about the bin width (reported as its resolution, not as a bound)",
+        }
+    )
+    varianceSubsampleSize = pexConfig.Field(
+        dtype=int,
+        doc="""Maximum number of pixels used if varianceMeanMethod is 'subsample'""",
+        default=100000
+    )
+    varianceHistogramBins = pexConfig.Field(
+        dtype=int,
+        doc="""Number of bins used if varianceMeanMethod is 'histogram'""",
+        default=1024
+    )
+    varianceMeanCacheSize = pexConfig.Field(
+        dtype=int,
+        doc="""Number of variance means to cache, keyed by the exposure and its pixel buffers
+        (0 disables caching); see `DecorrelateALKernelTask.invalidateVarianceStats()`""",
+        default=16
+    )
+    kernelCacheSize = pexConfig.Field(
+        dtype=int,
+        doc="""Maximum number of decorrelation kernels and corrected PSFs to keep in the task's
+        least-recently-used cache (0 disables caching)""",
+        default=64
+    )
+    kernelCacheVarianceDigits = pexConfig.Field(
+        dtype=int,
+        doc="""If set, the number of significant digits of svar and tvar used in the kernel cache key, so
+        that variances agreeing to a relative tolerance of about 10**-digits reuse a cached kernel;
+        if None (the default), the exact variances are used""",
+        default=None,
+        optional=True
+    )
+    exposurePoolSize = pexConfig.Field(
+        dtype=int,
+        doc="""Maximum number of released output exposures (per bbox) kept by the task for reuse;
+        see `DecorrelateALKernelTask.releaseExposure()`""",
+        default=4
+    )
+    applyInFourierSpace = pexConfig.Field(
+        dtype=bool,
+        doc="""Apply the decorrelation by multiplying the transform of the (padded) diffim by the
+        decorrelation filter, rather than by convolving it with the (trimmed) decorrelation kernel.
+        Ignored if spatiallyVarying is True""",
+        default=False
+    )
 
 ## \addtogroup LSST_task_documentation
 ## \{
@@ -104,8 +196,22 @@ class DecorrelateALKernelTask(pipeBase.Task):
 
     \section ip_diffim_imageDecorrelation_DecorrelateALKernelTask_Config       Configuration parameters
 
-    This task currently has no relevant configuration parameters.
-    See \ref DecorrelateALKernelConfig
+    By default a single decorrelation kernel, computed from the matching kernel at the center of
+    the image, is used. Set `spatiallyVarying` to compute decorrelation kernels on a grid of
+    `spatialGridSize` nodes and apply them by bilinear blending (see \ref DecorrelateALKernelConfig).
+
+    \section ip_diffim_imageDecorrelation_DecorrelateALKernelTask_Output       Ownership of the outputs
+
+    The decorrelated exposures returned by `run()` and `runBatch()` are taken from an exposure pool
+    held by the task, rather than cloned from the input. They belong to the caller: the task keeps
+    no reference to them, and never reuses one unless the caller hands it back with
+    `releaseExposure()`, after which the caller must not use it any more. Never releasing them is
+    safe; the task then simply allocates a new exposure on each call.
+
+    The clipped means of the variance planes of the input exposures are cached (see
+    `computeVarianceStats()`), keyed by the exposure object and the addresses of its variance and
+    mask buffers. Replacing an exposure's planes is detected, but modifying their pixels in place
+    is not: call `invalidateVarianceStats()` after doing so.
 
     \section ip_diffim_imageDecorrelation_DecorrelateALKernelTask_Debug		Debug variables
 
@@ -131,13 +237,186 @@ class DecorrelateALKernelTask(pipeBase.Task):
         self.statsControl.setNumSigmaClip(3.)
         self.statsControl.setNumIter(3)
         self.statsControl.setAndMask(afwImage.MaskU.getPlaneBitMask(self.config.ignoreMaskPlanes))
+        self.kernelCache = KernelCache(maxSize=self.config.kernelCacheSize,
+                                       varianceDigits=self.config.kernelCacheVarianceDigits)
+        self.exposurePool = ExposurePool(maxPerKey=self.config.exposurePoolSize)
+        self._varianceStatsCache = OrderedDict()
+        self._varianceStatsLock = threading.Lock()
+
+    def releaseExposure(self, exposure):
+        """! Hand a `correctedExposure` returned by `run()` back to the task for reuse by later calls.
+        The exposure must not be used by the caller afterwards.
+        """
+        self.invalidateVarianceStats(exposure)
+        self.exposurePool.release(exposure)
+
+    def invalidateVarianceStats(self, exposure=None):
+        """! Drop the cached variance means of `exposure` (or of all exposures), e.g. after its
+        variance or mask pixels were modified in place.
+        """
+        with self._varianceStatsLock:
+            if exposure is None:
+                self._varianceStatsCache.clear()
+            else:
+                for key in [k for k in self._varianceStatsCache if k[0] == id(exposure)]:
+                    del self._varianceStatsCache[key]
 
     def computeVarianceMean(self, exposure):
-        statObj = afwMath.makeStatistics(exposure.getMaskedImage().getVariance(),
-                                         exposure.getMaskedImage().getMask(),
-                                         afwMath.MEANCLIP, self.statsControl)
-        var = statObj.getValue(afwMath.MEANCLIP)
-        return var
+        return self.computeVarianceStats(exposure)[0]
+
+    def computeVarianceStats(self, exposure):
+        """! Compute the sigma-clipped mean of the variance plane of an exposure.
+
+        The method is set by `config.varianceMeanMethod`. Results are cached, keyed by the exposure
+        object (held by a weak reference, so that a new exposure reusing its id() is not mistaken for
+        it) and stamped with the addresses and shapes of its variance and mask buffers, so repeated
+        requests for the same exposure read no pixels. In-place modifications of the pixels are not
+        detected; call `invalidateVarianceStats()` after them.
+
+        The "histogram" method bins all good pixels within +/- 2*nSigma (IQR-based) sigma of the
+        median of a sparse subsample (or, if a quarter of the pixels fall on one side of that range,
+        within their full range, in a second pass). The pixels outside the range are counted, so the
+        median and IQR that start the clipping are those of all pixels (to the bin resolution), but
+        their values are lost: if the final clipping range extends past the histogram range while
+        such pixels exist, the mean is biased and a warning is logged. The second returned value is then only
+        the resolution of the binning, not a bound on the error.
+
+        @param exposure the afwImage.Exposure
+        @return the clipped mean (NaN if there are no good pixels), and its uncertainty: 0 for the
+        "exact" method, the standard error of the subsample mean for "subsample", and half the bin
+        width (the resolution of the binning; see above) for "histogram"
+        """
+        mi = exposure.getMaskedImage()
+        var = mi.getVariance().getArray()
+        msk = mi.getMask().getArray()
+        method = self.config.varianceMeanMethod
+
+        key = ref = None
+        if self.config.varianceMeanCacheSize > 0:
+            try:
+                ref = weakref.ref(exposure)
+            except TypeError:
+                pass
+        if ref is not None:
+            key = (id(exposure), method, self.statsControl.getAndMask())
+            stamp = tuple((arr.__array_interface__['data'][0], arr.shape, arr.strides) for arr in (var, msk))
+            with self._varianceStatsLock:
+                entry = self._varianceStatsCache.pop(key, None)
+                if entry is not None and entry[0]() is exposure and entry[1] == stamp:
+                    self._varianceStatsCache[key] = entry  # most recently used
+                    return entry[2]
+
+        if method == "exact":
+            statObj = afwMath.makeStatistics(mi.getVariance(), mi.getMask(), afwMath.MEANCLIP,
+                                             self.statsControl)
+            result = (statObj.getValue(afwMath.MEANCLIP), 0.)
+        else:
+            andMask = self.statsControl.getAndMask()
+            nSigma, nIter = self.statsControl.getNumSigmaClip(), self.statsControl.getNumIter()
+            step = max(1, int(np.ceil(var.size / self.config.varianceSubsampleSize)))
+
+            def goodValues(v, m):
+                return v[np.isfinite(v) & ((m & andMask) == 0)]
+
+            def sampleGoodValues(sampleStep):
+                # The good values of a 1/sampleStep subsample, or of all pixels if it has none
+                values = goodValues(var.ravel()[::sampleStep], msk.ravel()[::sampleStep])
+                if values.size == 0 and sampleStep > 1:
+                    values = goodValues(var, msk)
+                return values
+
+            sample = sampleGoodValues(step if method == "subsample" else step*16)
+            if sample.size == 0:
+                self.log.warn("No good pixels in the variance plane; its mean is NaN")
+                result = (np.nan, np.nan)
+            elif method == "subsample":
+                mean, std, n = DecorrelateALKernelTask._clippedMean(sample, nSigma, nIter)
+                # Standard error of the mean, with the finite-population correction for a 1/step sample
+                result = (mean, std / np.sqrt(max(n, 1)) * np.sqrt(1. - 1. / step))
+            else:
+                def accumulate(edges):
+                    # Accumulate the histogram over blocks of rows, so only one block of good pixels is
+                    # copied; also count the pixels outside its range, and find the range of all pixels
+                    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+                    nBelow = nAbove = 0
+                    lo, hi = np.inf, -np.inf
+                    nRows = max(1, 65536 // max(var.shape[1], 1))
+                    for y0 in range(0, var.shape[0], nRows):
+                        values = goodValues(var[y0:y0 + nRows], msk[y0:y0 + nRows])
+                        if values.size == 0:
+                            continue
+                        counts += np.histogram(values, bins=edges)[0]
+                        nBelow += np.count_nonzero(values < edges[0])
+                        nAbove += np.count_nonzero(values > edges[-1])
+                        lo, hi = min(lo, values.min()), max(hi, values.max())
+                    return counts, nBelow, nAbove, lo, hi
+
+                # The histogram range comes from a sparse subsample...
+                center, sigma = DecorrelateALKernelTask._medianAndIqrSigma(sample)
+                halfWidth = 2*nSigma*sigma if sigma > 0 else max(abs(center), 1.) * 1e-6
+                nBins = self.config.varianceHistogramBins
+                edges = np.linspace(center - halfWidth, center + halfWidth, nBins + 1)
+                counts, nBelow, nAbove, lo, hi = accumulate(edges)
+                # ... unless that misses a quartile of the pixels (e.g. if the plane has a pattern aliased
+                # with the subsample), which would put the starting median or IQR outside the histogram:
+                # then make a second pass over the full range of the pixels
+                nTotal = counts.sum() + nBelow + nAbove
+                if 4*max(nBelow, nAbove) >= nTotal:
+                    edges = np.linspace(lo, hi if hi > lo else lo + max(abs(lo), 1.) * 1e-6, nBins + 1)
+                    counts, nBelow, nAbove, _, _ = accumulate(edges)
+                mean, clipSigma = DecorrelateALKernelTask._clippedMeanFromHistogram(
+                    counts, edges, nSigma, nIter, nBelow=nBelow, nAbove=nAbove)
+                if (nBelow > 0 and mean - nSigma*clipSigma < edges[0]) or \
+                        (nAbove > 0 and mean + nSigma*clipSigma > edges[-1]):
+                    self.log.warn("%d variance pixels outside the histogram range [%g, %g] may be within "
+                                  "the clipping range; the histogram mean is biased" %
+                                  (nBelow + nAbove, edges[0], edges[-1]))
+                result = (mean, (edges[1] - edges[0]) / 2.)
+
+        if key is not None:
+            with self._varianceStatsLock:
+                if len(self._varianceStatsCache) >= self.config.varianceMeanCacheSize:
+                    self._varianceStatsCache.popitem(last=False)
+                self._varianceStatsCache[key] = (ref, stamp, result)
+        self.log.debug("Variance mean (%s): %f +/- %f" % (method, result[0], result[1]))
+        return result
+
+    @staticmethod
+    def _medianAndIqrSigma(values):
+        q25, q50, q75 = np.percentile(values, [25., 50., 75.])
+        sigma = 0.741 * (q75 - q25)
+        return q50, (sigma if sigma > 0 else np.std(values))
+
+    @staticmethod
+    def _clippedMean(values, nSigma=3., nIter=3):
+        """! Sigma-clipped mean as in afwMath MEANCLIP: start from the median and the IQR-based
+        sigma, then iteratively clip about the mean.
+        @return the clipped mean, the clipped standard deviation and the number of values used
+        """
+        center, sigma = DecorrelateALKernelTask._medianAndIqrSigma(values)
+        clipped = values
+        for i in range(nIter):
+            clipped = values[np.abs(values - center) < nSigma * sigma]
+            center, sigma = clipped.mean(), clipped.std()
+        return center, sigma, len(clipped)
+
+    @staticmethod
+    def _clippedMeanFromHistogram(counts, edges, nSigma=3., nIter=3, nBelow=0, nAbove=0):
+        """! The `_clippedMean()` algorithm applied to a histogram of the values, `nBelow` and `nAbove`
+        of which are outside its range (they count for the starting median and IQR only).
+        @return the clipped mean and standard deviation
+        """
+        x = 0.5 * (edges[1:] + edges[:-1])
+        cdf = (nBelow + np.cumsum(counts)) / float(nBelow + counts.sum() + nAbove)
+        q25, q50, q75 = np.interp([0.25, 0.5, 0.75], cdf, x)
+        center, sigma = q50, 0.741 * (q75 - q25)
+        for i in range(nIter):
+            w = counts * (np.abs(x - center) < nSigma * sigma)
+            if w.sum() == 0:
+                break
+            center = np.sum(w * x) / w.sum()
+            sigma = np.sqrt(np.sum(w * (x - center)**2) / w.sum())
+        return center, sigma
 
     @pipeBase.timeMethod
     def run(self, exposure, templateExposure, subtractedExposure, psfMatchingKernel,
@@ -172,9 +451,13 @@ class DecorrelateALKernelTask(pipeBase.Task):
             * `correctionKernel`: the decorrelation correction kernel (which may be ignored)
 
         @note The `subtractedExposure` is NOT updated
-        @note The returned `correctedExposure` has an updated PSF as well.
-        @note Here we currently convert a spatially-varying matching kernel into a constant kernel,
-        just by computing it at the center of the image (tickets DM-6243, DM-6244).
+        @note The returned `correctedExposure` has an updated PSF as well. It is owned by the caller,
+        who may pass it to `releaseExposure()` once done with it (and must not use it afterwards) to
+        avoid a new allocation on the next call; see the task documentation.
+        @note Unless `config.spatiallyVarying` is set, here we convert a spatially-varying matching
+        kernel into a constant kernel, just by computing it at the center of the image (tickets DM-6243,
+        DM-6244). If it is set, `xcen` and `ycen` are ignored, and the returned struct also contains
+        `correctionKernels`, `xNodes` and `yNodes` (see `_doSpatiallyVaryingCorrection()`).
         @note We are also using a constant accross-the-image measure of sigma (sqrt(variance)) to compute
         the decorrelation kernel.
         @note Still TBD (ticket DM-6580): understand whether the convolution is correctly modifying
@@ -190,8 +473,9 @@ class DecorrelateALKernelTask(pipeBase.Task):
             xcen = (bbox.getBeginX() + bbox.getEndX()) / 2.
         if ycen is None:
             ycen = (bbox.getBeginY() + bbox.getEndY()) / 2.
-        self.log.info("Using matching kernel computed at (%d, %d)" % (xcen, ycen))
-        spatialKernel.computeImage(kimg, True, xcen, ycen)
+        if not self.config.spatiallyVarying:
+            self.log.info("Using matching kernel computed at (%d, %d)" % (xcen, ycen))
+            spatialKernel.computeImage(kimg, True, xcen, ycen)
 
         if False:  # debug code to save spatially varying kernel for analysis
             import pickle
@@ -208,25 +492,142 @@ class DecorrelateALKernelTask(pipeBase.Task):
         var = self.computeVarianceMean(subtractedExposure)
         self.log.info("Variance (uncorrected diffim): %f" % var)
 
-        corrKernel = DecorrelateALKernelTask._computeDecorrelationKernel(kimg.getArray(), svar, tvar)
-        self.log.info("Convolving.")
-        correctedExposure, corrKern = DecorrelateALKernelTask._doConvolve(subtractedExposure, corrKernel)
-        self.log.info("Updating correctedExposure and its PSF.")
+        if self.config.spatiallyVarying:
+            result = self._doSpatiallyVaryingCorrection(subtractedExposure, spatialKernel, svar, tvar)
+            correctedExposure, corrKern = result.correctedExposure, result.correctionKernel
+        else:
+            if self.config.applyInFourierSpace:
+                self.log.info("Applying decorrelation filter in Fourier space.")
+                correctedExposure, corrKernel = \
+                    DecorrelateALKernelTask._doDecorrelateInFourierSpace(subtractedExposure, kimg.getArray(),
+                                                                         svar, tvar, pool=self.exposurePool)
+                corrKern = DecorrelateALKernelTask._arrayToAfwKernel(corrKernel)
+            else:
+                kappa = kimg.getArray()
+                corrKernel = self.kernelCache.get(
+                    'decorrelationKernel', [kappa], [svar, tvar],
+                    lambda: DecorrelateALKernelTask._computeDecorrelationKernel(kappa, svar, tvar))
+                self.log.info("Convolving.")
+                correctedExposure, corrKern = DecorrelateALKernelTask._doConvolve(subtractedExposure,
+                                                                                  corrKernel,
+                                                                                  pool=self.exposurePool)
+            self.log.info("Updating correctedExposure and its PSF.")
+            self._updateCorrectedPsf(correctedExposure, subtractedExposure, corrKernel, svar, tvar)
+        self.log.info("Complete.")
 
-        # Compute the subtracted exposure's updated psf
+        var = self.computeVarianceMean(correctedExposure)
+        self.log.info("Variance (corrected diffim): %f" % var)
+
+        self.metadata.set("decorrelationKernelCacheHits", self.kernelCache.hits)
+        self.metadata.set("decorrelationKernelCacheMisses", self.kernelCache.misses)
+
+        return pipeBase.Struct(correctedExposure=correctedExposure, correctionKernel=corrKern)
+
+    def _updateCorrectedPsf(self, correctedExposure, subtractedExposure, corrKernel, svar, tvar):
+        """! Set the PSF of the decorrelated diffim, computed from that of the uncorrected diffim.
+        """
         psf = subtractedExposure.getPsf().computeImage().getArray()
-        psfc = DecorrelateALKernelTask.computeCorrectedDiffimPsf(corrKernel, psf, svar=svar, tvar=tvar)
+        psfc = self.kernelCache.get(
+            'correctedDiffimPsf', [corrKernel, psf], [svar, tvar],
+            lambda: DecorrelateALKernelTask.computeCorrectedDiffimPsf(corrKernel, psf, svar=svar, tvar=tvar))
         psfcI = afwImage.ImageD(psfc.shape[0], psfc.shape[1])
         psfcI.getArray()[:, :] = psfc
         psfcK = afwMath.FixedKernel(psfcI)
         psfNew = measAlg.KernelPsf(psfcK)
         correctedExposure.setPsf(psfNew)
-        self.log.info("Complete.")
 
-        var = self.computeVarianceMean(correctedExposure)
-        self.log.info("Variance (corrected diffim): %f" % var)
+    @pipeBase.timeMethod
+    def runBatch(self, inputs, nThreads=None):
+        """! Perform decorrelation of many image difference exposures, e.g. the CCDs of a visit.
 
-        return pipeBase.Struct(correctedExposure=correctedExposure, correctionKernel=corrKern)
+        The variance means and matching kernels of all inputs are computed concurrently, the
+        decorrelation kernels of all inputs with the same kernel dimensions are computed with a
+        single stacked FFT, and the convolutions (and PSF updates) are run concurrently on a
+        thread pool. The results are the same as calling `run()` on each input.
+
+        @param[in] inputs list of (exposure, templateExposure, subtractedExposure, psfMatchingKernel)
+        tuples, with the same meaning as the arguments of `run()`
+        @param[in] nThreads number of threads; if `None` (default), use `config.nThreads`
+
+        @return a list of `pipeBase.Struct`, one per input, each containing:
+            * `correctedExposure`: the decorrelated diffim
+            * `correctionKernel`: the decorrelation correction kernel (which may be ignored)
+            * `timing`: a dict of the wall-clock seconds spent on this input in the
+              `prepare`, `convolve` and `psf` steps
+
+        @note If `config.spatiallyVarying` is set, each input is simply passed to `run()` in turn (the
+        tiled convolution of each input is then itself multi-threaded).
+        """
+        if self.config.spatiallyVarying:
+            results = []
+            for exposure, templateExposure, subtractedExposure, psfMatchingKernel in inputs:
+                t0 = time.time()
+                result = self.run(exposure, templateExposure, subtractedExposure, psfMatchingKernel)
+                result.timing = dict(run=time.time() - t0)
+                results.append(result)
+            return results
+
+        nThreads = self.config.nThreads if nThreads is None else nThreads
+        pool = ThreadPool(nThreads) if nThreads > 1 else None
+        mapper = pool.map if pool is not None else lambda func, args: list(map(func, args))
+        self.log.info("Decorrelating %d diffims on %d thread(s)." % (len(inputs), nThreads))
+
+        def prepare(args):
+            exposure, templateExposure, subtractedExposure, psfMatchingKernel = args
+            t0 = time.time()
+            bbox = subtractedExposure.getBBox()
+            kimg = afwImage.ImageD(psfMatchingKernel.getDimensions())
+            psfMatchingKernel.computeImage(kimg, True, (bbox.getBeginX() + bbox.getEndX()) / 2.,
+                                           (bbox.getBeginY() + bbox.getEndY()) / 2.)
+            svar = self.computeVarianceMean(exposure)
+            tvar = self.computeVarianceMean(templateExposure)
+            return kimg.getArray().copy(), svar, tvar, dict(prepare=time.time() - t0)
+
+        try:
+            prepared = mapper(prepare, inputs)
+            kappas = [p[0] for p in prepared]
+            svars = np.array([p[1] for p in prepared])
+            tvars = np.array([p[2] for p in prepared])
+
+            corrKernels = [None] * len(inputs)
+            if not self.config.applyInFourierSpace:
+                for shape in set(kappa.shape for kappa in kappas):
+                    idx = [i for i, kappa in enumerate(kappas) if kappa.shape == shape]
+                    kernels = DecorrelateALKernelTask._computeDecorrelationKernels(
+                        np.array([kappas[i] for i in idx]), svars[idx], tvars[idx])
+                    for i, kernel in zip(idx, kernels):
+                        corrKernels[i] = kernel
+
+            def decorrelate(i):
+                subtractedExposure = inputs[i][2]
+                timing = prepared[i][3]
+                t0 = time.time()
+                if self.config.applyInFourierSpace:
+                    correctedExposure, corrKernel = DecorrelateALKernelTask._doDecorrelateInFourierSpace(
+                        subtractedExposure, kappas[i], svars[i], tvars[i], pool=self.exposurePool)
+                    corrKern = DecorrelateALKernelTask._arrayToAfwKernel(corrKernel)
+                else:
+                    corrKernel = corrKernels[i]
+                    correctedExposure, corrKern = DecorrelateALKernelTask._doConvolve(
+                        subtractedExposure, corrKernel, pool=self.exposurePool)
+                t1 = time.time()
+                self._updateCorrectedPsf(correctedExposure, subtractedExposure, corrKernel,
+                                         svars[i], tvars[i])
+                timing.update(convolve=t1 - t0, psf=time.time() - t1)
+                return pipeBase.Struct(correctedExposure=correctedExposure, correctionKernel=corrKern,
+                                       timing=timing)
+
+            results = mapper(decorrelate, range(len(inputs)))
+        finally:
+            if pool is not None:  # also stops the threads if a step raised
+                pool.terminate()
+                pool.join()
+
+        self.metadata.set("runBatchNumInputs", len(inputs))
+        self.metadata.set("runBatchNumThreads", nThreads)
+        self.metadata.set("decorrelationKernelCacheHits", self.kernelCache.hits)
+        self.metadata.set("decorrelationKernelCacheMisses", self.kernelCache.misses)
+        return results
 
     @staticmethod
     def _computeDecorrelationKernel(kappa, svar=0.04, tvar=0.04):
@@ -241,7 +642,7 @@ class DecorrelateALKernelTask(pipeBase.Task):
         """
         kappa = DecorrelateALKernelTask._fixOddKernel(kappa)
         kft = scipy.fftpack.fft2(kappa)
-        kft = np.sqrt((svar + tvar) / (svar + tvar * kft**2))
+        kft = np.sqrt((svar + tvar) / (svar + tvar * np.abs(kft)**2))
         pck = scipy.fftpack.ifft2(kft)
         pck = scipy.fftpack.ifftshift(pck.real)
         fkernel = DecorrelateALKernelTask._fixEvenKernel(pck)
@@ -253,10 +654,183 @@ class DecorrelateALKernelTask(pipeBase.Task):
 
         return fkernel
 
+    def _doSpatiallyVaryingCorrection(self, subtractedExposure, psfMatchingKernel, svar, tvar):
+        """! Decorrelate with a spatially-varying kernel.
+
+        The matching kernel is evaluated on a grid of `config.spatialGridSize` nodes spanning the
+        image, and the decorrelation kernels for all nodes are computed at once. The image
+        difference is then convolved tile by tile: the region of influence of each node (out to its
+        neighbouring nodes) is convolved with that node's kernel and weighted by the bilinear
+        interpolation weight of the node, and the weighted tiles are summed. Tiles are convolved
+        on `config.nThreads` threads. The corrected PSF is computed at each node and its spatial
+        variation is fit by a polynomial of order `config.spatialPsfOrder`.
+
+        @param subtractedExposure the image difference to be decorrelated
+        @param psfMatchingKernel the (spatially-varying) A&L PSF matching kernel
+        @param svar,tvar variances of the science and template images
+        @return a `pipeBase.Struct` containing:
+            * `correctedExposure`: the decorrelated diffim, with a spatially-varying PSF
+            * `correctionKernel`: the decorrelation kernel at the node closest to the image center
+            * `correctionKernels`: (ny, nx, h, w) array of the decorrelation kernels at the grid nodes
+            * `xNodes`, `yNodes`: the x- and y- pixel coordinates of the grid nodes
+        """
+        bbox = subtractedExposure.getBBox()
+        nx, ny = self.config.spatialGridSize
+
+        def nodes(begin, end, n):
+            if n <= 1:
+                return np.array([(begin + end) / 2.])
+            return np.linspace(begin, end - 1, n)
+
+        xNodes = nodes(bbox.getBeginX(), bbox.getEndX(), nx)
+        yNodes = nodes(bbox.getBeginY(), bbox.getEndY(), ny)
+        self.log.info("Computing decorrelation kernels on a %d x %d grid." % (len(xNodes), len(yNodes)))
+
+        kimg = afwImage.ImageD(psfMatchingKernel.getDimensions())
+        kappas = []
+        psfs = []
+        for y in yNodes:
+            for x in xNodes:
+                psfMatchingKernel.computeImage(kimg, True, x, y)
+                kappas.append(kimg.getArray().copy())
+                psfs.append(subtractedExposure.getPsf().computeKernelImage(afwGeom.Point2D(x, y)).getArray())
+        kappas = np.array(kappas)
+        corrKernels = self.kernelCache.get(
+            'decorrelationKernels', [kappas], [svar, tvar],
+            lambda: DecorrelateALKernelTask._computeDecorrelationKernels(kappas, svar, tvar))
+
+        # Bilinear (hat-function) weights of each node along each axis, for every pixel
+        def weights(nodes, begin, end):
+            coords = np.arange(begin, end)
+            if len(nodes) == 1:
+                return [np.ones(len(coords))]
+            return [np.interp(coords, nodes, np.eye(len(nodes))[i]) for i in range(len(nodes))]
+
+        xWeights = weights(xNodes, bbox.getBeginX(), bbox.getEndX())
+        yWeights = weights(yNodes, bbox.getBeginY(), bbox.getEndY())
+        maskedImage = subtractedExposure.getMaskedImage()
+        kernelRadius = max(corrKernels.shape[-2:]) // 2
+
+        def convolveTile(node):
+            j, i = node
+            wx, wy = xWeights[i], yWeights[j]
+            x0, x1 = np.nonzero(wx)[0][[0, -1]] + [0, 1]
+            y0, y1 = np.nonzero(wy)[0][[0, -1]] + [0, 1]
+            # Grow the tile so that the convolution is valid over the whole region of influence
+            gx0, gx1 = max(x0 - kernelRadius, 0), min(x1 + kernelRadius, bbox.getWidth())
+            gy0, gy1 = max(y0 - kernelRadius, 0), min(y1 + kernelRadius, bbox.getHeight())
+            tileBBox = afwGeom.Box2I(afwGeom.Point2I(int(bbox.getBeginX() + gx0), int(bbox.getBeginY() + gy0)),
+                                     afwGeom.Extent2I(int(gx1 - gx0), int(gy1 - gy0)))
+            tileIn = maskedImage.Factory(maskedImage, tileBBox, afwImage.PARENT)
+            tileOut = self.exposurePool.acquire(tileIn)
+            kern = DecorrelateALKernelTask._arrayToAfwKernel(corrKernels[j*len(xNodes) + i])
+            convCntrl = afwMath.ConvolutionControl(False, True, 0)
+            afwMath.convolve(tileOut, tileIn, kern, convCntrl)
+
+            img, msk, var = tileOut.getArrays()
+            sub = (slice(y0 - gy0, y1 - gy0), slice(x0 - gx0, x1 - gx0))
+            w = np.outer(wy[y0:y1], wx[x0:x1])
+            result = (slice(y0, y1), slice(x0, x1)), w * img[sub], w * var[sub], msk[sub] * (w > 0)
+            self.exposurePool.release(tileOut)
+            return result
+
+        outImg = np.zeros((bbox.getHeight(), bbox.getWidth()))
+        outVar = np.zeros_like(outImg)
+        outMsk = np.zeros(outImg.shape, dtype=maskedImage.getMask().getArray().dtype)
+        tiles = [(j, i) for j in range(len(yNodes)) for i in range(len(xNodes))]
+        self.log.info("Convolving %d tiles on %d thread(s)." % (len(tiles), self.config.nThreads))
+        pool = ThreadPool(self.config.nThreads) if self.config.nThreads > 1 else None
+        try:
+            for region, img, var, msk in (pool.imap_unordered(convolveTile, tiles) if pool is not None
+                                          else map(convolveTile, tiles)):
+                outImg[region] += img
+                outVar[region] += var
+                outMsk[region] |= msk
+        finally:
+            if pool is not None:  # also stops the threads if a tile raised
+                pool.terminate()
+                pool.join()
+
+        correctedExposure = self.exposurePool.acquire(subtractedExposure)  # Keeps WCS, PSF, etc.
+        correctedImg, correctedMsk, correctedVar = correctedExposure.getMaskedImage().getArrays()
+        correctedImg[:, :] = outImg
+        correctedVar[:, :] = outVar
+        correctedMsk[:, :] = outMsk
+
+        self.log.info("Updating correctedExposure and its PSF.")
+        psfcs = self.kernelCache.get(
+            'correctedDiffimPsfs', [kappas, np.array(psfs)], [svar, tvar],
+            lambda: kernelOps.computeCorrectedDiffimPsfs(kappas, np.array(psfs), svar=svar, tvar=tvar,
+                                                         fixOdd=False))
+        correctedExposure.setPsf(DecorrelateALKernelTask._makeSpatialKernelPsf(psfcs, xNodes, yNodes,
+                                                                                self.config.spatialPsfOrder))
+
+        xcen = (bbox.getBeginX() + bbox.getEndX()) / 2.
+        ycen = (bbox.getBeginY() + bbox.getEndY()) / 2.
+        iCen = np.argmin(np.abs(xNodes - xcen)) + len(xNodes) * np.argmin(np.abs(yNodes - ycen))
+        return pipeBase.Struct(correctedExposure=correctedExposure,
+                               correctionKernel=DecorrelateALKernelTask._arrayToAfwKernel(corrKernels[iCen]),
+                               correctionKernels=corrKernels.reshape((len(yNodes), len(xNodes)) +
+                                                                     corrKernels.shape[-2:]),
+                               xNodes=xNodes, yNodes=yNodes)
+
+    @staticmethod
+    def _computeDecorrelationKernels(kappas, svar=0.04, tvar=0.04):
+        """! Compute the decorrelation kernels for a stack of matching kernels.
+        Same as `_computeDecorrelationKernel()`, but with a single FFT (and inverse FFT)
+        of the whole (N, h, w) stack.
+
+        @param kappas  A (N, h, w) numpy.array of matching kernels
+        @param svar   Average variance of science image used for PSF matching (a scalar, or one per kernel)
+        @param tvar   Average variance of template image used for PSF matching (a scalar, or one per kernel)
+        @return a (N, h', w') numpy.array containing the correction kernels
+        """
+        kappas = kernelOps.fixOddKernels(kappas)
+        if np.ndim(svar) > 0:
+            svar = np.reshape(svar, (-1, 1, 1))
+        if np.ndim(tvar) > 0:
+            tvar = np.reshape(tvar, (-1, 1, 1))
+        kft = scipy.fftpack.fft2(kappas, axes=(-2, -1))
+        kft = np.sqrt((svar + tvar) / (svar + tvar * np.abs(kft)**2))
+        pck = scipy.fftpack.ifft2(kft, axes=(-2, -1))
+        pck = scipy.fftpack.ifftshift(pck.real, axes=(-2, -1))
+        return kernelOps.fixEvenKernels(pck)
+
+    @staticmethod
+    def _makeSpatialKernelPsf(psfs, xNodes, yNodes, order=1):
+        """! Make a spatially-varying PSF from PSF images computed on a grid of positions.
+
+        Each pixel of the PSF is fit as a polynomial in (x, y) over the grid nodes. The fitted
+        coefficient images become the basis of an `afwMath.LinearCombinationKernel`, whose
+        spatial functions are the corresponding `afwMath.PolynomialFunction2D` terms.
+
+        @param psfs  (ny*nx, h, w) numpy.array of PSF images, x varying fastest
+        @param xNodes,yNodes  the x- and y- pixel coordinates of the grid nodes
+        @param order  order of the spatial polynomial (reduced if the grid is too small)
+        @return a `measAlg.KernelPsf`
+        """
+        xx, yy = np.meshgrid(xNodes, yNodes)
+        xx, yy = xx.flatten(), yy.flatten()
+        while order > 0 and (order + 1) * (order + 2) // 2 > len(xx):
+            order -= 1
+        # PolynomialFunction2D terms are ordered 1, x, y, x^2, xy, y^2, ...
+        terms = [(n - k, k) for n in range(order + 1) for k in range(n + 1)]
+        design = np.array([xx**px * yy**py for px, py in terms]).T
+        coeffs = np.linalg.lstsq(design, psfs.reshape(len(psfs), -1))[0]
+
+        basisList = afwMath.KernelList()
+        for coeff in coeffs:
+            basisImg = afwImage.ImageD(psfs.shape[2], psfs.shape[1])
+            basisImg.getArray()[:, :] = coeff.reshape(psfs.shape[1:])
+            basisList.append(afwMath.FixedKernel(basisImg))
+        kernel = afwMath.LinearCombinationKernel(basisList, afwMath.PolynomialFunction2D(order))
+        kernel.setSpatialParameters(np.eye(len(terms)).tolist())
+        return measAlg.KernelPsf(kernel)
+
     @staticmethod
     def computeCorrectedDiffimPsf(kappa, psf, svar=0.04, tvar=0.04):
         """! Compute the (decorrelated) difference image's new PSF.
-        new_psf = psf(k) * sqrt((svar + tvar) / (svar + tvar * kappa_ft(k)**2))
+        new_psf = psf(k) * sqrt((svar + tvar) / (svar + tvar * |kappa_ft(k)|**2))
 
         @param kappa  A matching kernel array derived from Alard & Lupton PSF matching
         @param psf    The uncorrected psf array of the science image (and also of the diffim)
@@ -264,28 +838,7 @@ class DecorrelateALKernelTask(pipeBase.Task):
         @param tvar   Average variance of template image used for PSF matching
         @return a 2-d numpy.array containing the new PSF
         """
-        def post_conv_psf_ft2(psf, kernel, svar, tvar):
-            # Pad psf or kernel symmetrically to make them the same size!
-            # Note this assumes they are both square (width == height)
-            if psf.shape[0] < kernel.shape[0]:
-                diff = (kernel.shape[0] - psf.shape[0]) // 2
-                psf = np.pad(psf, (diff, diff), mode='constant')
-            elif psf.shape[0] > kernel.shape[0]:
-                diff = (psf.shape[0] - kernel.shape[0]) // 2
-                kernel = np.pad(kernel, (diff, diff), mode='constant')
-            psf_ft = scipy.fftpack.fft2(psf)
-            kft = scipy.fftpack.fft2(kernel)
-            out = psf_ft * np.sqrt((svar + tvar) / (svar + tvar * kft**2))
-            return out
-
-        def post_conv_psf(psf, kernel, svar, tvar):
-            kft = post_conv_psf_ft2(psf, kernel, svar, tvar)
-            out = scipy.fftpack.ifft2(kft)
-            return out
-
-        pcf = post_conv_psf(psf=psf, kernel=kappa, svar=svar, tvar=tvar)
-        pcf = pcf.real / pcf.real.sum()
-        return pcf
+        return kernelOps.computeCorrectedDiffimPsfs(kappa, psf, svar=svar, tvar=tvar, fixOdd=False)
 
     @staticmethod
     def _fixOddKernel(kernel):
@@ -296,17 +849,7 @@ class DecorrelateALKernelTask(pipeBase.Task):
         otherwise just return the input kernel.
         """
         # Note this works best for the FFT if we left-pad
-        out = kernel
-        changed = False
-        if (out.shape[0] % 2) == 1:
-            out = np.pad(out, ((1, 0), (0, 0)), mode='constant')
-            changed = True
-        if (out.shape[1] % 2) == 1:
-            out = np.pad(out, ((0, 0), (1, 0)), mode='constant')
-            changed = True
-        if changed:
-            out *= (np.mean(kernel) / np.mean(out))  # need to re-scale to same mean for FFT
-        return out
+        return kernelOps.fixOddKernels(kernel)
 
     @staticmethod
     def _fixEvenKernel(kernel):
@@ -314,42 +857,78 @@ class DecorrelateALKernelTask(pipeBase.Task):
         @param kernel a numpy.array
         @return a fixed kernel numpy.array
         """
-        # Make sure the peak (close to a delta-function) is in the center!
-        maxloc = np.unravel_index(np.argmax(kernel), kernel.shape)
-        out = np.roll(kernel, kernel.shape[0]//2 - maxloc[0], axis=0)
-        out = np.roll(out, out.shape[1]//2 - maxloc[1], axis=1)
-        # Make sure it is odd-dimensioned by trimming it.
-        if (out.shape[0] % 2) == 0:
-            maxloc = np.unravel_index(np.argmax(out), out.shape)
-            if out.shape[0] - maxloc[0] > maxloc[0]:
-                out = out[:-1, :]
-            else:
-                out = out[1:, :]
-            if out.shape[1] - maxloc[1] > maxloc[1]:
-                out = out[:, :-1]
-            else:
-                out = out[:, 1:]
-        return out
+        # Make sure the peak (close to a delta-function) is in the center, and it is odd-dimensioned.
+        return kernelOps.fixEvenKernels(kernel)
 
     @staticmethod
-    def _doConvolve(exposure, kernel):
+    def _doConvolve(exposure, kernel, pool=None):
         """! Convolve an Exposure with a decorrelation convolution kernel.
         @param exposure Input afw.image.Exposure to be convolved.
         @param kernel Input 2-d numpy.array to convolve the image with
+        @param pool An optional ExposurePool from which to take the output Exposure
         @return a new Exposure with the convolved pixels and the (possibly
         re-centered) kernel.
 
         @note We use afwMath.convolve() but keep scipy.convolve for debugging.
         @note We re-center the kernel if necessary and return the possibly re-centered kernel
         """
+        kern = DecorrelateALKernelTask._arrayToAfwKernel(kernel)
+        if pool is not None:
+            outExp = pool.acquire(exposure)  # All pixel planes are written by convolve()
+        else:
+            outExp = exposure.clone()  # Do this to keep WCS, PSF, masks, etc.
+        convCntrl = afwMath.ConvolutionControl(False, True, 0)
+        afwMath.convolve(outExp.getMaskedImage(), exposure.getMaskedImage(), kern, convCntrl)
+
+        return outExp, kern
+
+    @staticmethod
+    def _doDecorrelateInFourierSpace(exposure, kappa, svar=0.04, tvar=0.04, pool=None):
+        """! Decorrelate an Exposure by filtering it in Fourier space.
+
+        The image is zero-padded by the kernel size (to a fast FFT size), its transform is
+        multiplied by the decorrelation filter sqrt((svar + tvar) / (svar + tvar * |kappa_ft|**2))
+        (a kernelOps.DecorrelationFilter at the padded size), and it is transformed back once.
+        The variance plane is convolved the same way with the square of the (real-space)
+        decorrelation kernel.
+        As the filter is real and even, no trimming or re-centering of the kernel is needed.
+
+        @param exposure Input afw.image.Exposure to be decorrelated
+        @param kappa  A matching kernel 2-d numpy.array derived from Alard & Lupton PSF matching
+        @param svar   Average variance of science image used for PSF matching
+        @param tvar   Average variance of template image used for PSF matching
+        @param pool   An optional ExposurePool from which to take the output Exposure
+        @return a new Exposure with the decorrelated pixels, and the decorrelation kernel
+        (trimmed to the kappa size, made odd) as a 2-d numpy.array
+
+        @note Non-finite image pixels are set to zero for the FFT, and remain NaN in the output.
+        """
+        img, _, var = exposure.getMaskedImage().getArrays()
+        filt = kernelOps.DecorrelationFilter(kappa, svar, tvar,
+                                             shape=kernelOps.paddedShape(img.shape, kappa.shape))
+
+        if pool is not None:
+            outExp = pool.acquire(exposure, copyMask=True)
+        else:
+            outExp = exposure.clone()  # Do this to keep WCS, PSF, masks, etc.
+        outImg, _, outVar = outExp.getMaskedImage().getArrays()
+        outImg[:, :] = kernelOps.filterArray(img, filt.filter)
+        outVar[:, :] = kernelOps.filterArray(var, filt.varianceFilter)
+
+        # Return the kernel in real space, centered, for reference.
+        corrKernel = filt.kernel()
+        return outExp, corrKernel
+
+    @staticmethod
+    def _arrayToAfwKernel(kernel):
+        """! Make an afwMath.FixedKernel from a 2-d numpy.array, centered on its peak.
+        @param kernel Input 2-d numpy.array
+        @return an afwMath.FixedKernel
+        """
         kernelImg = afwImage.ImageD(kernel.shape[0], kernel.shape[1])
         kernelImg.getArray()[:, :] = kernel
         kern = afwMath.FixedKernel(kernelImg)
         maxloc = np.unravel_index(np.argmax(kernel), kernel.shape)
         kern.setCtrX(maxloc[0])
         kern.setCtrY(maxloc[1])
-        outExp = exposure.clone()  # Do this to keep WCS, PSF, masks, etc.
-        convCntrl = afwMath.ConvolutionControl(False, True, 0)
-        afwMath.convolve(outExp.getMaskedImage(), exposure.getMaskedImage(), kern, convCntrl)
-
-        return outExp, kern
+        return kern
@@ -0,0 +1,372 @@
+from __future__ import absolute_import, division, print_function
+
+# Image statistics that work on very large (e.g. memmapped full-CCD) arrays.
+# Inputs are read in chunks (blocks of rows of an array, or a sequence of arrays), and NaN/inf and
+# `ignore` values are excluded through a single per-chunk mask, so that no full-size masks are
+# made. Only the exact clipped statistics (the default) keep a (compacted) copy of the good values.
+
+import collections
+import hashlib
+import threading
+
+import numpy as np
+import scipy.fftpack
+
+__all__ = ("iterChunks", "clippedStats", "PixelCovariance", "pixelCovariance",
+           "zscale")
+
+
+def iterChunks(im, chunkSize=1 << 20):
+    """! Iterate over an image as flat chunks of about `chunkSize` pixels.
+    @param im a numpy.array (blocks of rows are views, so memmaps are read lazily), or a
+    list/tuple of arrays which are taken as the chunks
+    """
+    if isinstance(im, (list, tuple)):
+        for chunk in im:
+            for c in iterChunks(np.asarray(chunk), chunkSize):
+                yield c
+        return
+    im = np.asarray(im)
+    if im.ndim < 2:
+        im = im.reshape(-1)
+        for i in range(0, im.size, chunkSize):
+            yield im[i:i + chunkSize]
+        return
+    rowSize = im.size // im.shape[0] if im.shape[0] > 0 else 1
+    nRows = max(1, chunkSize // max(rowSize, 1))
+    for i in range(0, im.shape[0], nRows):
+        yield im[i:i + nRows].ravel()
+
+
+def _goodMask(chunk, ignore):
+    good = np.isfinite(chunk)
+    if ignore is not None and len(ignore) > 0:
+        good &= ~np.in1d(chunk, ignore).reshape(chunk.shape)
+    return good
+
+
+class _Moments(object):
+    """! Running count, shifted sum and sum of squares (and extrema) of values.
+    """
+
+    def __init__(self, shift=0.):
+        self.shift = shift
+        self.n, self.s, self.ss = 0, 0., 0.
+        self.min, self.max = np.inf, -np.inf
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        d = values - self.shift
+        self.n += len(d)
+        self.s += d.sum()
+        self.ss += np.dot(d, d)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    @property
+    def mean(self):
+        return self.shift + self.s / self.n if self.n > 0 else np.nan
+
+    @property
+    def std(self):
+        if self.n == 0:
+            return np.nan
+        return np.sqrt(max(self.ss / self.n - (self.s / self.n)**2, 0.))
+
+
+def _viewMeanStd(values):
+    """! Mean and std. dev. of `values` from their sum and sum of squares, with no temporary arrays.
+    """
+    n = len(values)
+    if n == 0:
+        return np.nan, np.nan
+    mean = values.sum() / n
+    return mean, np.sqrt(max(np.dot(values, values) / n - mean**2, 0.))
+
+
+def _clipHistogram(counts, sums, sumsqs, edges, shift, lo, hi, low, high, maxIter):
+    """! Run the `scipy.stats.sigmaclip` iteration on a histogram holding the count, sum and
+    sum of squares of the values (less `shift`, as are `edges`, `lo` and `hi`) in each bin. Bins
+    straddling a threshold contribute in proportion to the fraction of the bin inside it.
+    @return the final (lower, upper) thresholds
+    """
+    width = edges[1] - edges[0]
+    lower, upper = edges[:-1], edges[1:]
+
+    def moments(lo, hi):
+        frac = np.clip((np.minimum(upper, hi) - np.maximum(lower, lo)) / width, 0., 1.)
+        n = np.dot(frac, counts)
+        if n <= 0:
+            return n, np.nan, np.nan
+        mean = np.dot(frac, sums) / n
+        return n, mean, np.sqrt(max(np.dot(frac, sumsqs) / n - mean**2, 0.))
+
+    n, mean, std = moments(lo, hi)
+    newLo, newHi = lo, hi
+    for i in range(maxIter):
+        newLo, newHi = mean - std * low, mean + std * high
+        # As in sigmaclip, each iteration clips the previously clipped values, so the range only shrinks.
+        lo, hi = max(lo, newLo), min(hi, newHi)
+        nNew, mean, std = moments(lo, hi)
+        if abs(nNew - n) < 0.5 or nNew <= 0:
+            break
+        n = nNew
+    return shift + newLo, shift + newHi
+
+
+def clippedStats(im, low=3., high=3., ignore=None, method='exact', nBins=65536, chunkSize=1 << 20,
+                 maxIter=50):
+    """! Sigma-clipped mean and standard deviation of an image, as `scipy.stats.sigmaclip` followed
+    by the mean and std. of the values strictly inside the final clipping thresholds.
+
+    @param im       the image: a numpy.array (or memmap), or a list of arrays taken as its chunks
+    @param low      lower clipping threshold in units of the std. dev. (0 disables clipping)
+    @param high     upper clipping threshold in units of the std. dev. (0 disables clipping)
+    @param ignore   sequence of values (e.g. 0.) to exclude, along with NaNs and infs
+    @param method   'exact' (the default): one pass over the chunks to gather a compacted copy of
+                    the good values, on which `scipy.stats.sigmaclip` is reproduced exactly. This
+                    copy (as float64) is the only one: it is sorted in place, and each clipping
+                    iteration takes the values between its thresholds as a slice of it.
+                    'histogram': no copy of the image, but three passes over the chunks: the
+                    moments of all good values, then a `nBins` histogram of the values inside the
+                    first-iteration thresholds (which bound all later ones) on which the clipping
+                    is iterated, and the statistics of the pixels inside the final thresholds.
+                    As the thresholds are found from the histogram, the result is approximate:
+                    pixels close to a threshold may be clipped differently than by 'exact'.
+    @param chunkSize approximate number of pixels read at a time
+    @param maxIter  maximum number of clipping iterations (0 disables clipping)
+    @return the clipped mean, the clipped std. dev., and the min and max of all good values
+    """
+    if method not in ('exact', 'histogram'):
+        raise ValueError('Unknown clipping method: %s' % method)
+    if ignore is not None:
+        ignore = np.atleast_1d(ignore)
+    noClip = low == 0 or high == 0 or maxIter <= 0
+
+    if method == 'exact':
+        # The one copy: the good values, compacted, sorted in place and shifted by their median (to
+        # keep the sums of squares well-conditioned). Each clipped set is then a slice (a view) of it.
+        values = np.concatenate([chunk[_goodMask(chunk, ignore)] for chunk in iterChunks(im, chunkSize)])
+        if len(values) == 0:
+            return np.nan, np.nan, np.nan, np.nan
+        values = values.astype(np.float64, copy=False)
+        values.sort()
+        vmin, vmax = values[0], values[-1]
+        shift = values[len(values) // 2]
+        values -= shift
+        mean, std = _viewMeanStd(values)
+        if noClip or vmin == vmax:
+            return shift + mean, std, vmin, vmax
+        i, j = 0, len(values)
+        for _ in range(maxIter):
+            cmean, cstd = _viewMeanStd(values[i:j])
+            lo, hi = cmean - cstd * low, cmean + cstd * high
+            i2 = max(i, np.searchsorted(values, lo, side='left'))
+            j2 = min(j, np.searchsorted(values, hi, side='right'))
+            if (i2, j2) == (i, j):
+                break
+            i, j = i2, j2
+        if np.isnan(lo) or np.isnan(hi) or lo == hi:
+            return shift + mean, std, vmin, vmax
+        cmean, cstd = _viewMeanStd(values[np.searchsorted(values, lo, side='right'):
+                                          np.searchsorted(values, hi, side='left')])
+        return shift + cmean, cstd, vmin, vmax
+
+    # Pass 1: moments and extrema of all good values. The shift (the first good value) keeps the
+    # sums of squares well-conditioned.
+    total = None
+    for chunk in iterChunks(im, chunkSize):
+        values = chunk[_goodMask(chunk, ignore)].astype(np.float64)
+        if total is None and len(values) > 0:
+            total = _Moments(shift=values[0])
+        if total is not None:
+            total.add(values)
+    if total is None:
+        return np.nan, np.nan, np.nan, np.nan
+    if noClip or total.min == total.max:
+        return total.mean, total.std, total.min, total.max
+
+    # Pass 2: histogram of the values inside the first-iteration thresholds.
+    lo, hi = total.mean - total.std * low, total.mean + total.std * high
+    edges = np.linspace(lo, hi, nBins + 1)
+    counts, sums, sumsqs = np.zeros(nBins), np.zeros(nBins), np.zeros(nBins)
+    for chunk in iterChunks(im, chunkSize):
+        values = chunk[_goodMask(chunk, ignore)].astype(np.float64)
+        values = values[(values >= lo) & (values <= hi)]
+        idx = np.minimum(((values - lo) * (nBins / (hi - lo))).astype(np.intp), nBins - 1)
+        d = values - total.shift
+        counts += np.bincount(idx, minlength=nBins)
+        sums += np.bincount(idx, weights=d, minlength=nBins)
+        sumsqs += np.bincount(idx, weights=d**2, minlength=nBins)
+    lo, hi = _clipHistogram(counts, sums, sumsqs, edges - total.shift, total.shift,
+                            lo - total.shift, hi - total.shift, low, high, maxIter)
+
+    if np.isnan(lo) or np.isnan(hi) or lo == hi:
+        return total.mean, total.std, total.min, total.max
+
+    # Pass 3: exact statistics of the values strictly inside the thresholds.
+    clipped = _Moments(shift=total.shift)
+    for chunk in iterChunks(im, chunkSize):
+        values = chunk[_goodMask(chunk, ignore)].astype(np.float64)
+        clipped.add(values[(values > lo) & (values < hi)])
+    return clipped.mean, clipped.std, total.min, total.max
+
+
+class PixelCovariance(object):
+    """!
+    \\brief Pixel auto- (or cross-) covariance of images to any lag, accumulated over tiles via FFT
+
+    For each lag l = (dy, dx) up to +/-`maxLag`, accumulates over all pairs of good pixels
+    (q, q + l) within each tile that is added the sums x(q)*y(q+l), x(q), y(q+l) and the number of
+    pairs, each as a zero-padded FFT correlation, so the cost is O(N log N) whatever `maxLag` is.
+    The covariance is then sum(xy)/n - sum(x)/n * sum(y)/n at each lag, so that tiles (with or
+    without masked pixels) can be added one at a time. Pairs straddling two tiles are not counted.
+
+    If `circular`, the tiles are not zero-padded, so lags wrap around (as with `np.roll`); for one
+    unmasked tile this gives exactly the `np.cov(..., bias=1)` of the shifted images.
+    """
+
+    def __init__(self, maxLag=5, circular=False):
+        self.maxLag, self.circular = maxLag, circular
+        size = 2 * maxLag + 1
+        self.sxy, self.sx, self.sy, self.n = (np.zeros((size, size)) for i in range(4))
+        self.shift = None
+
+    def _correlate(self, a_hat, b_hat):
+        # sum_q a(q) b(q + l) for |l| <= maxLag, from the FFTs of a and b
+        corr = scipy.fftpack.ifft2(np.conj(a_hat) * b_hat).real
+        rows = np.arange(-self.maxLag, self.maxLag + 1) % corr.shape[0]
+        cols = np.arange(-self.maxLag, self.maxLag + 1) % corr.shape[1]
+        return corr[rows[:, None], cols[None, :]]
+
+    def add(self, tile, tile2=None, mask=None):
+        """! Add the pixel pairs within a tile.
+        @param tile   2-d numpy.array
+        @param tile2  2-d numpy.array of the same shape, for the cross-covariance of `tile` with it
+        @param mask   boolean array, True for pixels to exclude (NaNs and infs are always excluded)
+        """
+        good = np.isfinite(tile)
+        if tile2 is not None:
+            good &= np.isfinite(tile2)
+        if mask is not None:
+            good &= ~np.asarray(mask, dtype=bool)
+        if not good.any():
+            return
+        if self.shift is None:
+            # A common shift keeps the sums well-conditioned, and must be the same for all tiles.
+            self.shift = (tile[good].mean(), tile2[good].mean() if tile2 is not None else None)
+        shape = tile.shape if self.circular else \
+            [scipy.fftpack.next_fast_len(int(n + self.maxLag)) for n in tile.shape]
+        m = good.astype(np.float64)
+        x = np.where(good, tile - self.shift[0], 0.)
+        m_hat, x_hat = scipy.fftpack.fft2(m, shape), scipy.fftpack.fft2(x, shape)
+        if tile2 is None:
+            y_hat = x_hat
+        else:
+            y_hat = scipy.fftpack.fft2(np.where(good, tile2 - self.shift[1], 0.), shape)
+        self.sxy += self._correlate(x_hat, y_hat)
+        self.sx += self._correlate(x_hat, m_hat)
+        self.sy += self._correlate(m_hat, y_hat)
+        self.n += np.round(self._correlate(m_hat, m_hat))
+
+    @property
+    def covariance(self):
+        """! The (2*maxLag+1, 2*maxLag+1) covariance, indexed by [dy + maxLag, dx + maxLag].
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sxy / self.n - (self.sx / self.n) * (self.sy / self.n)
+
+
+def pixelCovariance(im, im2=None, maxLag=5, mask=None, tileSize=None, circular=False):
+    """! Pixel auto-covariance of an image (or its cross-covariance with `im2`) at all lags up to
+    +/-`maxLag` in each axis. See `PixelCovariance`.
+    @param tileSize if not None, accumulate over (tileSize x tileSize) tiles (views of `im`,
+    so it may be a memmap), rather than one FFT of the whole image
+    @return the covariance as a (2*maxLag+1, 2*maxLag+1) numpy.array indexed by [dy + maxLag, dx + maxLag]
+    """
+    cov = PixelCovariance(maxLag, circular=circular)
+    tileSize = np.shape(im) if tileSize is None else np.broadcast_to(tileSize, 2)
+    for i in range(0, im.shape[0], tileSize[0]):
+        for j in range(0, im.shape[1], tileSize[1]):
+            sl = (slice(i, i + tileSize[0]), slice(j, j + tileSize[1]))
+            cov.add(im[sl], im2[sl] if im2 is not None else None,
+                    mask[sl] if mask is not None else None)
+    return cov.covariance
+
+
+_zscaleCache = collections.OrderedDict()
+_zscaleCacheLock = threading.Lock()
+
+
+def zscale(image, nSamples=1000, contrast=0.25, maxReject=0.5, minNPixels=5, krej=2.5, maxIterations=5,
+           cacheSize=256):
+    """! Display limits as computed by the IRAF/ds9 zscale algorithm.
+
+    A line is fit (with iterative `krej`-sigma rejection, growing rejected regions by 1% of the
+    sample) to the sorted values of a regular strided sample of about `nSamples` finite pixels;
+    the limits are the median -/+ the range spanned by the line's slope over the sample, divided by
+    `contrast`, clipped to the sample's min and max.
+
+    The sample is sorted once (a full sort, as the line is fit to all of its sorted values; the
+    median is read from it). Only the sample is read (never a copy or sort of the whole image),
+    and the result is cached on the sample's values and the parameters, so redrawing the same
+    image costs only the sampling.
+    @return z1, z2
+    """
+    image = np.asarray(image)
+    if image.ndim != 2:
+        image = image.reshape(1, -1)
+    stride = max(1, int(np.sqrt(image.shape[0] * image.shape[1] / float(nSamples))))
+    samples = image[::stride, ::stride].ravel()
+    samples = samples[np.isfinite(samples)].astype(np.float64)
+
+    key = (hashlib.sha1(samples.tobytes()).hexdigest(), nSamples, contrast, maxReject, minNPixels, krej,
+           maxIterations)
+    with _zscaleCacheLock:
+        if key in _zscaleCache:
+            _zscaleCache[key] = _zscaleCache.pop(key)  # most recently used
+            return _zscaleCache[key]
+
+    npix = len(samples)
+    if npix == 0:
+        return np.nan, np.nan
+    samples.sort()
+    center = (npix - 1) // 2
+    median = samples[center] if npix % 2 == 1 else 0.5 * (samples[center] + samples[center + 1])
+    zmin, zmax = samples[0], samples[-1]
+    result = (zmin, zmax)
+
+    x = np.arange(npix)
+    good = np.ones(npix, dtype=bool)
+    minpix = max(minNPixels, int(npix * maxReject))
+    ngrow = max(1, int(npix * 0.01))
+    nGood = npix
+    fit = None
+    for i in range(maxIterations):
+        if nGood < minpix:
+            break
+        fit = np.polyfit(x[good], samples[good], 1)
+        flat = samples - np.polyval(fit, x)
+        sigma = flat[good].std()
+        if sigma <= 1e-12 * np.abs(samples[good]).max():  # an exact line, up to rounding errors
+            break
+        threshold = krej * sigma
+        bad = ~good | (flat < -threshold) | (flat > threshold)
+        # Grow the rejected pixels by `ngrow` on either side
+        bad = np.convolve(bad, np.ones(2 * ngrow + 1), mode='same') > 0
+        good = ~bad
+        nGoodNew = good.sum()
+        if nGoodNew == nGood:
+            break
+        nGood = nGoodNew
+
+    if fit is not None and nGood >= minpix:
+        slope = fit[0] / contrast if contrast > 0 else fit[0]
+        result = (max(zmin, median - center * slope), min(zmax, median + (npix - 1 - center) * slope))
+
+    with _zscaleCacheLock:
+        _zscaleCache[key] = result
+        while len(_zscaleCache) > cacheSize:
+            _zscaleCache.popitem(last=False)
+    return result
@@ -0,0 +1,259 @@
+from __future__ import absolute_import, division, print_function
+
+# Operations on stacks of kernel (or PSF) images, shared by diffimTests and imageDecorrelation.
+# All functions accept a single 2-d kernel or an (N, h, w) (or more generally (..., h, w)) stack,
+# and operate on the last two axes. Padding and re-centering are done by index arithmetic into a
+# single output array, rather than with np.pad/np.roll copies.
+
+import numpy as np
+import scipy.fftpack
+
+__all__ = ("padKernels", "fixOddKernels", "fixEvenKernels", "computeCorrectedDiffimPsfs", "kernelFT",
+           "splitFT", "centeredInverseFT", "paddedShape", "filterArray", "DecorrelationFilter")
+
+
+def padKernels(kernels, shape):
+    """! Zero-pad (or trim) kernels symmetrically to `shape`, keeping their centers at shape//2.
+    @param kernels a (..., h, w) numpy.array
+    @param shape the new (h', w')
+    @return a (..., h', w') numpy.array; the input itself if its shape is already `shape`
+    """
+    kernels = np.asarray(kernels)
+    shape = tuple(shape[-2:])
+    if kernels.shape[-2:] == shape:
+        return kernels
+    out = np.zeros(kernels.shape[:-2] + shape, dtype=kernels.dtype)
+    src, dst = [Ellipsis], [Ellipsis]
+    for axis in (-2, -1):
+        before = shape[axis]//2 - kernels.shape[axis]//2
+        n = min(kernels.shape[axis], shape[axis])
+        src.append(slice(max(-before, 0), max(-before, 0) + n))
+        dst.append(slice(max(before, 0), max(before, 0) + n))
+    out[tuple(dst)] = kernels[tuple(src)]
+    return out
+
+
+def fixOddKernels(kernels):
+    """! Take kernels with odd dimensions and make them even for FFT, by left-padding with zeros.
+
+    @param kernels a (..., h, w) numpy.array
+    @return the fixed kernels. Returns a new array if the dimensions needed to change (re-scaled
+    to the same mean, as the FFT expects); otherwise just return the input kernels.
+    """
+    kernels = np.asarray(kernels)
+    h, w = kernels.shape[-2:]
+    if h % 2 == 0 and w % 2 == 0:
+        return kernels
+    out = np.zeros(kernels.shape[:-2] + (h + h % 2, w + w % 2), dtype=kernels.dtype)
+    out[..., h % 2:, w % 2:] = kernels
+    out *= (out.shape[-2] * out.shape[-1]) / (h * w)  # need to re-scale to same mean for FFT
+    return out
+
+
+def fixEvenKernels(kernels):
+    """! Take kernels with even dimensions and make them odd, centered correctly.
+
+    Each kernel is circularly shifted to put its peak (close to a delta-function) in the center
+    and, if it has an even number of rows, trimmed by one row and one column. The shift and trim
+    are done with a single gather per stack.
+
+    @param kernels a (..., h, w) numpy.array
+    @return a (..., h', w') numpy.array of the fixed kernels
+    """
+    kernels = np.asarray(kernels)
+    h, w = kernels.shape[-2:]
+    flat = kernels.reshape((-1, h, w))
+    maxloc = np.argmax(flat.reshape((len(flat), -1)), axis=1)
+    shiftY = h//2 - maxloc // w
+    shiftX = w//2 - maxloc % w
+
+    # After the shift the peak is at (h//2, w//2); trim the row (and column) on its shorter side.
+    rowStart = colStart = 0
+    outH, outW = h, w
+    if h % 2 == 0:
+        rowStart = 0 if h - h//2 > h//2 else 1
+        colStart = 0 if w - w//2 > w//2 else 1
+        outH, outW = h - 1, w - 1
+
+    rows = (np.arange(outH) + rowStart - shiftY[:, None]) % h
+    cols = (np.arange(outW) + colStart - shiftX[:, None]) % w
+    out = flat[np.arange(len(flat))[:, None, None], rows[:, :, None], cols[:, None, :]]
+    return out.reshape(kernels.shape[:-2] + (outH, outW))
+
+
+def computeCorrectedDiffimPsfs(kappas, psfs, svar=0.04, tvar=0.04, fixOdd=True):
+    """! Compute the (decorrelated) difference images' new PSFs, for all kernels at once.
+    new_psf = psf(k) * sqrt((svar + tvar) / (svar + tvar * |kappa_ft(k)|**2))
+
+    @param kappas  (..., h, w) numpy.array of matching kernels derived from Alard & Lupton PSF matching
+    @param psfs    (..., h, w) numpy.array of the uncorrected psfs of the science images (and diffims)
+    @param svar    Average variance of science image used for PSF matching (a scalar, or one per kernel)
+    @param tvar    Average variance of template image used for PSF matching (a scalar, or one per kernel)
+    @param fixOdd  Make odd-sized kernels and psfs even (with fixOddKernels()) before the FFT
+    @return a (..., h', w') numpy.array containing the new PSFs, each normalized to unit sum
+
+    @note The psfs or kernels are first zero-padded about their centers to the same size.
+    """
+    kappas, psfs = np.asarray(kappas), np.asarray(psfs)
+    shape = np.maximum(kappas.shape[-2:], psfs.shape[-2:])
+    kappas, psfs = padKernels(kappas, shape), padKernels(psfs, shape)
+    if fixOdd:
+        psfs, kappas = fixOddKernels(psfs), fixOddKernels(kappas)
+    if np.ndim(svar) > 0:
+        svar = np.reshape(svar, np.shape(svar) + (1, 1))
+    if np.ndim(tvar) > 0:
+        tvar = np.reshape(tvar, np.shape(tvar) + (1, 1))
+
+    psf_ft = scipy.fftpack.fft2(psfs, axes=(-2, -1))
+    kft = scipy.fftpack.fft2(kappas, axes=(-2, -1))
+    pcf = scipy.fftpack.ifft2(psf_ft * np.sqrt((svar + tvar) / (svar + tvar * np.abs(kft)**2)),
+                              axes=(-2, -1)).real
+    return pcf / pcf.sum(axis=(-2, -1), keepdims=True)
+
+
+def kernelFT(kernel, shape):
+    """! FFT of kernels zero-padded to `shape`, with each kernel's center pixel (h//2, w//2) placed
+    at the origin, so that multiplying by it is a convolution that does not shift the image.
+    @param kernel a (..., h, w) numpy.array (complex kernels a + 1j*b give the transforms of two
+    real kernels at once, see splitFT())
+    @param shape the (padded) shape of the FFT
+    """
+    kernel = np.asarray(kernel)
+    h, w = kernel.shape[-2:]
+    kpad = np.zeros(kernel.shape[:-2] + tuple(shape), dtype=np.result_type(kernel, np.float64))
+    rows = (np.arange(h) - h//2) % shape[0]
+    cols = (np.arange(w) - w//2) % shape[1]
+    kpad[..., rows[:, None], cols[None, :]] = kernel
+    return scipy.fftpack.fft2(kpad, axes=(-2, -1))
+
+
+def splitFT(arr_hat):
+    """! Separate the FFTs of two real arrays `a` and `b` from the single complex FFT of a + 1j*b,
+    using the Hermitian symmetry of the transform of a real array.
+    @param arr_hat a (..., h, w) numpy.array, the FFT of a + 1j*b (e.g. from kernelFT())
+    @return the FFTs of `a` and of `b`
+    """
+    h, w = arr_hat.shape[-2:]
+    conjRev = np.conj(arr_hat[..., (-np.arange(h)) % h, :][..., (-np.arange(w)) % w])
+    return 0.5 * (arr_hat + conjRev), -0.5j * (arr_hat - conjRev)
+
+
+def centeredInverseFT(arr_hat, size):
+    """! Inverse FFT of an origin-centered transform, returned centered in an array of `size`.
+    """
+    arr = scipy.fftpack.ifft2(arr_hat, axes=(-2, -1)).real
+    rows = (np.arange(size[0]) - size[0]//2) % arr.shape[-2]
+    cols = (np.arange(size[1]) - size[1]//2) % arr.shape[-1]
+    return arr[..., rows[:, None], cols[None, :]]
+
+
+def paddedShape(imShape, kernelShape):
+    """! A fast FFT shape for an image zero-padded by twice the kernel size, large enough that
+    filtering it with the kernel (or a filter of the kernel's extent) does not wrap around.
+    """
+    return tuple(scipy.fftpack.next_fast_len(int(imShape[i] + 2*kernelShape[i])) for i in range(2))
+
+
+def filterArray(arr, filt_hat):
+    """! Multiply the FFT of a 2-d array, zero-padded to the shape of `filt_hat`, by `filt_hat` and
+    transform back, trimmed to the shape of the array.
+    Non-finite pixels are zeroed for the FFT and remain NaN in the output.
+    """
+    good = np.isfinite(arr)
+    out = scipy.fftpack.fft2(np.where(good, arr, 0.), shape=np.shape(filt_hat)[-2:])
+    out = scipy.fftpack.ifft2(out * filt_hat).real[:arr.shape[0], :arr.shape[1]]
+    out[~good] = np.nan
+    return out
+
+
+class DecorrelationFilter(object):
+    """!
+    \\brief The A&L decorrelation filter, with optional pre-convolution, and everything derived from it
+
+    Holds the FFTs of the matching kernel kappa, the pre-convolution kernel and the PSF of the
+    science image, all at one common (fast) size, and computes from them (lazily, each only once):
+        * `filter`: sqrt((svar + tvar + delta) / (svar * |pc_ft|**2 + tvar * |kappa_ft|**2 + delta))
+        * `kernel()`: the real-space decorrelation kernel
+        * `correctedPsf()`: the PSF of the decorrelated diffim, psf * pc * filter in Fourier space
+          (the pre-convolution is included, as the diffim is pc (x) im2 - kappa (x) im1)
+        * `varianceFilter`: the FFT of the decorrelation kernel squared, to propagate variance planes
+    If the pre-convolution kernel is the PSF (as in `DiffimTest.doALInStack`) their FFT is shared,
+    so pre-convolution costs no more FFTs than plain decorrelation.
+    With `shape=paddedShape(imageShape, kernelShape)` (see `atImageShape()`) the `filter` and
+    `varianceFilter` can be applied to whole image and variance planes with `filterArray()`.
+    """
+
+    def __init__(self, kappa, svar=0.04, tvar=0.04, preConvKernel=None, psf=None, delta=0., shape=None):
+        self.kappa, self.preConvKernel, self.psf = kappa, preConvKernel, psf
+        self.svar, self.tvar, self.delta = svar, tvar, delta
+        sizes = [k.shape for k in (kappa, preConvKernel, psf) if k is not None]
+        if shape is None:
+            shape = [scipy.fftpack.next_fast_len(int(n)) for n in np.max(sizes, axis=0)]
+        self.shape = tuple(shape)
+        self.kernelSize = tuple(n | 1 for n in np.max(sizes[:2] if preConvKernel is not None else sizes[:1],
+                                                      axis=0))
+        self._cache = {}
+
+    def atImageShape(self, imageShape):
+        """! A new filter of the same kernels and variances at the padded size of an image of shape
+        `imageShape` (see `paddedShape()`), to filter its planes with `filterArray()`.
+        """
+        kernels = [k for k in (self.kappa, self.preConvKernel) if k is not None]
+        shape = paddedShape(imageShape, np.max([k.shape for k in kernels], axis=0))
+        return DecorrelationFilter(self.kappa, self.svar, self.tvar, preConvKernel=self.preConvKernel,
+                                   psf=self.psf, delta=self.delta, shape=shape)
+
+    def _get(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    @property
+    def kappaFT(self):
+        return self._get('kappaFT', lambda: kernelFT(self.kappa, self.shape))
+
+    @property
+    def psfFT(self):
+        return self._get('psfFT', lambda: kernelFT(self.psf, self.shape))
+
+    @property
+    def preConvFT(self):
+        def compute():
+            if self.preConvKernel is None:
+                return 1.
+            if self.psf is not None and self.psf.shape == self.preConvKernel.shape and \
+                    np.array_equal(self.psf, self.preConvKernel):
+                return self.psfFT
+            return kernelFT(self.preConvKernel, self.shape)
+        return self._get('preConvFT', compute)
+
+    @property
+    def filter(self):
+        return self._get('filter', lambda: np.sqrt(
+            (self.svar + self.tvar + self.delta) /
+            (self.svar * np.abs(self.preConvFT)**2 + self.tvar * np.abs(self.kappaFT)**2 + self.delta)))
+
+    def kernel(self, size=None):
+        """! The decorrelation kernel, centered in an odd-sized array (by default, of the size
+        of the larger of kappa and the pre-convolution kernel).
+        """
+        size = self.kernelSize if size is None else tuple(size)
+        return self._get(('kernel', size), lambda: centeredInverseFT(self.filter, size)).copy()
+
+    @property
+    def varianceFilter(self):
+        def compute():
+            kernel = scipy.fftpack.ifft2(self.filter, axes=(-2, -1)).real
+            return scipy.fftpack.fft2(kernel**2, axes=(-2, -1))
+        return self._get('varianceFilter', compute)
+
+    def correctedPsf(self, size=None):
+        """! The PSF of the decorrelated diffim, normalized to unit sum, centered in an array of
+        `size` (by default, that of the input PSF).
+        """
+        size = self.psf.shape[-2:] if size is None else tuple(size)
+
+        def compute():
+            psfc = centeredInverseFT(self.psfFT * self.preConvFT * self.filter, size)
+            return psfc / psfc.sum(axis=(-2, -1), keepdims=True)
+        return self._get(('correctedPsf', size), compute).copy()
@@ -0,0 +1,68 @@
+from __future__ import absolute_import, division, print_function
+
+# One-to-one positional matching of source catalogs with a KD-tree, shared by the astrometric
+# offset estimation (diffimTests.computeOffsets) and the scoring of detections against the input
+# sources (DiffimTest.runTest). Memory and time are O(N log N) in the number of sources, rather
+# than the O(N*M) of a dense distance matrix.
+
+import numpy as np
+import scipy.spatial
+
+__all__ = ("matchSources", "scoreDetections")
+
+
+def matchSources(xy1, xy2, radius, maxNeighbors=8):
+    """! Match two lists of positions one-to-one, closest pairs first, within `radius`.
+
+    Candidate pairs are each source in `xy1` with its `maxNeighbors` nearest neighbours in `xy2`
+    within `radius`. They are assigned as with a greedy assignment in order of increasing
+    distance, but vectorized: in each round, every pair in which each source is the other's
+    nearest remaining candidate is accepted, and all other candidates of the accepted sources
+    are dropped.
+
+    @param xy1  (N, 2) numpy.array of positions
+    @param xy2  (M, 2) numpy.array of positions
+    @param radius the maximum separation of a match, in the same units as the positions
+    @return idx1, idx2, dist: numpy.arrays of the indices into `xy1` and `xy2` of the matched
+    pairs, and their separations
+    """
+    xy1 = np.asarray(xy1, dtype=np.float64).reshape(-1, 2)
+    xy2 = np.asarray(xy2, dtype=np.float64).reshape(-1, 2)
+    empty = (np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0))
+    if len(xy1) == 0 or len(xy2) == 0:
+        return empty
+
+    k = min(maxNeighbors, len(xy2))
+    dist, j = scipy.spatial.cKDTree(xy2).query(xy1, k=k, distance_upper_bound=radius)
+    dist, j = dist.reshape(len(xy1), k), j.reshape(len(xy1), k)
+    i = np.repeat(np.arange(len(xy1)), k)
+    dist, j = dist.ravel(), j.ravel()
+    ok = np.isfinite(dist)
+    order = np.argsort(dist[ok], kind='mergesort')
+    i, j, dist = i[ok][order], j[ok][order], dist[ok][order]
+
+    matched1, matched2, matchedDist = [], [], []
+    while len(i) > 0:
+        # The first (closest) candidate of each source, on either side
+        _, first1 = np.unique(i, return_index=True)
+        _, first2 = np.unique(j, return_index=True)
+        mutual = np.intersect1d(first1, first2, assume_unique=True)
+        matched1.append(i[mutual])
+        matched2.append(j[mutual])
+        matchedDist.append(dist[mutual])
+        keep = ~(np.in1d(i, i[mutual]) | np.in1d(j, j[mutual]))
+        i, j, dist = i[keep], j[keep], dist[keep]
+
+    if not matched1:
+        return empty
+    return np.concatenate(matched1), np.concatenate(matched2), np.concatenate(matchedDist)
+
+
+def scoreDetections(detectedXY, trueXY, radius=1.5):
+    """! Score detections against the true positions of the sources, with one-to-one matching.
+    @return dict with the numbers of true positives 'TP', false negatives 'FN' (undetected
+    sources) and false positives 'FP' (unmatched detections)
+    """
+    idx1, _, _ = matchSources(detectedXY, trueXY, radius)
+    nDetected, nTrue = len(np.asarray(detectedXY).reshape(-1, 2)), len(np.asarray(trueXY).reshape(-1, 2))
+    return {'TP': len(idx1), 'FN': nTrue - len(idx1), 'FP': nDetected - len(idx1)}
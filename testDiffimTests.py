@@ -0,0 +1,551 @@
+from __future__ import absolute_import, division, print_function
+
+import pickle
+import threading
+import unittest
+
+import numpy as np
+import scipy.ndimage
+
+import lsst.utils.tests
+
+import diffimTests as dit
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+def gaussian(shape, sigma, yc, xc):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    out = np.exp(-((x - xc)**2. + (y - yc)**2.) / (2. * sigma**2.))
+    return out / out.sum()
+
+
+class ZOGYTemplateTest(lsst.utils.tests.TestCase):
+    """!Tests of the Fourier-space multi-epoch ZOGY (diffimTests.ZOGYTemplate)."""
+
+    def _checkCentering(self, shape):
+        """! A source added to the science image must peak at its position in D, S and in the
+        propagated variance planes, whatever the parity of the image dimensions.
+        """
+        psf1, psf2 = gaussian((15, 15), 1.6, 7, 7), gaussian((15, 15), 2.0, 7, 7)
+        im1 = np.zeros(shape)
+        im2 = 1000. * gaussian(shape, 2.0, 20, 27)
+        var = np.ones(shape)
+        var[20, 27] = 50.
+        zt = dit.ZOGYTemplate(im1, psf1, var, sig1=1.)
+        S_corr, S, D, P_D, F_D, var1c, var2c = zt.subtract(im2, psf2, var, sig2=1.)
+        for arr in (D, S, var1c, var2c):
+            self.assertEqual(np.unravel_index(np.argmax(arr), shape), (20, 27))
+
+    def testCentering_even(self):
+        self._checkCentering((64, 64))
+
+    def testCentering_odd(self):
+        self._checkCentering((63, 65))
+        self._checkCentering((65, 63))
+
+
+class ZOGYBatchTest(lsst.utils.tests.TestCase):
+    """!Tests of the batched ZOGY (diffimTests.performZOGYBatch) against the per-pair functions."""
+
+    def setUp(self):
+        rng = np.random.RandomState(12345)
+        # Odd-sized, so that the image-space S_corr of performZOGY_Scorr() is centered the same way
+        self.shape = (65, 65)
+        self.nPairs = 5
+        self.psf1s = np.array([gaussian((15, 15), 1.4 + 0.1*i, 7, 7) for i in range(self.nPairs)])
+        self.psf2 = gaussian((15, 15), 2.0, 7, 7)
+        self.im1s = 2. * rng.normal(size=(self.nPairs,) + self.shape)
+        self.im2s = rng.normal(size=(self.nPairs,) + self.shape) + 500. * gaussian(self.shape, 2.0, 30, 33)
+        self.var1s = np.full((self.nPairs,) + self.shape, 4.)
+        self.var2s = np.ones((self.nPairs,) + self.shape)
+
+    def testBatch(self):
+        # Template sigmas given, science sigmas computed per image, in chunks smaller than the batch
+        sig1s = [2.] * self.nPairs
+        D, P_D, S_corr = dit.performZOGYBatch(self.im1s, self.im2s, self.psf1s, self.psf2, self.var1s,
+                                              self.var2s, sig1s=sig1s, chunkSize=2)
+        inner = (slice(16, -16), slice(16, -16))  # performZOGY_Scorr() does not wrap around the edges
+        for i in range(self.nPairs):
+            sig2 = dit.computeClippedImageStats(self.im2s[i])[1]
+            psf1 = dit.padPsfToImage(self.psf1s[i], self.shape)
+            psf2 = dit.padPsfToImage(self.psf2, self.shape)
+            D_i = dit.performZOGY(self.im1s[i], self.im2s[i], psf1, psf2, sig1=2., sig2=sig2)
+            self.assertFloatsAlmostEqual(D[i], D_i, atol=1e-10)
+            P_D_i, _ = dit.computeZOGYDiffimPsf(self.im1s[i], self.im2s[i], psf1, psf2, sig1=2., sig2=sig2)
+            self.assertFloatsAlmostEqual(P_D[i], P_D_i, atol=1e-10)
+            S_corr_i = dit.performZOGY_Scorr(self.im1s[i], self.im2s[i], self.var1s[i], self.var2s[i],
+                                             psf1, psf2, sig1=2., sig2=sig2, D=D_i, padSize=0)[0]
+            self.assertFloatsAlmostEqual(S_corr[i][inner], S_corr_i[inner], atol=1e-3)
+
+    def testBatchWithoutVariance(self):
+        sig2s = [1.] * self.nPairs
+        D, P_D, S_corr = dit.performZOGYBatch(self.im1s, self.im2s, self.psf1s[0], self.psf2, sig2s=sig2s)
+        self.assertIsNone(S_corr)
+        sig1 = dit.computeClippedImageStats(self.im1s[3])[1]
+        D_3 = dit.performZOGY(self.im1s[3], self.im2s[3], dit.padPsfToImage(self.psf1s[0], self.shape),
+                              dit.padPsfToImage(self.psf2, self.shape), sig1=sig1, sig2=1.)
+        self.assertFloatsAlmostEqual(D[3], D_3, atol=1e-10)
+
+
+class ZOGYMethodTest(lsst.utils.tests.TestCase):
+    """!Tests of the tiled ZOGY, its kernel error estimates and the choice between the ZOGY paths."""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(12345)
+        # A compact pair of ZOGY kernels, and one whose kernels extend far beyond the PSFs
+        self.psfPairs = [(gaussian((15, 15), 1.2, 7, 7), gaussian((15, 15), 2.5, 7, 7)),
+                         (gaussian((15, 15), 1.6, 7, 7), gaussian((15, 15), 2.0, 7, 7))]
+
+    def _fourierD(self, im1, im2, psf1, psf2):
+        return dit.performZOGY(im1, im2, dit.padPsfToImage(psf1, im1.shape),
+                               dit.padPsfToImage(psf2, im2.shape), sig1=1., sig2=1.)
+
+    def testTiledWithinDeclaredError(self):
+        for (psf1, psf2), maxKernelError in zip(self.psfPairs, (1e-3, 0.1)):
+            overlap, err = dit.chooseZOGYTileOverlap(psf1, psf2, 1., 1., maxKernelError)
+            self.assertLessEqual(err, maxKernelError)
+            shape = (128 + 4*overlap, 128 + 4*overlap)
+            im1, im2 = self.rng.normal(size=shape), self.rng.normal(size=shape)
+            D = self._fourierD(im1, im2, psf1, psf2)
+            # The full-image transform wraps around the image edges; compare away from them
+            inner = (slice(2*overlap, -2*overlap), slice(2*overlap, -2*overlap))
+            for tileSize in (16, 32, 64):
+                D_tiled = dit.performZOGYTiled(im1, im2, psf1, psf2, sig1=1., sig2=1., tileSize=tileSize,
+                                               maxKernelError=maxKernelError)
+                self.assertLessEqual(np.std((D_tiled - D)[inner]) / np.std(D[inner]), err)
+
+    def testTileErrorDecreases(self):
+        psf1, psf2 = self.psfPairs[1]
+        errors = [dit.estimateZOGYTileError(psf1, psf2, 1., 1., overlap) for overlap in (15, 30, 45)]
+        self.assertGreater(errors[0], 0.05)  # a PSF-sized overlap cuts off much of these kernels
+        self.assertTrue(errors[0] > errors[1] > errors[2])
+        # Identical PSFs make delta-function kernels, which nothing cuts off
+        self.assertAlmostEqual(dit.estimateZOGYTileError(psf1, psf1, 1., 1., 15), 0., places=6)
+
+    def testKernelErrorDecreases(self):
+        psf1, psf2 = self.psfPairs[0]
+        errors = [dit.estimateZOGYKernelError(psf1, psf2, 1., 1., padSize) for padSize in (0, 5, 15)]
+        self.assertTrue(errors[0] > errors[1] > errors[2])
+        self.assertAlmostEqual(dit.estimateZOGYKernelError(psf1, psf1, 1., 1., 0), 0., places=6)
+
+    def testChooseMethod(self):
+        psf1, psf2 = self.psfPairs[1]
+        choice = dit.chooseZOGYMethod((512, 512), psf1, psf2, 1., 1., maxKernelError=1e-3)
+        self.assertLessEqual(choice['error'], 1e-3)
+        tiled, = [c for c in choice['candidates'] if c['method'] == 'tiled']
+        self.assertEqual((tiled['overlap'], tiled['error']), dit.chooseZOGYTileOverlap(psf1, psf2, 1., 1.))
+        # With a loose error bound the cheapest candidate is chosen
+        choice = dit.chooseZOGYMethod((512, 512), psf1, psf2, 1., 1., maxKernelError=1.)
+        self.assertEqual(choice['flops'], min(c['flops'] for c in choice['candidates']))
+        # Only the Fourier path is exact; a small memory budget forces the tiled path
+        self.assertEqual(dit.chooseZOGYMethod((512, 512), psf1, psf2, 1., 1., maxKernelError=0.)['method'],
+                         'fourier')
+        choice = dit.chooseZOGYMethod((2048, 2048), psf1, psf2, 1., 1., maxKernelError=1.,
+                                      memoryBudget=150.*1024**2)
+        self.assertEqual(choice['method'], 'tiled')
+
+    def testDoZOGY(self):
+        psf1, psf2 = self.psfPairs[0]
+        shape = (160, 160)
+        im1, im2 = self.rng.normal(size=shape), self.rng.normal(size=shape)
+        testObj = dit.DiffimTest(doInit=False)
+        testObj.im1 = dit.Exposure(im1, psf1, np.ones(shape))
+        testObj.im2 = dit.Exposure(im2, psf2, np.ones(shape))
+        testObj.astrometricOffsets = [0., 0.]
+
+        D = testObj.doZOGY(computeScorr=False, inImageSpace='tiled', tileSize=64).im
+        self.assertFloatsAlmostEqual(D, dit.performZOGYTiled(im1, im2, psf1, psf2, sig1=1., sig2=1.,
+                                                             tileSize=64))
+        self.assertEqual(testObj.zogyChoice['method'], 'tiled')
+        self.assertEqual(testObj.zogyChoice['overlap'], dit.chooseZOGYTileOverlap(psf1, psf2, 1., 1.)[0])
+        D = testObj.doZOGY(computeScorr=False, inImageSpace='auto', maxKernelError=0.).im
+        self.assertFloatsAlmostEqual(D, self._fourierD(im1, im2, psf1, psf2))
+        self.assertEqual(testObj.zogyChoice['method'], 'fourier')
+        self.assertIn('candidates', testObj.zogyChoice)
+        testObj.doZOGY(computeScorr=False, inImageSpace=True, padSize=5)
+        self.assertEqual((testObj.zogyChoice['method'], testObj.zogyChoice['padSize']), ('imageSpace', 5))
+        with self.assertRaises(TypeError):
+            testObj.doZOGY(inImageSpace=True, maxKernelError=0.)
+        with self.assertRaises(ValueError):
+            testObj.doZOGY(inImageSpace='fourier-space')
+
+
+class ZOGYVarianceTest(lsst.utils.tests.TestCase):
+    """!Tests of the ZOGY variance propagation (diffimTests.computeZOGYVariance) against direct
+    image-space convolution of the variance planes.
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(12345)
+        self.shape = (60, 70)
+        self.var1 = rng.uniform(1., 3., self.shape)
+        self.var2 = rng.uniform(2., 5., self.shape)
+        self.psf1, self.psf2 = gaussian((15, 15), 1.6, 7, 7), gaussian((15, 15), 2.2, 7, 7)
+
+    def _convolve(self, var, kernel):
+        return scipy.ndimage.filters.convolve(var, kernel**2., mode='constant')
+
+    def testConvolveVariancePlanes(self):
+        rng = np.random.RandomState(12345)
+        k1, k2 = rng.uniform(size=(2, 15, 15))
+        var_a, var_b, var_c = dit.convolveVariancePlanes(self.var1, self.var2,
+                                                         [(k1, k2), (k1, None), (None, k2)])
+        self.assertFloatsAlmostEqual(var_a, self._convolve(self.var1, k1) + self._convolve(self.var2, k2),
+                                     rtol=1e-12)
+        self.assertFloatsAlmostEqual(var_b, self._convolve(self.var1, k1), rtol=1e-12)
+        self.assertFloatsAlmostEqual(var_c, self._convolve(self.var2, k2), rtol=1e-12)
+
+    def testComputeZOGYVariance(self):
+        sig1, sig2 = 1.2, 1.8
+        for padSize in (0, 5):
+            _, _, P_r_hat, P_n_hat, denom, _, _ = dit.ZOGYUtils(None, None, self.psf1, self.psf2,
+                                                                sig1, sig2, padSize=padSize)
+            K_r = np.fft.ifft2(P_r_hat / denom).real
+            K_n = np.fft.ifft2(P_n_hat / denom).real
+            if padSize > 0:
+                K_r = K_r[padSize:-padSize, padSize:-padSize]
+                K_n = K_n[padSize:-padSize, padSize:-padSize]
+            k_r, k_n = dit.computeZOGYScorrKernels(P_r_hat, P_n_hat, denom, padSize=padSize)
+
+            # D = K_r (x) N - K_n (x) R, so the template variance goes through K_n
+            var_D, var1c, var2c = dit.computeZOGYVariance(self.var1, self.var2, self.psf1, self.psf2,
+                                                          sig1=sig1, sig2=sig2, padSize=padSize)
+            self.assertFloatsAlmostEqual(var_D, self._convolve(self.var1, K_n) +
+                                         self._convolve(self.var2, K_r), rtol=1e-12)
+            self.assertFloatsAlmostEqual(var1c, self._convolve(self.var1, k_r), rtol=1e-12)
+            self.assertFloatsAlmostEqual(var2c, self._convolve(self.var2, k_n), rtol=1e-12)
+
+            var_D2, var1c, var2c = dit.computeZOGYVariance(self.var1, self.var2, self.psf1, self.psf2,
+                                                           sig1=sig1, sig2=sig2, padSize=padSize,
+                                                           computeScorr=False)
+            self.assertFloatsAlmostEqual(var_D2, var_D, rtol=1e-12)
+            self.assertIsNone(var1c)
+            self.assertIsNone(var2c)
+
+
+class ALVarianceTest(lsst.utils.tests.TestCase):
+    """!Tests of the A&L decorrelation and variance propagation in Fourier space
+    (diffimTests.applyALKernelsInFourierSpace) against direct image-space convolution.
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(12345)
+        self.shape = (60, 70)
+        self.diffim = rng.normal(size=self.shape)
+        # Different template and science variances, and an asymmetric kappa, so that swapping
+        # the planes (or flipping the kernels) does not go unnoticed
+        self.var1 = rng.uniform(1., 3., self.shape)
+        self.var2 = rng.uniform(4., 6., self.shape)
+        self.kappa = gaussian((21, 21), 1.3, 10, 11.5)
+        self.kappa[3, 5] += 0.05
+        self.preConvKernel = gaussian((21, 21), 1.5, 10, 10)
+
+    def testApplyALKernels(self):
+        # The Fourier-space planes are zero outside of the image, but not the intermediate results,
+        # so the reference convolutions are done on planes padded by all the kernels
+        pad = 3 * self.kappa.shape[0]
+
+        def convolve(arr, kernel):
+            return scipy.ndimage.filters.convolve(arr, kernel, mode='constant')
+
+        def trim(arr):
+            return arr[pad:-pad, pad:-pad]
+
+        diffim0, var1, var2 = [np.pad(arr, pad, mode='constant')
+                               for arr in (self.diffim, self.var1, self.var2)]
+        for preConvKernel in (None, self.preConvKernel):
+            decorrKernel = dit.computeDecorrelationKernel(self.kappa, 0.04, 0.09, preConvKernel=preConvKernel)
+            for pck in (None, decorrKernel):
+                diffim, var = dit.applyALKernelsInFourierSpace(self.diffim, self.var1, self.var2, self.kappa,
+                                                               decorrKernel=pck, preConvKernel=preConvKernel)
+                # var(pck (x) (pc (x) im2 - kappa (x) im1)) = pck**2 (x) (pc**2 (x) var2 + kappa**2 (x) var1)
+                expected = convolve(var1, self.kappa**2.)
+                expected += var2 if preConvKernel is None else convolve(var2, preConvKernel**2.)
+                if pck is not None:
+                    expected = convolve(expected, pck**2.)
+                self.assertFloatsAlmostEqual(var, trim(expected), rtol=1e-10)
+                swapped = convolve(var2, self.kappa**2.) + var1
+                self.assertGreater(np.abs(var - trim(swapped)).max(), 0.1)
+
+                expected = self.diffim if pck is None else trim(convolve(diffim0, pck))
+                self.assertFloatsAlmostEqual(diffim, expected, atol=1e-12)
+
+    def testCachedDecorrelationFilter(self):
+        # Computed once per kernels and variances (see testNumpyOps for the filter itself)
+        filt = dit.cachedDecorrelationFilter(self.kappa, 0.04, 0.09, preConvKernel=self.preConvKernel)
+        self.assertIs(dit.cachedDecorrelationFilter(self.kappa.copy(), 0.04, 0.09,
+                                                    preConvKernel=self.preConvKernel.copy()), filt)
+        self.assertIsNot(dit.cachedDecorrelationFilter(self.kappa, 0.04, 0.09), filt)
+        self.assertIsNot(dit.cachedDecorrelationFilter(self.kappa, 0.04, 0.08,
+                                                       preConvKernel=self.preConvKernel), filt)
+
+
+class ALInStackTest(lsst.utils.tests.TestCase):
+    """!Tests of the fused subtract-and-decorrelate path of DiffimTest.doALInStack."""
+
+    def setUp(self):
+        self.testObj = dit.DiffimTest(imSize=(256, 256), n_sources=100, psf_yvary_factor=0., offset=[0., 0.])
+
+    def testFusedMatchesUnfused(self):
+        unfused = self.testObj.doALInStack(decorrInFourierSpace=True)
+        fused = self.testObj.doALInStack(fused=True, keepUndecorrelated=True)
+
+        # The same kernel fit, so the same decorrelation
+        self.assertFloatsAlmostEqual(fused.kappaImg, unfused.kappaImg)
+        self.assertFloatsAlmostEqual(fused.decorrelationKernel, unfused.decorrelationKernel)
+        psfs = [dit.afwPsfToArray(r.decorrelatedDiffim.getPsf(), r.decorrelatedDiffim)
+                for r in (fused, unfused)]
+        self.assertFloatsAlmostEqual(psfs[0], psfs[1])
+
+        # The fused path applies the kernel fitted at the image center everywhere, while the stack
+        # convolves with the (slightly) spatially-varying one.
+        inner = (slice(40, -40), slice(40, -40))
+        for name in ('subtractedExposure', 'decorrelatedDiffim'):
+            img1, _, var1 = getattr(fused, name).getMaskedImage().getArrays()
+            img2, _, var2 = getattr(unfused, name).getMaskedImage().getArrays()
+            img1, var1, img2, var2 = img1[inner], var1[inner], img2[inner], var2[inner]
+            good = np.isfinite(img1) & np.isfinite(img2)
+            self.assertGreater(good.sum(), 0.9 * good.size)
+            self.assertLess(np.std((img1 - img2)[good]) / np.std(img2[good]), 0.05)
+            self.assertFloatsAlmostEqual(np.median(var1[good]), np.median(var2[good]), rtol=0.01)
+
+
+    def testFusedDoesLessWork(self):
+        # Count the (whole-image) real-space convolutions done by afw in each path
+        import lsst.afw.math as afwMath
+        convolve = afwMath.convolve
+        counts = []
+
+        def countingConvolve(*args, **kwargs):
+            counts[-1] += 1
+            return convolve(*args, **kwargs)
+
+        afwMath.convolve = countingConvolve
+        try:
+            for fused in (False, True):
+                counts.append(0)
+                result = self.testObj.doALInStack(decorrInFourierSpace=True, fused=fused)
+        finally:
+            afwMath.convolve = convolve
+
+        # The fused path skips the convolution of the template by the kernel (and by default does
+        # not keep the un-decorrelated diffim)
+        self.assertLess(counts[1], counts[0])
+        self.assertIsNone(result.subtractedExposure)
+        self.assertIsNotNone(result.decorrelatedDiffim)
+
+class ExposureTest(lsst.utils.tests.TestCase):
+    """!Tests of the numpy Exposure and its cached conversion to an afw exposure."""
+
+    def setUp(self):
+        rng = np.random.RandomState(12345)
+        self.im = rng.normal(size=(64, 64)).astype(np.float32)
+        self.var = np.ones((64, 64), dtype=np.float32)
+        self.psf = gaussian((15, 15), 1.6, 7, 7)
+
+    def testStatsInvalidated(self):
+        exp = dit.Exposure(self.im, self.psf, self.var)
+        mean, std, _, _ = exp.getStats()
+        self.assertAlmostEqual(exp.sig, 1., places=6)
+        self.assertIs(exp.getStats(), exp.getStats())
+
+        # Modifying pixels in place is only seen within mutate() (or after markModified())
+        with exp.mutate():
+            exp.im *= 3.
+            exp.var[:, :] = 4.
+        self.assertAlmostEqual(exp.getStats()[0], 3. * mean, places=5)
+        self.assertAlmostEqual(exp.getStats()[1], 3. * std, places=5)
+        self.assertAlmostEqual(exp.sig, 2., places=6)
+
+        # An explicit sig is kept until the pixels change, and replacing a plane recomputes the stats
+        exp.sig = 5.
+        self.assertEqual(exp.sig, 5.)
+        exp.var = np.full((64, 64), 9., dtype=np.float32)
+        self.assertAlmostEqual(exp.sig, 3., places=6)
+        exp.var = None
+        self.assertAlmostEqual(exp.sig, exp.getStats()[1])
+
+    def testPickle(self):
+        exp = dit.Exposure(self.im, self.psf, self.var, metaData={'key': 'value'})
+        exp.sig = 1.5
+        exp.asAfwExposure(shared=True)
+        exp2 = pickle.loads(pickle.dumps(exp))
+        self.assertFloatsAlmostEqual(exp2.im, self.im, rtol=0, atol=0)
+        self.assertFloatsAlmostEqual(exp2.var, self.var, rtol=0, atol=0)
+        self.assertFloatsAlmostEqual(exp2.psf, self.psf, rtol=0, atol=0)
+        self.assertEqual(exp2.metaData, {'key': 'value'})
+        self.assertEqual(exp2.sig, 1.5)
+        self.assertFloatsAlmostEqual(exp2.asAfwExposure().getMaskedImage().getImage().getArray(), self.im)
+
+        # The state of Exposures pickled before __slots__ was used is their __dict__
+        exp3 = dit.Exposure.__new__(dit.Exposure)
+        exp3.__setstate__(dict(im=self.im, psf=self.psf, var=self.var, metaData={}, sig=1.5))
+        self.assertEqual(exp3.sig, 1.5)
+        with exp3.mutate():
+            exp3.var[:, :] = 4.
+        self.assertAlmostEqual(exp3.sig, 2., places=6)
+
+    def testAfwExposureCache(self):
+        exp = dit.Exposure(self.im, self.psf, self.var)
+        afwExp = exp.asAfwExposure(shared=True)
+        self.assertIs(exp.asAfwExposure(shared=True), afwExp)
+        self.assertFloatsAlmostEqual(afwExp.getMaskedImage().getImage().getArray(), self.im)
+        self.assertFloatsAlmostEqual(afwExp.getMaskedImage().getVariance().getArray(), self.var)
+
+        # By default, each caller gets its own copy, which it may modify
+        clone = exp.asAfwExposure()
+        self.assertIsNot(clone, afwExp)
+        self.assertIsNot(exp.asAfwExposure(), clone)
+        clone.getMaskedImage().getImage().getArray()[:, :] = 0.
+        clone.getMaskedImage().getMask().getArray()[:, :] = 1
+        for afwExp2 in (exp.asAfwExposure(), exp.asAfwExposure(shared=True)):
+            self.assertFloatsAlmostEqual(afwExp2.getMaskedImage().getImage().getArray(), self.im)
+            self.assertEqual(afwExp2.getMaskedImage().getMask().getArray().max(), 0)
+
+        # Modifying the numpy exposure invalidates the cached one
+        version = exp.version
+        with exp.mutate():
+            exp.im[10, 20] = 1000.
+        self.assertGreater(exp.version, version)
+        afwExp2 = exp.asAfwExposure(shared=True)
+        self.assertIsNot(afwExp2, afwExp)
+        self.assertEqual(afwExp2.getMaskedImage().getImage().getArray()[10, 20], 1000.)
+        self.assertEqual(exp.asAfwExposure().getMaskedImage().getImage().getArray()[10, 20], 1000.)
+        exp.psf = gaussian((15, 15), 2.0, 7, 7)
+        self.assertIsNot(exp.asAfwExposure(shared=True), afwExp2)
+
+    def testAfwExposureZeroCopy(self):
+        exp = dit.Exposure(self.im, self.psf, self.var)
+        with self.assertRaises(ValueError):
+            exp.asAfwExposure(zeroCopy=True)
+        afwExp = exp.asAfwExposure(shared=True, zeroCopy=True)
+        self.assertIs(exp.asAfwExposure(shared=True, zeroCopy=True), afwExp)
+        self.assertIsNot(exp.asAfwExposure(shared=True), afwExp)
+        img = afwExp.getMaskedImage().getImage().getArray()
+        self.assertFloatsAlmostEqual(img, self.im)
+        if np.may_share_memory(img, self.im):  # otherwise this afw version can only copy
+            self.im[5, 5] = -1000.
+            self.assertEqual(img[5, 5], -1000.)
+
+
+class DetectionTaskCacheTest(lsst.utils.tests.TestCase):
+    """!Tests of the per-thread, per-process cache of detection tasks (diffimTests.DetectionTaskCache)."""
+
+    def setUp(self):
+        # Stand-in tasks, so that the cache can be tested without configuring the real ones
+        self.makeDetectionTasks = dit.makeDetectionTasks
+        dit.makeDetectionTasks = lambda *args: (object(), args)
+
+    def tearDown(self):
+        dit.makeDetectionTasks = self.makeDetectionTasks
+
+    def testReuse(self):
+        cache = dit.DetectionTaskCache(maxSize=2)
+        tasks = cache.get(5.0)
+        self.assertIs(cache.get(5.0), tasks)
+        self.assertIs(cache.get(5.0, plugins=list(dit.defaultMeasurementPlugins)), tasks)
+        self.assertIsNot(cache.get(3.0), tasks)
+        self.assertIsNot(cache.get(5.0, thresholdPolarity='positive'), tasks)
+        self.assertIsNot(cache.get(5.0, plugins=('base_PsfFlux',)), tasks)
+
+        # Only the maxSize most recently used are kept
+        tasks = cache.get(4.0)
+        cache.get(6.0)
+        self.assertIs(cache.get(4.0), tasks)
+        cache.get(7.0)
+        cache.get(8.0)
+        self.assertIsNot(cache.get(4.0), tasks)
+
+        tasks = cache.get(4.0)
+        cache.clear()
+        self.assertIsNot(cache.get(4.0), tasks)
+
+    def testThreadsAndProcesses(self):
+        cache = dit.DetectionTaskCache()
+        tasks = cache.get(5.0)
+        results = []
+        thread = threading.Thread(target=lambda: results.extend([cache.get(5.0), cache.get(5.0)]))
+        thread.start()
+        thread.join()
+        self.assertIsNot(results[0], tasks)
+        self.assertIs(results[1], results[0])
+        self.assertIs(cache.get(5.0), tasks)
+
+        # As in a forked pool worker, whose (copied) cache was filled in its parent
+        cache.local.pid = -1
+        self.assertIsNot(cache.get(5.0), tasks)
+
+
+class CatalogTest(lsst.utils.tests.TestCase):
+    """!Tests of the column selection of diffimTests.catalogToDataFrame()."""
+
+    def setUp(self):
+        testObj = dit.DiffimTest(imSize=(128, 128), n_sources=20, psf_yvary_factor=0., offset=[0., 0.])
+        self.sources = dit.doDetection(testObj.im2.asAfwExposure(), asDF=False)
+        self.assertGreater(len(self.sources), 0)
+
+    def testColumns(self):
+        allColumns = dit.catalogToDataFrame(self.sources)
+        self.assertEqual(len(allColumns), len(self.sources))
+        self.assertIn('base_PsfFlux_flux', allColumns.columns)
+
+        df = dit.catalogToDataFrame(self.sources, columns=['id', 'base_PsfFlux_*'])
+        expected = ['id'] + [c for c in allColumns.columns if c.startswith('base_PsfFlux_')]
+        self.assertEqual(sorted(df.columns), sorted(expected))
+        self.assertGreater(len(expected), 2)
+        for column in df.columns:
+            self.assertFloatsAlmostEqual(df[column].values.astype(float),
+                                         allColumns[column].values.astype(float), rtol=0, atol=0)
+
+        # A single name, and the structured array
+        df = dit.catalogToDataFrame(self.sources, columns='base_PsfFlux_flux')
+        self.assertEqual(list(df.columns), ['base_PsfFlux_flux'])
+        arr = dit.catalogToDataFrame(self.sources, columns=['id', 'base_PsfFlux_*'], asDF=False)
+        self.assertEqual(sorted(arr.dtype.names), sorted(expected))
+        self.assertFloatsAlmostEqual(arr['base_PsfFlux_flux'], allColumns['base_PsfFlux_flux'].values,
+                                     rtol=0, atol=0)
+
+        # Patterns that match nothing give no columns
+        self.assertEqual(len(dit.catalogToDataFrame(self.sources, columns=['nonexistent_*']).columns), 0)
+
+
+class PhaseCorrelationTest(lsst.utils.tests.TestCase):
+    """!Tests of the FFT offset estimation (diffimTests.phaseCorrelationOffset)."""
+
+    def _makeField(self, rng, dx, dy, shape=(96, 96), nSources=20):
+        xc, yc = rng.uniform(15., shape[1] - 15., nSources), rng.uniform(15., shape[0] - 15., nSources)
+        flux = rng.uniform(200., 2000., nSources)
+        return np.sum([f * gaussian(shape, 2., y + dy, x + dx) for f, x, y in zip(flux, xc, yc)], axis=0)
+
+    def testSubPixelOffsets(self):
+        for dx, dy in ((0.3, -0.15), (-0.7, 0.35), (0.5, 0.)):
+            seed = np.random.RandomState(12345).randint(1 << 30)
+            im1 = self._makeField(np.random.RandomState(seed), dx, dy)
+            im2 = self._makeField(np.random.RandomState(seed), 0., 0.)
+            # Away from the edges, the upsampled refinement is unbiased
+            x, y, peak, rms = dit.phaseCorrelationOffset(im1, im2, window=False)
+            self.assertAlmostEqual(x, dx, places=3)
+            self.assertAlmostEqual(y, dy, places=3)
+            self.assertGreater(peak / rms, 10.)
+            # ... and the Hann window biases the offsets by a few percent of their size
+            x, y, _, _ = dit.phaseCorrelationOffset(im1, im2)
+            self.assertLess(abs(x - dx), 0.05 * abs(dx) + 1e-3)
+            self.assertLess(abs(y - dy), 0.05 * abs(dy) + 1e-3)
+
+    def testNoise(self):
+        # Unrelated images have no significant peak
+        rng = np.random.RandomState(12345)
+        _, _, peak, rms = dit.phaseCorrelationOffset(rng.normal(size=(64, 64)), rng.normal(size=(64, 64)))
+        self.assertLess(peak / rms, 10.)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -22,6 +22,7 @@ from past.builtins import basestring
 # the GNU General Public License along with this program.  If not,
 # see <https://www.lsstcorp.org/LegalNotices/>.
 
+import threading
 import unittest
 
 import numpy as np
@@ -220,7 +221,7 @@ class DiffimCorrectionTest(lsst.utils.tests.TestCase):
         del self.im1ex
         del self.im2ex
 
-    def _testImages(self):
+    def _testImages(self, config=None):
         """Check that the variance of the corrected diffim matches the theoretical value.
         """
         # Create the matching kernel. We used Gaussian PSFs for im1 and im2, so we can compute the "expected"
@@ -267,7 +268,7 @@ class DiffimCorrectionTest(lsst.utils.tests.TestCase):
         self.assertLess(mn, expected_var)
         print('UNCORRECTED VARIANCE:', var, mn)
 
-        task = DecorrelateALKernelTask()
+        task = DecorrelateALKernelTask(config=config)
         decorrResult = task.run(self.im1ex, self.im2ex, diffExp, mKernel)
         corrected_diffExp = decorrResult.correctedExposure
 
@@ -300,6 +301,105 @@ class DiffimCorrectionTest(lsst.utils.tests.TestCase):
         self._setUpImages(svar=0.04, tvar=0.08)
         self._testImages()
 
+    def testDiffimCorrection_spatiallyVarying(self):
+        """Test decorrelated diffim using decorrelation kernels computed on a grid and blended.
+        """
+        config = DecorrelateALKernelTask.ConfigClass()
+        config.spatiallyVarying = True
+        config.spatialGridSize = (3, 3)
+        config.nThreads = 2
+        self._setUpImages(svar=0.04, tvar=0.08)
+        self._testImages(config=config)
+
+    def testDiffimCorrection_fourierSpace(self):
+        """Test decorrelated diffim with the decorrelation filter applied in Fourier space.
+        """
+        config = DecorrelateALKernelTask.ConfigClass()
+        config.applyInFourierSpace = True
+        self._setUpImages(svar=0.04, tvar=0.08)
+        self._testImages(config=config)
+
+    def testDecorrelationKernelCache(self):
+        """Test that repeated decorrelation with the same kernel and variances hits the kernel cache.
+        """
+        self._setUpImages(svar=0.04, tvar=0.04)
+        mKernel = afwMath.FixedKernel(self.im1ex.getPsf().computeKernelImage())
+        task = DecorrelateALKernelTask()
+        result1 = task.run(self.im1ex, self.im2ex, self.im1ex, mKernel, svar=self.svar, tvar=self.tvar)
+        self.assertEqual(task.metadata.get("decorrelationKernelCacheHits"), 0)
+        result2 = task.run(self.im1ex, self.im2ex, self.im1ex, mKernel, svar=self.svar, tvar=self.tvar)
+        self.assertEqual(task.metadata.get("decorrelationKernelCacheHits"), 2)
+        self.assertClose(result1.correctedExposure.getMaskedImage().getImage().getArray(),
+                         result2.correctedExposure.getMaskedImage().getImage().getArray())
+
+    def testExposurePool(self):
+        """Test that released corrected exposures are reused, and do not alter later results.
+        """
+        self._setUpImages(svar=0.04, tvar=0.04)
+        mKernel = afwMath.FixedKernel(self.im1ex.getPsf().computeKernelImage())
+        task = DecorrelateALKernelTask()
+        result1 = task.run(self.im1ex, self.im2ex, self.im1ex, mKernel, svar=self.svar, tvar=self.tvar)
+        expected = result1.correctedExposure.getMaskedImage().getImage().getArray().copy()
+        task.releaseExposure(result1.correctedExposure)
+        result2 = task.run(self.im1ex, self.im2ex, self.im1ex, mKernel, svar=self.svar, tvar=self.tvar)
+        self.assertEqual(task.exposurePool.nAllocated, 1)
+        self.assertEqual(task.exposurePool.nReused, 1)
+        self.assertIs(result2.correctedExposure, result1.correctedExposure)
+        self.assertClose(result2.correctedExposure.getMaskedImage().getImage().getArray(), expected)
+        self.assertTrue(result2.correctedExposure.hasPsf())
+        # The output has its own header and calib
+        result2.correctedExposure.getMetadata().set("POOLTEST", 1)
+        self.assertFalse(self.im1ex.getMetadata().exists("POOLTEST"))
+        result2.correctedExposure.getCalib().setFluxMag0(12345.)
+        self.assertNotEqual(self.im1ex.getCalib().getFluxMag0()[0], 12345.)
+
+    def testVarianceMeanMethods(self):
+        """Test that the approximate variance means agree with the exact one within a few times their
+        reported uncertainties.
+        """
+        self._setUpImages(svar=0.04, tvar=0.04)
+        config = DecorrelateALKernelTask.ConfigClass()
+        config.varianceMeanMethod = "exact"
+        exact, err = DecorrelateALKernelTask(config=config).computeVarianceStats(self.im1ex)
+        self.assertEqual(err, 0.)
+        for method in ("subsample", "histogram"):
+            config.varianceMeanMethod = method
+            config.varianceSubsampleSize = 10000
+            task = DecorrelateALKernelTask(config=config)
+            mean, err = task.computeVarianceStats(self.im1ex)
+            self.assertLess(abs(mean - exact), 5.*err + 1e-3*exact)
+            self.assertEqual(task.computeVarianceStats(self.im1ex), (mean, err))
+
+    def testRunBatch(self):
+        """Test that batched, threaded decorrelation gives the same results as decorrelating one at a time.
+        """
+        self._setUpImages(svar=0.04, tvar=0.08)
+        mKernel = afwMath.FixedKernel(self.im1ex.getPsf().computeKernelImage())
+        config = DecorrelateALKernelTask.ConfigClass()
+        config.nThreads = 2
+        task = DecorrelateALKernelTask(config=config)
+        inputs = [(self.im1ex, self.im2ex, self.im1ex, mKernel), (self.im2ex, self.im1ex, self.im2ex, mKernel)]
+        results = task.runBatch(inputs)
+        self.assertEqual(len(results), 2)
+        for args, result in zip(inputs, results):
+            expected = DecorrelateALKernelTask().run(*args)
+            self.assertClose(result.correctedExposure.getMaskedImage().getImage().getArray(),
+                             expected.correctedExposure.getMaskedImage().getImage().getArray(), rtol=1e-6)
+            self.assertIn("convolve", result.timing)
+        self.assertEqual(task.metadata.get("runBatchNumInputs"), 2)
+
+    def testRunBatchError(self):
+        """Test that the worker threads are stopped when decorrelating an input fails.
+        """
+        self._setUpImages()
+        config = DecorrelateALKernelTask.ConfigClass()
+        config.nThreads = 2
+        task = DecorrelateALKernelTask(config=config)
+        nThreads = threading.active_count()
+        with self.assertRaises(Exception):
+            task.runBatch([(self.im1ex, self.im2ex, self.im1ex, None)] * 2)  # no psfMatchingKernel
+        self.assertEqual(threading.active_count(), nThreads)
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
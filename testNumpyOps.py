@@ -0,0 +1,408 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+import scipy.ndimage
+import scipy.stats
+
+import lsst.utils.tests
+
+import caches
+import fastDetection
+import imageStats
+import kernelOps
+import sourceMatching
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+def fixOddKernelLoop(kernel):
+    """Reference: the per-kernel version formerly in DecorrelateALKernelTask."""
+    out = kernel
+    changed = False
+    if (out.shape[0] % 2) == 1:
+        out = np.pad(out, ((1, 0), (0, 0)), mode='constant')
+        changed = True
+    if (out.shape[1] % 2) == 1:
+        out = np.pad(out, ((0, 0), (1, 0)), mode='constant')
+        changed = True
+    if changed:
+        out *= (np.mean(kernel) / np.mean(out))
+    return out
+
+
+def fixEvenKernelLoop(kernel):
+    """Reference: the per-kernel version formerly in DecorrelateALKernelTask."""
+    maxloc = np.unravel_index(np.argmax(kernel), kernel.shape)
+    out = np.roll(kernel, kernel.shape[0]//2 - maxloc[0], axis=0)
+    out = np.roll(out, out.shape[1]//2 - maxloc[1], axis=1)
+    if (out.shape[0] % 2) == 0:
+        maxloc = np.unravel_index(np.argmax(out), out.shape)
+        if out.shape[0] - maxloc[0] > maxloc[0]:
+            out = out[:-1, :]
+        else:
+            out = out[1:, :]
+        if out.shape[1] - maxloc[1] > maxloc[1]:
+            out = out[:, :-1]
+        else:
+            out = out[:, 1:]
+    return out
+
+
+def gaussianKernel(shape, sigma, yc, xc):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    out = np.exp(-((x - xc)**2. + (y - yc)**2.) / (2. * sigma**2.))
+    return out / out.sum()
+
+
+class KernelOpsTest(lsst.utils.tests.TestCase):
+    """!Tests of the kernel-stack operations in kernelOps against per-kernel implementations."""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(12345)
+
+    def testPadKernels(self):
+        kernels = self.rng.rand(3, 13, 13)
+        diff = (21 - 13) // 2
+        expected = np.array([np.pad(k, (diff, diff), mode='constant') for k in kernels])
+        self.assertClose(kernelOps.padKernels(kernels, (21, 21)), expected, rtol=0, atol=0)
+        # Trimming is the inverse, and the center pixel stays at shape//2 for either parity
+        self.assertClose(kernelOps.padKernels(expected, (13, 13)), kernels, rtol=0, atol=0)
+        for shape in ((20, 20), (21, 22), (8, 9)):
+            padded = kernelOps.padKernels(kernels, shape)
+            self.assertEqual(padded.shape, (3,) + shape)
+            self.assertEqual(padded[1, shape[0]//2, shape[1]//2], kernels[1, 6, 6])
+
+    def testFixOddKernels(self):
+        for shape in ((21, 21), (20, 20), (21, 20), (20, 21)):
+            kernels = self.rng.rand(4, *shape)
+            expected = np.array([fixOddKernelLoop(k) for k in kernels])
+            self.assertClose(kernelOps.fixOddKernels(kernels), expected, rtol=1e-12)
+
+    def testFixEvenKernels(self):
+        for shape in ((21, 21), (20, 20), (16, 17)):
+            kernels = self.rng.rand(4, *shape)
+            expected = np.array([fixEvenKernelLoop(k) for k in kernels])
+            fixed = kernelOps.fixEvenKernels(kernels)
+            self.assertEqual(fixed.shape, expected.shape)
+            self.assertClose(fixed, expected, rtol=0, atol=0)
+            self.assertClose(kernelOps.fixEvenKernels(kernels[0]), expected[0], rtol=0, atol=0)
+
+    def testCorrectedDiffimPsfs(self):
+        kappas, psfs = self.rng.rand(3, 21, 21), self.rng.rand(3, 13, 13)
+        svars = np.array([0.04, 0.05, 0.06])
+        stacked = kernelOps.computeCorrectedDiffimPsfs(kappas, psfs, svars, 0.08)
+        for i in range(3):
+            single = kernelOps.computeCorrectedDiffimPsfs(kappas[i], psfs[i], svars[i], 0.08)
+            self.assertClose(stacked[i], single, rtol=1e-12, atol=1e-15)
+            self.assertAlmostEqual(stacked[i].sum(), 1.)
+
+    def testDecorrelationFilter(self):
+        # An asymmetric kappa, and kernels narrow enough for the decorrelation kernel to fit in 51x51
+        kappa = gaussianKernel((21, 21), 1.0, 10, 10.5)
+        kappa[8, 9] += 0.02
+        kappa /= kappa.sum()
+        psf = gaussianKernel((21, 21), 2.2, 10, 10)
+        image = self.rng.normal(size=(60, 70))
+        var = self.rng.uniform(1., 3., size=(60, 70))
+        svar, tvar = 0.04, 0.09
+
+        def convolve(arr, kernel):
+            return scipy.ndimage.filters.convolve(arr, kernel, mode='constant')
+
+        for preConvKernel in (None, gaussianKernel((21, 21), 0.8, 10, 10)):
+            # The filter of diffimTests.computeDecorrelationKernel(), at the size it uses (but without
+            # the rescaling of the kernels by fixOddKernels())
+            kappaFT = np.fft.fft2(np.pad(kappa, ((1, 0), (1, 0)), mode='constant'))
+            pcFT = 1. if preConvKernel is None else \
+                np.fft.fft2(np.pad(preConvKernel, ((1, 0), (1, 0)), mode='constant'))
+            expected = np.sqrt((svar + tvar) / (svar * np.abs(pcFT)**2 + tvar * np.abs(kappaFT)**2))
+            filt = kernelOps.DecorrelationFilter(kappa, svar, tvar, preConvKernel=preConvKernel,
+                                                 shape=(22, 22))
+            self.assertClose(filt.filter, expected, rtol=1e-12)
+
+            # Filtering the image and variance planes is convolving them with the kernel and its square
+            filt = kernelOps.DecorrelationFilter(kappa, svar, tvar, preConvKernel=preConvKernel, psf=psf)
+            self.assertEqual(filt.kernel().shape, (21, 21))
+            self.assertAlmostEqual(filt.filter[0, 0], 1.)
+            imageFilt = filt.atImageShape(image.shape)
+            kernel = imageFilt.kernel((51, 51))
+            self.assertClose(kernelOps.filterArray(image, imageFilt.filter), convolve(image, kernel),
+                             rtol=0, atol=1e-5)
+            self.assertClose(kernelOps.filterArray(var, imageFilt.varianceFilter), convolve(var, kernel**2.),
+                             rtol=0, atol=1e-5)
+
+            # The corrected PSF is the PSF pre-convolved and decorrelated
+            expected = np.pad(psf, 20, mode='constant')
+            if preConvKernel is not None:
+                expected = convolve(expected, preConvKernel)
+            expected = convolve(expected, filt.kernel((31, 31)))[20:-20, 20:-20]
+            self.assertClose(filt.correctedPsf(), expected / expected.sum(), rtol=0, atol=1e-4)
+
+        # A pre-convolution by the PSF shares its transform
+        filt = kernelOps.DecorrelationFilter(kappa, svar, tvar, preConvKernel=psf.copy(), psf=psf)
+        self.assertIs(filt.preConvFT, filt.psfFT)
+
+
+def directCovariance(im, im2, good, dy, dx):
+    """Reference: covariance of the good pixel pairs (q, q + (dy, dx)) by shifting and multiplying."""
+    h, w = im.shape
+    sl1 = (slice(max(0, -dy), h - max(0, dy)), slice(max(0, -dx), w - max(0, dx)))
+    sl2 = (slice(max(0, dy), h + min(0, dy)), slice(max(0, dx), w + min(0, dx)))
+    pair = good[sl1] & good[sl2]
+    x, y = im[sl1][pair], im2[sl2][pair]
+    return np.mean(x * y) - np.mean(x) * np.mean(y)
+
+
+def sigmaclipStats(im, low=3, high=3, ignore=None):
+    """Reference: the scipy.stats.sigmaclip version formerly in diffimTests.computeClippedImageStats."""
+    im = im[~(np.isnan(im) | np.isinf(im))]
+    if ignore is not None:
+        for i in ignore:
+            im = im[im != i]
+    tmp = im
+    if low != 0 and high != 0 and tmp.min() != tmp.max():
+        _, low, upp = scipy.stats.sigmaclip(tmp, low=low, high=high)
+        if not np.isnan(low) and not np.isnan(upp) and low != upp:
+            tmp = im[(im > low) & (im < upp)]
+    return np.nanmean(tmp), np.nanstd(tmp), np.nanmin(im), np.nanmax(im)
+
+
+class ImageStatsTest(lsst.utils.tests.TestCase):
+    """!Tests of the numpy image statistics in imageStats against direct computations."""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(12345)
+
+    def testClippedStats(self):
+        # Outliers on both sides, NaNs, infs and ignored values
+        im = self.rng.normal(100., 5., (150, 170))
+        im[10:20, 30:40] = 1e4
+        im[50, 50:60] = -1e3
+        im[70, :] = np.nan
+        im[80, ::3] = np.inf
+        im[90, ::5] = 0.
+        constant = np.full((30, 40), 7.)
+        constant[0, 0] = np.nan
+        cases = [(im, {}), (im, dict(ignore=[0.])), (im, dict(low=2., high=4.)), (im, dict(low=0.)),
+                 (constant, {})]
+        for image, kwargs in cases:
+            expected = np.array(sigmaclipStats(image, **kwargs))
+            exact = imageStats.clippedStats(image, method='exact', chunkSize=1000, **kwargs)
+            self.assertClose(np.array(exact), expected, rtol=1e-10)
+            # The histogram thresholds may clip the few pixels closest to them differently
+            hist = imageStats.clippedStats(image, method='histogram', chunkSize=1000, **kwargs)
+            self.assertClose(np.array(hist), expected, rtol=1e-4)
+        # A list of arrays is taken as the chunks of one image
+        self.assertClose(np.array(imageStats.clippedStats([im[:60], im[60:]])),
+                         np.array(sigmaclipStats(im)), rtol=1e-10)
+
+    def testPixelCovariance(self):
+        # Correlated noise, with a masked region and a NaN
+        im = self.rng.normal(10., 1., (64, 80))
+        im = im + 0.5 * np.roll(im, 1, axis=1) + 0.3 * np.roll(im, 2, axis=0)
+        im2 = im + self.rng.normal(0., 0.5, im.shape)
+        mask = np.zeros(im.shape, dtype=bool)
+        mask[10:20, 30:35] = True
+        im[40, 40] = np.nan
+        good = ~mask & np.isfinite(im) & np.isfinite(im2)
+        maxLag = 3
+        auto = imageStats.pixelCovariance(im, maxLag=maxLag, mask=mask)
+        cross = imageStats.pixelCovariance(im, im2, maxLag=maxLag, mask=mask)
+        for dy in range(-maxLag, maxLag + 1):
+            for dx in range(-maxLag, maxLag + 1):
+                self.assertClose(auto[dy + maxLag, dx + maxLag], directCovariance(im, im, good, dy, dx),
+                                 rtol=1e-9, atol=1e-12)
+                self.assertClose(cross[dy + maxLag, dx + maxLag], directCovariance(im, im2, good, dy, dx),
+                                 rtol=1e-9, atol=1e-12)
+
+    def testPixelCovarianceCircular(self):
+        im = self.rng.normal(0., 1., (32, 48))
+        cov = imageStats.pixelCovariance(im, maxLag=2, circular=True)
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                shifted = np.roll(np.roll(im, -dy, axis=0), -dx, axis=1)
+                expected = np.cov(im.ravel(), shifted.ravel(), bias=1)[0, 1]
+                self.assertClose(cov[dy + 2, dx + 2], expected, rtol=1e-9, atol=1e-12)
+
+    def testZscaleUniform(self):
+        # The sorted values of a uniform sample lie on a line spanning its range
+        im = self.rng.uniform(10., 20., (200, 300))
+        z1, z2 = imageStats.zscale(im, contrast=1.)
+        self.assertLess(abs(z1 - 10.), 0.5)
+        self.assertLess(abs(z2 - 20.), 0.5)
+        # ... so a smaller contrast is clipped to the sample's min and max
+        stride = int(np.sqrt(im.size / 1000.))
+        sample = im[::stride, ::stride]
+        self.assertEqual(imageStats.zscale(im), (sample.min(), sample.max()))
+
+    def testZscaleGaussian(self):
+        # The central slope of the sorted values of a normal sample of size n is sigma*sqrt(2*pi)/n,
+        # so with contrast=1 the limits are about median -/+ sigma*sqrt(2*pi)/2 (a little wider, as
+        # the line is fit out to the rejection limits, where the sorted values steepen), whatever
+        # the outliers
+        im = self.rng.normal(100., 5., (200, 300))
+        im[50:60, 50:60] = 1e5
+        im[100, :] = np.nan
+        z1, z2 = imageStats.zscale(im, contrast=1.)
+        halfWidth = 5. * np.sqrt(2. * np.pi) / 2.
+        self.assertLess(abs(z1 - (100. - halfWidth)), 0.5 * 5.)
+        self.assertLess(abs(z2 - (100. + halfWidth)), 0.5 * 5.)
+        self.assertLess(abs(z1 + z2 - 200.), 0.2 * 5.)
+        # A flat image gives equal limits
+        flat = np.full((100, 100), 7.)
+        flat[::7, ::11] = 1e4
+        self.assertClose(np.array(imageStats.zscale(flat)), np.array([7., 7.]), rtol=1e-12)
+
+    def testZscaleLimits(self):
+        # Sorted values on a line of slope 0.5 (with alternating +/-0.1 offsets, so that no value is
+        # rejected): the limits are the median -center and +(npix-1-center) slopes away from it
+        for shape in ((33, 31), (32, 31)):
+            npix = shape[0] * shape[1]
+            values = 0.5 * np.arange(npix) + 0.1 * (-1.)**np.arange(npix)
+            im = values[self.rng.permutation(npix)].reshape(shape)
+            z1, z2 = imageStats.zscale(im, contrast=2.)
+            center = (npix - 1) // 2
+            slope = 0.5 / 2.
+            self.assertClose(z2 - z1, (npix - 1) * slope, rtol=1e-5)
+            self.assertClose(z1 + z2, 2. * np.median(values) + (npix - 1 - 2*center) * slope, rtol=1e-5)
+
+
+def greedyMatch(xy1, xy2, radius):
+    """Reference: greedy one-to-one assignment of all pairs within `radius`, closest first."""
+    dist = np.hypot(xy1[:, None, 0] - xy2[None, :, 0], xy1[:, None, 1] - xy2[None, :, 1])
+    i, j = np.nonzero(dist <= radius)
+    used1, used2, pairs = set(), set(), {}
+    for n in np.argsort(dist[i, j], kind='mergesort'):
+        if i[n] not in used1 and j[n] not in used2:
+            used1.add(i[n])
+            used2.add(j[n])
+            pairs[(i[n], j[n])] = dist[i[n], j[n]]
+    return pairs
+
+
+class SourceMatchingTest(lsst.utils.tests.TestCase):
+    """!Tests of the KD-tree matching in sourceMatching against a brute-force greedy match."""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(12345)
+
+    def testMatchSources(self):
+        # A crowded field, where many sources have several candidates within the radius
+        xy1 = self.rng.uniform(0., 100., (400, 2))
+        xy2 = np.concatenate([xy1[:300] + self.rng.normal(0., 0.7, (300, 2)),
+                              self.rng.uniform(0., 100., (150, 2))])
+        for radius in (0.5, 2., 5.):
+            expected = greedyMatch(xy1, xy2, radius)
+            idx1, idx2, dist = sourceMatching.matchSources(xy1, xy2, radius, maxNeighbors=len(xy2))
+            self.assertEqual(len(set(idx1)), len(idx1))
+            self.assertEqual(len(set(idx2)), len(idx2))
+            self.assertEqual(set(zip(idx1, idx2)), set(expected.keys()))
+            self.assertClose(dist, np.array([expected[p] for p in zip(idx1, idx2)]), rtol=1e-12)
+
+    def testMatchSourcesEmpty(self):
+        xy = self.rng.uniform(0., 100., (10, 2))
+        for xy1, xy2 in ((xy, np.zeros((0, 2))), (np.zeros((0, 2)), xy), (xy, xy + 50.)):
+            idx1, idx2, dist = sourceMatching.matchSources(xy1, xy2, 1.)
+            self.assertEqual((len(idx1), len(idx2), len(dist)), (0, 0, 0))
+
+    def testScoreDetections(self):
+        trueXY = self.rng.uniform(0., 100., (50, 2))
+        detectedXY = np.concatenate([trueXY[:40] + 0.1, self.rng.uniform(200., 300., (5, 2))])
+        self.assertEqual(sourceMatching.scoreDetections(detectedXY, trueXY), {'TP': 40, 'FN': 10, 'FP': 5})
+
+
+class FastDetectionTest(lsst.utils.tests.TestCase):
+    """!Tests of the numpy source detection in fastDetection on injected PSFs."""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(12345)
+        self.sigma = 1.8
+        y, x = np.mgrid[-8:9, -8:9]
+        self.psf = np.exp(-(x**2. + y**2.) / (2. * self.sigma**2.))
+        self.psf /= self.psf.sum()
+
+    def _makeImage(self, shape, xc, yc, flux, noise=1.):
+        y, x = np.mgrid[:shape[0], :shape[1]]
+        im = self.rng.normal(0., noise, shape)
+        for f, x0, y0 in zip(flux, xc, yc):
+            im += f * np.exp(-((x - x0)**2. + (y - y0)**2.) / (2. * self.sigma**2.)) / \
+                (2. * np.pi * self.sigma**2.)
+        return im
+
+    def testDetectSources(self):
+        # A 5x5 grid of isolated sources, a sixth of them negative; the first half are centered on
+        # pixels, the others are offset by up to half a pixel
+        shape = (220, 230)
+        yc, xc = [a.ravel().astype(float) for a in np.mgrid[30:220:40, 30:230:40]]
+        n, nCentered = len(xc), len(xc) // 2
+        xc[nCentered:] += self.rng.uniform(-0.5, 0.5, n - nCentered)
+        yc[nCentered:] += self.rng.uniform(-0.5, 0.5, n - nCentered)
+        flux = self.rng.uniform(1000., 5000., n) * np.where(np.arange(n) % 6 == 5, -1., 1.)
+        im = self._makeImage(shape, xc, yc, flux)
+
+        sources = fastDetection.detectSources(im, self.psf, var=np.ones(shape), asDF=False)
+        self.assertEqual(len(sources['id']), n)
+        xy = np.column_stack([sources['base_NaiveCentroid_x'], sources['base_NaiveCentroid_y']])
+        idx1, idx2, dist = sourceMatching.matchSources(xy, np.column_stack([xc, yc]), 1.)
+        self.assertEqual(len(idx1), n)
+        centered = idx2 < nCentered
+        fitFlux, fluxSigma = sources['base_PsfFlux_flux'][idx1], sources['base_PsfFlux_fluxSigma'][idx1]
+        # Centered sources: exact centroids and unbiased PSF fluxes (to the noise)
+        self.assertLess(dist[centered].max(), 0.05)
+        self.assertLess(np.abs((fitFlux - flux[idx2]) / fluxSigma)[centered].max(), 4.)
+        # Offset sources: the centroids are within the peak pixel, and the PSF flux measured at the
+        # peak pixel loses at most a few percent
+        self.assertLess(dist.max(), 0.5)
+        ratio = fitFlux / flux[idx2]
+        self.assertGreater(ratio.min(), 0.95)
+        self.assertLess(ratio.max(), 1.02)
+        self.assertFalse(np.any(sources['base_PsfFlux_flag']))
+
+        positive = fastDetection.detectSources(im, self.psf, var=np.ones(shape), thresholdPolarity='positive',
+                                               asDF=False)
+        self.assertEqual(len(positive['id']), np.sum(flux > 0))
+        self.assertTrue(np.all(positive['base_PsfFlux_flux'] > 0))
+
+    def testNoSources(self):
+        sources = fastDetection.detectSources(self.rng.normal(0., 1., (100, 100)), self.psf, asDF=False)
+        self.assertEqual(len(sources['id']), 0)
+
+
+class KernelCacheTest(lsst.utils.tests.TestCase):
+    """!Tests of the keys of caches.KernelCache."""
+
+    def setUp(self):
+        self.kernel = np.random.RandomState(12345).rand(21, 21)
+        self.nCalls = 0
+
+    def _compute(self):
+        self.nCalls += 1
+        return np.full(3, self.nCalls)
+
+    def testExactVariances(self):
+        cache = caches.KernelCache()
+        first = cache.get('k', [self.kernel], [0.040004, 0.08], self._compute)
+        self.assertEqual(cache.get('k', [self.kernel], [0.040004, 0.08], self._compute)[0], first[0])
+        self.assertNotEqual(cache.get('k', [self.kernel], [0.040001, 0.08], self._compute)[0], first[0])
+        # Kernels differing only by round-off share an entry
+        cache.get('k', [self.kernel * (1. + 1e-12)], [0.040004, 0.08], self._compute)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def testVarianceDigits(self):
+        cache = caches.KernelCache(varianceDigits=4)
+        first = cache.get('k', [self.kernel], [0.040004, 0.08], self._compute)
+        self.assertEqual(cache.get('k', [self.kernel], [0.040001, 0.08], self._compute)[0], first[0])
+        self.assertNotEqual(cache.get('k', [self.kernel], [0.04001, 0.08], self._compute)[0], first[0])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()